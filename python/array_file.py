@@ -0,0 +1,95 @@
+import json
+import os
+import struct
+import numpy as np
+
+# Versioned binary file: a small JSON header followed by raw NumPy
+# arrays, mapped in memory when loaded.
+#
+# Layout: magic (8 bytes), format version (uint32 LE), header length
+# (uint64 LE), JSON header, then the arrays, each one aligned to 64
+# bytes. The header holds the file kind, the user metadata and, for
+# each array, its dtype, shape and offset. Loading reads the header
+# only, the arrays are paged in on access and shared among the
+# processes mapping the same file.
+
+_magic = b'\x93CASSARR'
+_version = 1
+_prefix = struct.Struct('<8sIQ')
+_align = 64
+
+def is_array_file(filename):
+    """Does the file start with the array file magic?"""
+    with open(filename, 'rb') as f:
+        return (f.read(len(_magic))==_magic)
+
+def save_arrays(filename, kind, header, arrays):
+    """Write arrays and metadata, replacing filename atomically
+
+    :param filename: Local filename, as string
+    :param kind: Type of content, checked on load
+    :param header: Metadata, JSON serializable dict
+    :param arrays: Dict of arrays, by name
+    :returns:
+    :rtype:
+
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    # offsets relative to the end of the header, fixed below
+    specs = {}
+    off = 0
+    for name, a in arrays.items():
+        specs[name] = {'dtype': a.dtype.str, 'shape': list(a.shape),
+                       'offset': off}
+        off += -(-a.nbytes//_align)*_align
+    head = {'kind': kind, 'meta': header, 'arrays': specs}
+    js = json.dumps(head).encode()
+    start = -(-(_prefix.size+len(js))//_align)*_align
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(_prefix.pack(_magic, _version, len(js)))
+        f.write(js)
+        for name, a in arrays.items():
+            f.seek(start + specs[name]['offset'])
+            f.write(a.data)
+        f.truncate(start + off)
+    os.replace(tmp, filename)
+
+def load_arrays(filename, kind, mmap=True):
+    """Read metadata and arrays, in constant time with mmap
+
+    :param filename: Local filename, as string
+    :param kind: Expected type of content
+    :param mmap: Map arrays read-only in memory instead of reading them (default: True)
+    :returns: (header, arrays), as dicts
+    :rtype: tuple
+
+    """
+    with open(filename, 'rb') as f:
+        magic, version, hlen = _prefix.unpack(f.read(_prefix.size))
+        if (magic!=_magic):
+            raise ValueError(f'{filename}: not an array file')
+        if (version>_version):
+            raise ValueError(f'{filename}: format version {version} '
+                             f'not supported (max {_version})')
+        head = json.loads(f.read(hlen))
+        if (head['kind']!=kind):
+            raise ValueError(f'{filename}: {head["kind"]} file, '
+                             f'{kind} expected')
+        start = -(-(_prefix.size+hlen)//_align)*_align
+        arrays = {}
+        for name, spec in head['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            off = start + spec['offset']
+            size = int(np.prod(shape, dtype=np.int64))
+            if (size==0): # empty files cannot be mapped
+                a = np.empty(shape, dtype=dtype)
+            elif (mmap):
+                a = np.memmap(f, dtype=dtype, mode='r', offset=off,
+                              shape=shape).view(np.ndarray)
+            else:
+                f.seek(off)
+                a = np.fromfile(f, dtype=dtype, count=size).reshape(shape)
+            arrays[name] = a
+    return (head['meta'], arrays)
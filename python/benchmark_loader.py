@@ -0,0 +1,118 @@
+# Copyright (c) 2020 CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark of the Cassandra data loader: patches per second read from a
+split, for different fetch configurations. With --sweep-driver, sweeps
+the driver settings of the C++ handler instead.
+"""
+
+import argparse
+import itertools
+import time
+
+from cassandra_dataset import CassandraDataset, close_sessions
+
+from cassandra.auth import PlainTextAuthProvider
+from getpass import getpass
+from tqdm import trange
+
+
+def run(ap, args, **ds_opts):
+    cd = CassandraDataset(ap, args.cassandra_ips, seed=args.seed, **ds_opts)
+    cd.load_splits(args.splits_fn, batch_size=args.batch_size,
+                   prefetch_depth=args.prefetch_depth)
+    cs = args.split
+    num_batches = min(args.num_batches, cd.num_batches[cs])
+    # warm up connections and buffers
+    for b in range(min(args.warmup, num_batches)):
+        cd.load_batch(cs)
+    cd.rewind_splits(cs)
+    t0 = time.perf_counter()
+    for b in trange(num_batches):
+        cd.load_batch(cs)
+    elapsed = time.perf_counter() - t0
+    # free handlers and sessions: each driver setting has its own session
+    cd.close()
+    close_sessions()
+    return num_batches * args.batch_size / elapsed
+
+
+def sweep_driver(ap, args):
+    # all the combinations of the given driver settings
+    names = ['io_threads', 'connections_per_host', 'latency_aware',
+             'speculative_delay_ms']
+    grid = [args.io_threads, args.connections_per_host,
+            [bool(v) for v in args.latency_aware], args.speculative_delay_ms]
+    res = []
+    for vals in itertools.product(*grid):
+        opts = dict(zip(names, vals))
+        rate = run(ap, args, multi_get=args.multi_get[0], driver_opts=opts)
+        res.append((vals, rate))
+        print(f'{opts}: {rate:.1f} patches/s')
+    print()
+    print('\t'.join(names + ['patches/s']))
+    for vals, rate in sorted(res, key=lambda r: -r[1]):
+        print('\t'.join(str(v) for v in vals) + f'\t{rate:.1f}')
+
+
+def main(args):
+    if not args.cassandra_pwd_fn:
+        cass_pass = getpass('Insert Cassandra password: ')
+    else:
+        with open(args.cassandra_pwd_fn) as fd:
+            cass_pass = fd.readline().rstrip()
+    ap = PlainTextAuthProvider(username='prom', password=cass_pass)
+
+    if (args.sweep_driver):
+        sweep_driver(ap, args)
+        return
+    # one query per key (multi_get=1) vs. requests grouped by replica
+    res = []
+    for mg in args.multi_get:
+        rate = run(ap, args, multi_get=mg)
+        res.append((mg, rate))
+        print(f'multi_get={mg}: {rate:.1f} patches/s')
+    print()
+    print('multi_get\tpatches/s')
+    for mg, rate in res:
+        print(f'{mg}\t{rate:.1f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--splits-fn", metavar="STR", required=True,
+                        help="Pickle file with cassandra splits")
+    parser.add_argument("--cassandra-pwd-fn", metavar="STR", default='/tmp/cassandra_pass.txt',
+                        help="cassandra password")
+    parser.add_argument("--cassandra-ips", nargs='+', default=['127.0.0.1'], help='Cassandra contact points')
+    parser.add_argument("--split", type=int, metavar="INT", default=0, help='Split to be read')
+    parser.add_argument("--batch-size", type=int, metavar="INT", default=256, help='Batch size')
+    parser.add_argument("--num-batches", type=int, metavar="INT", default=50, help='Number of timed batches')
+    parser.add_argument("--warmup", type=int, metavar="INT", default=5, help='Number of batches read before timing')
+    parser.add_argument("--prefetch-depth", type=int, metavar="INT", default=1, help='Number of batches per split loaded in advance from Cassandra')
+    parser.add_argument("--seed", type=int, metavar="INT", default=None, help='Seed of the random generator to manage data load')
+    parser.add_argument("--multi-get", type=int, nargs='+', default=[1, 16, 64], help='Max patches per request to be compared, 1 is one query per patch')
+    parser.add_argument("--sweep-driver", action='store_true', help='Sweep the driver settings below (C++ handler), using the first --multi-get value')
+    parser.add_argument("--io-threads", type=int, nargs='+', default=[1, 2, 4], help='Driver I/O threads to be swept')
+    parser.add_argument("--connections-per-host", type=int, nargs='+', default=[1, 2], help='Connections per host to be swept')
+    parser.add_argument("--latency-aware", type=int, nargs='+', default=[0, 1], help='Latency-aware routing (0/1) to be swept')
+    parser.add_argument("--speculative-delay-ms", type=int, nargs='+', default=[-1, 20], help='Speculative execution delays to be swept, negative to disable')
+    main(parser.parse_args())
@@ -0,0 +1,83 @@
+# Copyright (c) 2020 CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark of the scan of the ids table: time to read the full list of
+rows partition by partition and by token ranges, for different
+parallelism levels.
+"""
+
+import argparse
+import time
+
+from cassandra_dataset import CassandraDataset, close_sessions
+
+from cassandra.auth import PlainTextAuthProvider
+from getpass import getpass
+
+
+def run(cd, scan_par, token_scan):
+    t0 = time.perf_counter()
+    cd.read_rows_from_db(scan_par=scan_par, token_scan=token_scan)
+    elapsed = time.perf_counter() - t0
+    return elapsed, cd._clm.tot
+
+
+def main(args):
+    if not args.cassandra_pwd_fn:
+        cass_pass = getpass('Insert Cassandra password: ')
+    else:
+        with open(args.cassandra_pwd_fn) as fd:
+            cass_pass = fd.readline().rstrip()
+    ap = PlainTextAuthProvider(username='prom', password=cass_pass)
+
+    cd = CassandraDataset(ap, args.cassandra_ips, seed=args.seed)
+    cd.init_listmanager(table=args.ids_table, id_col='patch_id',
+                        partition_cols=args.partition_cols,
+                        split_ncols=args.split_ncols,
+                        num_classes=args.num_classes)
+    res = []
+    for token_scan in [False, True]:
+        for sp in args.scan_par:
+            elapsed, tot = run(cd, sp, token_scan)
+            mode = 'tokens' if token_scan else 'partitions'
+            res.append((mode, sp, elapsed, tot))
+            print(f'{mode}, scan_par={sp}: {elapsed:.1f} s, {tot} patches')
+    cd.close()
+    close_sessions()
+    print()
+    print('mode\tscan_par\tseconds\tpatches/s')
+    for mode, sp, elapsed, tot in res:
+        print(f'{mode}\t{sp}\t{elapsed:.1f}\t{tot/elapsed:.1f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ids-table", metavar="STR", default='promort.ids_osk_0',
+                        help="Cassandra table with the patch ids")
+    parser.add_argument("--partition_cols", nargs='+', default=['sample_name', 'sample_rep', 'label'])
+    parser.add_argument("--split-ncols", type=int, metavar="INT", default=1)
+    parser.add_argument("--num-classes", type=int, metavar="INT", default=2)
+    parser.add_argument("--cassandra-pwd-fn", metavar="STR", default='/tmp/cassandra_pass.txt',
+                        help="cassandra password")
+    parser.add_argument("--cassandra-ips", nargs='+', default=['127.0.0.1'], help='Cassandra contact points')
+    parser.add_argument("--seed", type=int, metavar="INT", default=None, help='Seed of the random generators')
+    parser.add_argument("--scan-par", type=int, nargs='+', default=[1, 8, 32], help='Scan parallelism levels to be compared')
+    main(parser.parse_args())
@@ -0,0 +1,127 @@
+import os
+import struct
+import fcntl
+import threading
+
+# Local disk cache of patch blobs, shared by processes on the same host.
+#
+# Layout (same as the C++ BlobCache): <path>/<hex[:2]>/<hex>, with hex
+# the patch_id as 32 hex digits. Each file stores the label as a
+# little-endian int32, followed by the raw blob. Files are written to a
+# temporary name and atomically renamed. Hits refresh the file mtime, so
+# eviction removes the least recently used files first.
+class BlobCache():
+    def __init__(self, path, max_bytes):
+        """Read-through cache of (label, blob) pairs, keyed by patch_id
+
+        :param path: Cache directory (e.g., on local NVMe)
+        :param max_bytes: Size budget, in bytes
+        :returns:
+        :rtype:
+
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.added = 0 # bytes written since last eviction check
+        self.evicting = False
+        os.makedirs(path, exist_ok=True)
+        # check budget at startup
+        self._start_eviction()
+    def _key2path(self, key):
+        # accept uuid.UUID or its string representation
+        h = key.hex if hasattr(key, 'hex') else str(key).replace('-', '')
+        return os.path.join(self.path, h[:2], h)
+    def get(self, key):
+        """Return (label, blob) if key is cached, None otherwise"""
+        fn = self._key2path(key)
+        try:
+            with open(fn, 'rb') as f:
+                buf = f.read()
+            os.utime(fn) # refresh for LRU
+        except OSError: # not cached or just evicted
+            buf = b''
+        if (len(buf)<4):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        lab, = struct.unpack('<i', buf[:4])
+        return (lab, buf[4:])
+    def put(self, key, lab, blob):
+        fn = self._key2path(key)
+        d = os.path.dirname(fn)
+        tmp = os.path.join(d, f'.{os.path.basename(fn)}.{os.getpid()}.'
+                           f'{threading.get_ident()}.tmp')
+        try:
+            os.makedirs(d, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(struct.pack('<i', lab))
+                f.write(blob)
+            os.replace(tmp, fn) # atomic
+        except OSError: # e.g., disk full, the cache is best effort
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.added += len(blob) + 4
+            check = (self.added > self.max_bytes//16)
+        if (check):
+            self._start_eviction()
+    def _start_eviction(self):
+        with self.lock:
+            if (self.evicting):
+                return
+            self.evicting = True
+            self.added = 0
+        threading.Thread(target=self.evict, daemon=True).start()
+    def evict(self, low_water=0.9):
+        """Remove least recently used files until below low_water*max_bytes"""
+        try:
+            # one evicting process at a time
+            with open(os.path.join(self.path, '.lock'), 'w') as lf:
+                try:
+                    fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return # another process is evicting
+                entries = []
+                tot = 0
+                for d in os.scandir(self.path):
+                    if (not d.is_dir()):
+                        continue
+                    for e in os.scandir(d.path):
+                        try:
+                            st = e.stat()
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime, st.st_size, e.path))
+                        tot += st.st_size
+                if (tot <= self.max_bytes):
+                    return
+                entries.sort()
+                removed = 0
+                for (mt, sz, fn) in entries:
+                    if (tot <= low_water*self.max_bytes):
+                        break
+                    try:
+                        os.unlink(fn)
+                    except OSError:
+                        continue
+                    tot -= sz
+                    removed += 1
+                with self.lock:
+                    self.evictions += removed
+        finally:
+            with self.lock:
+                self.evicting = False
+    def stats(self):
+        """Hit, miss and eviction counters"""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
@@ -1,4 +1,5 @@
 import io
+import os
 import numpy as np
 import random
 import pickle
@@ -8,16 +9,21 @@ import pyeddl.eddl as eddl
 from pyeddl.tensor import Tensor
 import time
 import threading
+import uuid
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import trange, tqdm
-
-# pip3 install cassandra-driver
-import cassandra
-from cassandra.cluster import Cluster
-from cassandra.auth import PlainTextAuthProvider
-from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
-from cassandra.cluster import ExecutionProfile
+from blob_cache import BlobCache
+from cassandra_session import get_session, release_session
+from cassandra_session import close_sessions as _close_py_sessions
+from concurrency_limit import AIMDLimit
+from array_file import is_array_file, save_arrays, load_arrays
 
 _max_multilabs = 32
+_decode_scales = [1, 1/2, 1/4, 1/8]
 
 # Handler for large query results
 class PagedResultHandler():
@@ -39,12 +45,170 @@ class PagedResultHandler():
         self.error = exc
         self.finished_event.set()
 
+# Request to Cassandra, possibly duplicated (hedged) to another replica
+class _Request():
+    def __init__(self, group, gen):
+        self.group = group
+        self.gen = gen
+        self.t0 = time.perf_counter()
+        self.attempts = 0 # attempts in flight
+        self.hedged = False
+        self.done = False # first answer arrived
+
+def _hedge_monitor(handler_ref, stop):
+    # send hedged requests when due, holding the handler only weakly
+    while (not stop.is_set()):
+        handler = handler_ref()
+        if (handler is None):
+            return
+        wait = handler._check_hedges()
+        del handler
+        stop.wait(wait)
+
+def uuids_to_raw(ids):
+    """Patch ids as a (N,16) uint8 array
+
+    :param ids: uuid.UUID's, or rows as dicts with the uuid as only value
+    :returns: Raw 16-byte keys, one per row
+    :rtype: numpy.ndarray
+
+    """
+    ids = [next(iter(i.values())) if isinstance(i, dict) else i for i in ids]
+    raw = np.frombuffer(b''.join(i.bytes for i in ids), dtype=np.uint8)
+    return raw.reshape(-1, 16).copy()
+
+def raw_to_uuids(raw):
+    """Patch ids from a (N,16) uint8 array
+
+    :param raw: Raw 16-byte keys
+    :returns: List of uuid.UUID
+    :rtype: list
+
+    """
+    buf = np.ascontiguousarray(raw, dtype=np.uint8).tobytes()
+    return [uuid.UUID(bytes=buf[i:i+16]) for i in range(0, len(buf), 16)]
+
+def _decode_img(raw_img, aug, scale=1):
+    # decode jpeg blob
+    in_stream = io.BytesIO(raw_img)
+    img = PIL.Image.open(in_stream) # xyc, RGB
+    if (scale!=1):
+        # scaled IDCT, the full size image is never decoded
+        w, h = img.size
+        img.draft('RGB', (int(w*scale), int(h*scale)))
+        if (img.size==(w, h)): # not a jpeg, reduce after decoding
+            img = img.reduce(int(1/scale))
+    arr = np.array(img) # yxc, RGB
+    img.close()
+    arr = arr[..., ::-1] # yxc, BGR
+    # apply augmentations on eimg and then convert back to array
+    if (aug is not None):
+        eimg = ecvl.Image.fromarray(arr, "yxc", ecvl.ColorType.BGR)
+        aug.Apply(eimg)
+        arr = np.array(eimg) #yxc, BGR
+    return arr
+
+def _make_aug(aug):
+    # ECVL augmentation, also given as text (AugmentationFactory syntax)
+    if (isinstance(aug, str)):
+        return ecvl.AugmentationFactory.create(aug)
+    return aug
+
+def _norm_params(scale, mean, std):
+    # per-channel (x*scale-mean)/std as x*ch_scale+ch_off, None if identity
+    if (scale==1 and mean is None and std is None):
+        return None
+    mean = np.zeros(1) if mean is None else np.array(mean, dtype=np.float64)
+    std = np.ones(1) if std is None else np.array(std, dtype=np.float64)
+    ch_scale = (scale/std).astype(np.float32).reshape(-1,1,1)
+    ch_off = (-mean/std).astype(np.float32).reshape(-1,1,1)
+    return (ch_scale, ch_off)
+
+def _write_patch(dst, arr, norm):
+    # copy yxc patch into cyx slot, fusing conversion and normalization
+    src = arr.transpose(2,0,1)
+    if (norm is None):
+        dst[...] = src
+    else:
+        ch_scale, ch_off = norm
+        np.multiply(src, ch_scale, out=dst)
+        dst += ch_off
+
+# Decoding worker processes, writing directly into the shared batch buffer;
+# one pool can serve several handlers, each task carrying its parameters
+_dec_augs = {} # ECVL augmentations built from text, by text
+_dec_shm = OrderedDict() # attached batch buffers, most recent last
+_dec_shm_max = 16
+def decode_pool(workers, seed=None):
+    """Start a pool of decoding processes, to be shared by batch handlers
+
+    Workers are started by a fork server, so the main script needs the
+    __main__ guard.
+
+    :param workers: Number of processes
+    :param seed: Seed of the augmentations, worker i uses seed+i (default: None, random)
+    :returns: The pool
+    :rtype: multiprocessing.pool.Pool
+
+    """
+    if (seed is None):
+        seed = random.getrandbits(32)
+    # workers forked by a server process, since forking this one while
+    # Cassandra driver threads run (sessions are shared) could leave
+    # their locks held in the children
+    ctx = multiprocessing.get_context('forkserver')
+    # preload this module only, not the (maybe unguarded) main one
+    ctx.set_forkserver_preload([__name__])
+    # share one tracker of shared memory among workers and parent
+    resource_tracker.ensure_running()
+    return ctx.Pool(workers, initializer=_init_decoder,
+                    initargs=(seed, ctx.Value('i', 0)))
+def _init_decoder(seed, counter):
+    # a different random stream in each worker, seeded by worker index
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    ecvl.AugmentationParam.SetSeed((seed + index) % 2**32)
+def _decode_to_shm(raw_img, shm_name, shape, dtype, idx, aug, scale, norm):
+    # pickled: ECVL augmentations come as text
+    if (isinstance(aug, str)):
+        if (aug not in _dec_augs):
+            _dec_augs[aug] = _make_aug(aug)
+        aug = _dec_augs[aug]
+    arr = _decode_img(raw_img, aug, scale)
+    chw = (arr.shape[2], arr.shape[0], arr.shape[1])
+    if (chw!=tuple(shape[1:])):
+        raise ValueError(f'Patch shape {chw} differs from {shape[1:]}')
+    # attach to the batch buffer, detach from the least recent ones
+    if (shm_name in _dec_shm):
+        _dec_shm.move_to_end(shm_name)
+    else:
+        while (len(_dec_shm)>=_dec_shm_max):
+            _dec_shm.popitem(last=False)[1].close()
+        _dec_shm[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    buf = np.ndarray(shape, dtype=dtype, buffer=_dec_shm[shm_name].buf)
+    _write_patch(buf[idx], arr, norm)
+
 # Handler for batch of patches
 class BatchPatchHandler():
     def __init__(self, num_classes, aug, table, label_col, data_col,
                  id_col, username, cass_pass, cassandra_ips,
-                 thread_par=32, port=9042):
-        self.aug = aug
+                 thread_par=32, port=9042, decode_scale=1, norm_scale=1,
+                 norm_mean=None, norm_std=None, out_uint8=False,
+                 cache_dir=None, cache_bytes=10*2**30, prealloc=True,
+                 decode_workers=0, multi_get=1, hedge_pct=None,
+                 inflight_bounds=None, dec_pool=None):
+        if (decode_scale not in _decode_scales):
+            raise ValueError('decode_scale must be one of 1, 1/2, 1/4, 1/8')
+        ## output type and normalization, fused in the batch copy
+        self.norm = _norm_params(norm_scale, norm_mean, norm_std)
+        self.out_uint8 = out_uint8
+        if (out_uint8 and self.norm is not None):
+            raise ValueError('Normalization not available with uint8 output')
+        if ((out_uint8 or self.norm is not None) and not prealloc):
+            raise ValueError('Normalization and uint8 output need prealloc')
+        self.aug = _make_aug(aug)
+        self.decode_scale = decode_scale
         self.num_classes = num_classes
         self.label_col = label_col
         self.data_col = data_col
@@ -52,6 +216,21 @@ class BatchPatchHandler():
         self.finished_event = threading.Event()
         self.lock = threading.Lock()
         self.thread_par = thread_par
+        ## requests in flight: thread_par, or adapted between bounds
+        self.limiter = None
+        if (inflight_bounds is not None):
+            self.limiter = AIMDLimit(*inflight_bounds, initial=thread_par)
+        self.multi_get = multi_get # max keys per request
+        ## hedged requests: duplicate requests slower than the hedge_pct
+        ## percentile of recent latencies
+        self.hedge_pct = hedge_pct
+        self.hedge_q = deque() # requests to be checked, by issue time
+        self.hedge_thr = None # seconds, None until enough samples
+        self.lats = deque(maxlen=1024)
+        self.n_req = 0
+        self.n_hedged = 0
+        self.n_hedge_wins = 0
+        self.hedge_stop = threading.Event()
         self.tot = None
         self.cow = 0
         self.onair = 0
@@ -59,59 +238,307 @@ class BatchPatchHandler():
         self.feats = []
         self.labels = []
         self.perm = []
+        self.pending = deque()
         self.bb = None
+        ## preallocated NCHW batch buffers, reused across batches
+        self.prealloc = prealloc
+        self.chw = None # patch shape, known after first image
+        self.b_feats = None
+        self.b_labels = None
         ## multi-label when num_classes is small
         self.multi_label = (num_classes<=_max_multilabs)
-        ## cassandra parameters
-        prof_dict = ExecutionProfile(
-            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
-            row_factory = cassandra.query.dict_factory)
-        profs = {'dict': prof_dict}
-        auth_prov = PlainTextAuthProvider(username=username, password=cass_pass)
-        self.cluster = Cluster(cassandra_ips,
-                               execution_profiles=profs,
-                               protocol_version=4,
-                               auth_provider=auth_prov,
-                               port=port)
-        self.cluster.connect_timeout = 10 #seconds
-        self.sess = self.cluster.connect()
+        ## optional process pool for decoding and augmentation, own or
+        ## shared with other handlers (see decode_pool)
+        self.dec_pool = dec_pool
+        self.own_pool = False
+        self.dec_aug = aug # as given, pickled to the workers
+        self.shm = None # shared batch buffer, written by the workers
+        self.gen = 0 # batch counter, to discard results of old batches
+        if (dec_pool is not None or decode_workers>0):
+            assert(prealloc)
+            try:
+                pickle.dumps(aug)
+            except Exception:
+                raise ValueError('With decoding workers the augmentation '
+                                 'must be picklable, e.g., ECVL text '
+                                 '(AugmentationFactory syntax)')
+            if (dec_pool is None):
+                self.dec_pool = decode_pool(decode_workers)
+                self.own_pool = True
+        ## cassandra parameters, session shared with other handlers
+        self.shared = get_session(cassandra_ips, port, username, cass_pass)
+        self.cluster = self.shared.cluster
+        self.sess = self.shared.sess
         self.table = table
         query = f"SELECT {self.label_col}, {self.data_col} \
         FROM {self.table} WHERE {self.id_col}=?"
-        self.prep = self.sess.prepare(query)
+        self.prep = self.shared.prepare(query)
+        # multi-partition query, for keys owned by the same replica
+        self.prep_in = None
+        if (multi_get>1):
+            query = f"SELECT {self.id_col}, {self.label_col}, \
+            {self.data_col} FROM {self.table} WHERE {self.id_col} IN ?"
+            self.prep_in = self.shared.prepare(query)
+        if (hedge_pct is not None):
+            threading.Thread(target=_hedge_monitor, daemon=True,
+                             args=(weakref.ref(self),
+                                   self.hedge_stop)).start()
+        ## optional local cache of blobs, looked up by worker threads
+        self.cache = None
+        self.cache_pool = None
+        if (cache_dir is not None):
+            self.cache = BlobCache(os.path.join(cache_dir, table),
+                                   cache_bytes)
+            self.cache_pool = ThreadPoolExecutor(max_workers=thread_par)
     def __del__(self):
-        self.cluster.shutdown()
+        self.close()
+    def close(self):
+        """Stop the handler and release its Cassandra session"""
+        self.hedge_stop.set()
+        if (self.cache_pool is not None):
+            self.cache_pool.shutdown(wait=False)
+        if (self.dec_pool is not None):
+            if (self.own_pool):
+                self.dec_pool.terminate()
+            self._free_shm()
+        if (self.shared is not None):
+            release_session(self.shared)
+            self.shared = None
     def reset(self, tot):
-        self.tot = tot
-        self.cow = 0
-        self.onair = 0
-        self.errors = []
-        self.feats = []
-        self.labels = []
-        self.perm = []
-        self.bb = None
-        self.finished_event.clear()
+        # under lock: late callbacks of the old batch check gen with the
+        # lock held, and see either the old batch or the new one
+        with self.lock:
+            # failed batch: workers might still be writing in the old buffer
+            if (self.errors and self.shm is not None):
+                self._free_shm()
+            self.gen += 1
+            self.tot = tot
+            self.cow = 0
+            self.onair = 0
+            self.errors = []
+            self.feats = []
+            self.labels = []
+            self.perm = []
+            self.pending = deque()
+            self.bb = None
+            self.finished_event.clear()
+            # allocate batch buffers now, if patch shape is already known
+            if (self.prealloc and self.chw is not None):
+                self._alloc_batch(self.chw)
+    def _alloc_batch(self, chw):
+        # (re)allocate buffers only if batch shape has changed
+        shape = (self.tot,) + chw
+        dtype = np.uint8 if self.out_uint8 else np.float32
+        if (self.b_feats is None or self.b_feats.shape!=shape):
+            if (self.dec_pool is not None):
+                # buffer shared with the decoding workers
+                self._free_shm()
+                size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                self.shm = shared_memory.SharedMemory(create=True, size=size)
+                self.b_feats = np.ndarray(shape, dtype=dtype,
+                                          buffer=self.shm.buf)
+            else:
+                self.b_feats = np.empty(shape, dtype=dtype)
+            self.b_labels = np.empty((self.tot, self.num_classes),
+                                     dtype=np.float32)
+        self.chw = chw
+    def _free_shm(self):
+        self.b_feats = None # drop view before closing
+        if (self.shm is not None):
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
     def schedule_batch(self, keys_):
+        # raw 16-byte keys, as (N,16) uint8 array
+        if (isinstance(keys_, np.ndarray)):
+            keys_ = raw_to_uuids(keys_)
         self.reset(tot=len(keys_))
-        kk = list(enumerate(keys_))
-        # concurrent queries to Cassandra server
-        cass_par = min(self.thread_par, self.tot)
-        while (len(kk)>0):
+        self.pending = deque(self._group_keys(list(enumerate(keys_))))
+        # concurrent requests to Cassandra server: start the first ones,
+        # up to the limit, the others are issued by the callbacks
+        self._issue_queries()
+    def _group_keys(self, items):
+        # one request per key
+        if (self.multi_get<=1):
+            return [[it] for it in items]
+        # group keys by owning replica and split groups in IN lists
+        groups = {}
+        for (idx, key) in items:
+            reps = self._replicas(key)
+            host = reps[0] if reps else None
+            groups.setdefault(host, []).append((idx, key))
+        chunks = []
+        for g in groups.values():
+            for i in range(0, len(g), self.multi_get):
+                chunks.append(g[i:i+self.multi_get])
+        return chunks
+    def _inflight_limit(self):
+        if (self.limiter is None):
+            return self.thread_par
+        return self.limiter.get()
+    def inflight_limit(self):
+        """Current limit of requests in flight"""
+        with self.lock:
+            return self._inflight_limit()
+    def _issue_queries(self):
+        # send pending requests while below the limit (not to be called
+        # with lock held, since callbacks of already completed futures
+        # run synchronously)
+        while (self._issue_query()):
+            pass
+    def _issue_query(self):
+        # send next pending request, if any and below the limit
+        with self.lock:
+            if (not self.pending or self.onair>=self._inflight_limit()):
+                return False
+            group = self.pending.popleft()
+            self.onair += 1
+            gen = self.gen
+        if (self.cache is not None):
+            self.cache_pool.submit(self._fetch_cached, group, gen)
+            return True
+        self._query(group, gen)
+        return True
+    def _query(self, group, gen):
+        req = _Request(group, gen)
+        self._send(req)
+        if (self.hedge_pct is not None):
+            with self.lock:
+                self.hedge_q.append(req)
+    def _send(self, req, host=None):
+        # send (or resend) request, to host if given
+        opts = {'execution_profile': 'dict'}
+        if (host is not None):
+            opts['host'] = host
+        with self.lock:
+            req.attempts += 1
+        if (len(req.group)==1):
+            idx, key = req.group[0]
+            future = self.sess.execute_async(self.prep, [key], **opts)
+        else:
+            keys = [key for (idx, key) in req.group]
+            # no routing key for IN lists: send to the replica owning
+            # the keys, as grouped by _group_keys
+            if (host is None):
+                reps = self._replicas(keys[0])
+                if (reps and reps[0].is_up is not False):
+                    opts['host'] = reps[0]
+            future = self.sess.execute_async(self.prep_in, [keys], **opts)
+        self.add_future(future, req)
+    def _check_hedges(self):
+        # hedge requests older than threshold, return time to next check
+        hedge = []
+        wait = 0.01
+        with self.lock:
+            now = time.perf_counter()
+            while (self.hedge_q):
+                req = self.hedge_q[0]
+                if (req.done or req.gen!=self.gen):
+                    self.hedge_q.popleft()
+                    continue
+                if (self.hedge_thr is None):
+                    break
+                late = req.t0 + self.hedge_thr - now
+                if (late>0):
+                    wait = min(wait, late)
+                    break
+                self.hedge_q.popleft()
+                req.hedged = True
+                self.n_hedged += 1
+                hedge.append(req)
+        for req in hedge:
+            try:
+                self._send(req, self._hedge_host(req.group[0][1]))
+            except Exception:
+                pass # the first attempt is still in flight
+        return max(wait, 0.0005)
+    def _replicas(self, key):
+        # replicas owning key, primary first
+        rk = self.prep.bind([key]).routing_key
+        return self.cluster.metadata.get_replicas(self.prep.keyspace, rk)
+    def _hedge_host(self, key):
+        # a replica other than the primary one, if known
+        reps = self._replicas(key)
+        if (len(reps)<2):
+            return None
+        return random.choice(reps[1:])
+    def _claim(self, req, hedge_win=False):
+        # first answer wins, the other one is dropped
+        with self.lock:
+            req.attempts -= 1
+            if (req.done or req.gen!=self.gen):
+                return False
+            req.done = True
+            self.n_req += 1
+            if (self.limiter is not None):
+                self.limiter.on_sample(req.t0, self.onair)
+            # answered: free the slot before any patch completes the batch
+            self.onair -= 1
+            if (hedge_win):
+                self.n_hedge_wins += 1
+            if (self.hedge_pct is not None):
+                self.lats.append(time.perf_counter() - req.t0)
+                if (len(self.lats)>=64 and self.n_req%64==0):
+                    self.hedge_thr = np.percentile(self.lats, self.hedge_pct)
+            return True
+    def hedge_stats(self):
+        with self.lock:
+            thr = -1 if self.hedge_thr is None else int(self.hedge_thr*1e6)
+            return {'requests': self.n_req, 'hedged': self.n_hedged,
+                    'hedge_wins': self.n_hedge_wins, 'threshold_us': thr}
+    def _fetch_cached(self, group, gen):
+        # read from local cache, query Cassandra for the misses
+        if (gen!=self.gen):
+            return # batch already failed
+        hits = []
+        miss = []
+        try:
+            for (idx, key) in group:
+                hit = self.cache.get(key)
+                if (hit is None):
+                    miss.append((idx, key))
+                else:
+                    hits.append((idx, hit))
+            if (miss): # the slot goes to the query of the misses
+                self._query(miss, gen)
+        except Exception as exc:
+            self.handle_error(exc, gen)
+            return
+        if (not miss):
+            # free the slot before any patch completes the batch
+            with self.lock:
+                if (gen==self.gen):
+                    self.onair -= 1
+        try:
+            for (idx, (lab, blob)) in hits:
+                self._process_item(idx, {self.label_col: lab,
+                                         self.data_col: blob}, gen)
+        except Exception as exc:
+            self._fail(exc, gen)
+            return
+        if (not miss):
+            self._issue_queries()
+    def add_future(self, future, req):
+        hedge = req.hedged # attempt sent as hedge
+        def errback(exc):
             with self.lock:
-                if (self.onair<cass_par):
-                    idx, keys = kk.pop(0)
-                    future = self.sess.execute_async(self.prep, [keys],
-                                                     execution_profile='dict')
-                    self.onair += 1
-                    self.add_future(future, idx)
-            # sleep 0.1 ms
-            time.sleep(.0001)
-    def add_future(self, future, idx):
+                req.attempts -= 1
+                if (req.done or req.gen!=self.gen):
+                    return
+                if (req.attempts>0):
+                    return # the other attempt might still succeed
+                req.done = True
+                if (self.limiter is not None):
+                    self.limiter.on_sample(req.t0, self.onair, dropped=True)
+            self.handle_error(exc, req.gen)
         future.add_callbacks(
-            callback=self.handle_res(idx),
-            errback=self.handle_error)
-    def _get_img(self, item):
-        # read label
+            callback=self.handle_res(req, hedge),
+            errback=errback)
+    def cache_stats(self):
+        if (self.cache is None):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+        return self.cache.stats()
+    def _get_label(self, item):
         lab = item[self.label_col] # read 32-bit int
         # convert to bits
         if (self.multi_label):
@@ -122,45 +549,125 @@ class BatchPatchHandler():
             v_lab = np.zeros([self.num_classes])
             v_lab[lab] = 1
             lab = v_lab
-        # read image
-        raw_img = item[self.data_col]
-        in_stream = io.BytesIO(raw_img)
-        img = PIL.Image.open(in_stream) # xyc, RGB
-        arr = np.array(img) # yxc, RGB
-        img.close()
-        arr = arr[..., ::-1] # yxc, BGR
-        # apply augmentations on eimg and then convert back to array
-        if (self.aug is not None):
-            eimg = ecvl.Image.fromarray(arr, "yxc", ecvl.ColorType.BGR)
-            self.aug.Apply(eimg)
-            arr = np.array(eimg) #yxc, BGR
+        return lab
+    def _get_img(self, item):
+        lab = self._get_label(item)
+        arr = _decode_img(item[self.data_col], self.aug, self.decode_scale)
         return (arr, lab)
-    def handle_res(self, idx):
+    def handle_res(self, req, hedge=False):
         def fun(rows):
+            if (not self._claim(req, hedge)):
+                return # late result of a failed batch, or hedge loser
+            try:
+                self._process_rows(req.group, rows, req.gen)
+            except Exception as exc:
+                self._fail(exc, req.gen) # slot freed by _claim
+                return
+            # a slot is free: send the next requests
+            self._issue_queries()
+        return fun
+    def _process_rows(self, group, rows, gen):
+        # single key: one row expected
+        if (len(group)==1):
             assert(len(rows)==1)
-            item = rows[0]
-            feat, lab = self._get_img(item)
-            with self.lock:
-                self.feats.append(feat)
-                self.labels.append(lab)
-                self.perm.append(idx)
-                self.cow += 1
+            idx, key = group[0]
+            self._process_item(idx, rows[0], gen, key)
+            return
+        # IN list: scatter rows to their slots, by id
+        slots = {}
+        for (idx, key) in group:
+            slots.setdefault(key, []).append(idx)
+        for item in rows:
+            key = item[self.id_col]
+            for idx in slots.pop(key, []):
+                self._process_item(idx, item, gen, key)
+        if (slots):
+            raise KeyError(f'Patches not found: {list(slots)}')
+    def _process_item(self, idx, item, gen, key=None):
+        # fresh from Cassandra: save in local cache
+        if (self.cache is not None and key is not None):
+            self.cache.put(key, item[self.label_col], item[self.data_col])
+        # patch shape known: decode in worker process
+        if (self.dec_pool is not None and self.chw is not None):
+            self._submit_decode(item[self.data_col], idx,
+                                self._get_label(item), gen)
+            return
+        feat, lab = self._get_img(item)
+        if (self.prealloc):
+            self._write_slot(idx, feat, lab, gen)
+            self._patch_done(gen)
+            return
+        with self.lock:
+            if (gen!=self.gen):
+                return # late result of an old batch
+            self.feats.append(feat)
+            self.labels.append(lab)
+            self.perm.append(idx)
+            self.cow += 1
+            if(self.cow==self.tot): # last patch
+                # recover original order of images
+                sh = []
+                for (i,x) in enumerate(self.perm):
+                    sh.append([x,i])
+                sh = np.array(sorted(sh))[:,1]
+                # reorder data and conclude
+                feats = np.array(self.feats)[sh]
+                labels = np.array(self.labels)[sh]
+                self.bb = (Tensor(feats.transpose(0,3,1,2)), Tensor(labels))
+                self.finished_event.set()
+    def _write_slot(self, idx, feat, lab, gen):
+        # write image (yxc -> cyx) and label directly in slot idx, under
+        # lock, so that the buffers are not reused by the next batch
+        chw = (feat.shape[2], feat.shape[0], feat.shape[1])
+        with self.lock:
+            if (gen!=self.gen):
+                return # late result of an old batch
+            if (self.b_feats is None):
+                self._alloc_batch(chw)
+            if (chw!=self.chw):
+                raise ValueError(f'Patch shape {chw} differs from {self.chw}')
+            _write_patch(self.b_feats[idx], feat, self.norm)
+            self.b_labels[idx] = lab
+    def _submit_decode(self, raw_img, idx, lab, gen):
+        def done(res):
+            self._patch_done(gen)
+        def fail(exc):
+            self._fail(exc, gen)
+        with self.lock:
+            if (gen!=self.gen):
+                return # late result of an old batch
+            self.b_labels[idx] = lab
+            args = (raw_img, self.shm.name, self.b_feats.shape,
+                    self.b_feats.dtype.str, idx, self.dec_aug,
+                    self.decode_scale, self.norm)
+        self.dec_pool.apply_async(_decode_to_shm, args,
+                                  callback=done, error_callback=fail)
+    def _patch_done(self, gen):
+        with self.lock:
+            if (gen!=self.gen):
+                return # late result of an old batch
+            self.cow += 1
+            if(self.cow==self.tot): # last patch
+                # make the only copy of the buffers
+                if (self.out_uint8):
+                    self.bb = (self.b_feats.copy(), self.b_labels.copy())
+                else:
+                    self.bb = (Tensor(self.b_feats), Tensor(self.b_labels))
+                self.finished_event.set()
+    def handle_error(self, exc, gen):
+        # failed request: free its slot and fail the batch
+        with self.lock:
+            if (gen==self.gen):
                 self.onair -= 1
-                if(self.cow==self.tot): # last patch
-                    # recover original order of images
-                    sh = []
-                    for (i,x) in enumerate(self.perm):
-                        sh.append([x,i])
-                    sh = np.array(sorted(sh))[:,1]
-                    # reorder data and conclude
-                    feats = np.array(self.feats)[sh]
-                    labels = np.array(self.labels)[sh]
-                    self.bb = (Tensor(feats.transpose(0,3,1,2)), Tensor(labels))
-                    self.finished_event.set()
-        return fun
-    def handle_error(self, exc):
-        self.errors.append(exc)
-        self.finished_event.set()
+        self._fail(exc, gen)
+    def _fail(self, exc, gen):
+        # batch is failed, do not send the remaining queries
+        with self.lock:
+            if (gen!=self.gen):
+                return # late error of an old batch
+            self.pending.clear()
+            self.errors.append(exc)
+            self.finished_event.set()
     def block_get_batch(self):
         self.finished_event.wait() # wait for data to be ready
         if (len(self.errors)>0): # if errors raise exception
@@ -168,10 +675,140 @@ class BatchPatchHandler():
         return(self.bb)
 
 try: 
-    from BPH import BatchPatchHandler
+    from BPH import BatchPatchHandler, DriverOptions
+    from BPH import close_sessions as _close_cpp_sessions
+    _cpp_handler = True
 except ImportError:
     print('C++ BatchPatchHandler not found, using Python one.')
+    _cpp_handler = False
     
+def close_sessions():
+    """Shut down the Cassandra sessions no handler or list manager is using,
+    e.g., after closing a dataset that will not be replaced
+
+    :returns: 
+    :rtype: 
+
+    """
+    _close_py_sessions()
+    if (_cpp_handler):
+        _close_cpp_sessions()
+
+def _driver_options(opts):
+    # dict to C++ DriverOptions, unknown keys raise AttributeError
+    d = DriverOptions()
+    for k, v in opts.items():
+        setattr(d, k, v)
+    return d
+
+def _class_labels(num_classes):
+    # label values in the DB: bit masks when multi-label
+    if (num_classes<=_max_multilabs):
+        return [2**i for i in range(num_classes)]
+    return list(range(num_classes))
+
+def _group_columns(groups, labs, shuffle=False):
+    # columns from raw ids by sample and label, given as
+    # {sample_name: {label: bytes}}, in sample order
+    sample_names = list(groups.keys())
+    ids = []
+    counts = []
+    for sn in sample_names:
+        for l in labs:
+            raw = np.frombuffer(groups[sn][l], dtype=np.uint8)
+            raw = raw.reshape(-1, 16)
+            if (shuffle): # random order in sample bags
+                raw = raw[np.random.permutation(raw.shape[0])]
+            ids.append(raw)
+            counts.append(raw.shape[0])
+    if (ids):
+        ids = np.concatenate(ids)
+    else:
+        ids = np.empty((0, 16), dtype=np.uint8)
+    stats = np.array(counts, dtype=np.int64).reshape(-1, len(labs))
+    return (sample_names, ids, stats)
+
+def _dict_columns(rows, labs):
+    # columns from nested dicts of rows, as saved by previous versions
+    groups = {}
+    for sn, lab_rows in rows.items():
+        groups[sn] = {l: uuids_to_raw(lab_rows.get(l, [])).tobytes()
+                      for l in labs}
+    return _group_columns(groups, labs)
+
+# Rows and splits files: array files with the list manager settings in
+# the header, see array_file.py. Pickles of previous versions are still
+# read, convert_pickle() rewrites them.
+_rows_kind = 'cassandra_rows'
+_splits_kind = 'cassandra_splits'
+
+def _save_rows_file(filename, info, rows, partitions=None, counts=None,
+                    whitelist=None):
+    sample_names, ids, stats = rows
+    header = dict(info)
+    header['sample_names'] = [list(sn) for sn in sample_names]
+    header['partitions'] = None
+    header['sample_whitelist'] = None
+    arrays = {'ids': ids, 'stats': stats}
+    if (partitions is not None):
+        header['partitions'] = [list(p) for p in partitions]
+        # samples the partitions were restricted to, if any
+        if (whitelist is not None):
+            header['sample_whitelist'] = [list(sn) for sn in whitelist]
+        # rows per partition, for incremental updates
+        if (counts is not None):
+            arrays['partition_counts'] = counts
+    save_arrays(filename, _rows_kind, header, arrays)
+
+def _save_splits_file(filename, info, row_keys, split, labels=None,
+                      samples=None, sample_names=None):
+    header = dict(info)
+    header['num_splits'] = len(split)
+    header['sample_names'] = None
+    if (sample_names is not None):
+        header['sample_names'] = [list(sn) for sn in sample_names]
+    arrays = {'ids': row_keys}
+    for (sp, idx) in enumerate(split):
+        arrays[f'split_{sp}'] = np.asarray(idx, dtype=np.int64)
+    # class and sample codes per row, if known
+    if (labels is not None):
+        arrays['labels'] = labels
+    if (samples is not None):
+        arrays['samples'] = samples
+    save_arrays(filename, _splits_kind, header, arrays)
+
+def convert_pickle(src, dst):
+    """Convert a rows or splits pickle to the current file format
+
+    :param src: Pickle saved by save_rows or save_splits of previous versions
+    :param dst: Output filename
+    :returns: Kind of the converted file, 'rows' or 'splits'
+    :rtype: str
+
+    """
+    with open(src, "rb") as f:
+        stuff = pickle.load(f)
+    if (len(stuff)==7): # rows
+        (table, partition_cols, split_ncols, id_col,
+         num_classes, rows, metatable) = stuff
+        info = {'list_table': table, 'partition_cols': list(partition_cols),
+                'split_ncols': split_ncols, 'id_col': id_col,
+                'num_classes': num_classes, 'metatable': metatable}
+        if (isinstance(rows, dict)):
+            rows = _dict_columns(rows, _class_labels(num_classes))
+        _save_rows_file(dst, info, rows)
+        return 'rows'
+    (clm_table, partition_cols, split_ncols, id_col, num_classes,
+     table, label_col, data_col, row_keys, split, metatable) = stuff
+    info = {'list_table': clm_table, 'partition_cols': list(partition_cols),
+            'split_ncols': split_ncols, 'id_col': id_col,
+            'num_classes': num_classes, 'metatable': metatable,
+            'table': table, 'label_col': label_col, 'data_col': data_col}
+    if (row_keys.dtype==object):
+        row_keys = uuids_to_raw(row_keys)
+    _save_splits_file(dst, info, row_keys, split)
+    return 'splits'
+
 class CassandraListManager():
     def __init__(self, auth_prov, cassandra_ips, table,
                  partition_cols, id_col, split_ncols=1, num_classes=2,
@@ -192,22 +829,11 @@ class CassandraListManager():
         """
         random.seed(seed)
         np.random.seed(seed)
-        ## cassandra parameters
-        prof_dict = ExecutionProfile(
-            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
-            row_factory = cassandra.query.dict_factory)
-        prof_tuple = ExecutionProfile(
-            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
-            row_factory = cassandra.query.tuple_factory
-        )
-        profs = {'dict': prof_dict, 'tuple': prof_tuple}
-        self.cluster = Cluster(cassandra_ips,
-                               execution_profiles=profs,
-                               protocol_version=4,
-                               auth_provider=auth_prov,
-                               port=port)
-        self.cluster.connect_timeout = 10 #seconds
-        self.sess = self.cluster.connect()
+        ## cassandra parameters, session shared with the handlers
+        self.shared = get_session(cassandra_ips, port, auth_prov.username,
+                                  auth_prov.password)
+        self.cluster = self.shared.cluster
+        self.sess = self.shared.sess
         self.table = table
         # row variables
         self.partition_cols = partition_cols
@@ -215,50 +841,77 @@ class CassandraListManager():
         self.id_col = id_col
         self.seed = seed
         self.partitions = None
+        self.partition_counts = None # rows per partition, when read
+        self.sample_whitelist = None # samples read, None for all
         self.sample_names = None
-        self._rows = None
         self.num_classes = num_classes
         ## multi-label when num_classes is small
         self.multi_label = (num_classes<=_max_multilabs)
-        if (self.multi_label):
-            self.labs = [2**i for i in range(self.num_classes)]
-        else:
-            self.labs = list(range(self.num_classes))
+        self.labs = _class_labels(self.num_classes)
+        # columnar rows, grouped by sample and class
+        self.ids = None # (N,16) uint8 patch ids
+        self.sample_codes = None # index in sample_names, per row
+        self.label_codes = None # class index, per row
+        self._stats = None # rows per sample and class
+        self._starts = None # first row per sample and class
         # split variables
         self.row_keys = None
         self.max_patches = None
         self.n = None
         self.tot = None
+        self.row_index = None
         self._bags = None
+        self._bag_codes = None
         self._cow_rows = None
-        self._stats = None
-        self._rows = None
         self.balance = None
         self.split_ratios = None
         self.num_splits = None
     def __del__(self):
-        self.cluster.shutdown()
-    def read_rows_from_db(self, scan_par=1, sample_whitelist=None):
-        self.partitions = self.sess.execute(f"SELECT DISTINCT \
-        {', '.join(self.partition_cols)} FROM {self.table} ;",
-                                            execution_profile='tuple', timeout=90)
-        self.partitions = self.partitions.all()
+        self.close()
+    def close(self):
+        """Release the Cassandra session"""
+        if (self.shared is not None):
+            release_session(self.shared)
+            self.shared = None
+    def read_rows_from_db(self, scan_par=1, sample_whitelist=None,
+                          token_scan=False):
+        self.sample_whitelist = None
         if (sample_whitelist is not None):
-            parts = self.partitions
-            swl = sample_whitelist
-            self.partitions = [p for p in parts if p[:self.split_ncols] in swl]
+            self.sample_whitelist = [tuple(sn) for sn in sample_whitelist]
+        if (token_scan):
+            self._scan_token_ranges(scan_par, sample_whitelist)
+            return
+        self.partitions = self._whitelisted(self._list_partitions())
         self.sample_names = {name[:self.split_ncols] for name in self.partitions}
         self.sample_names = list(self.sample_names)
         random.shuffle(self.sample_names)
+        # raw ids, per sample and label
+        groups = {}
+        for sn in self.sample_names:
+            groups[sn] = {l: bytearray() for l in self.labs}
+        counts = self._read_partitions(self.partitions, scan_par, groups)
+        self.partition_counts = np.array([counts[p] for p in self.partitions],
+                                         dtype=np.int64)
+        self._set_columns(groups, shuffle=True)
+    def _whitelisted(self, partitions):
+        # partitions of the whitelisted samples, all if no whitelist
+        if (self.sample_whitelist is None):
+            return partitions
+        swl = set(self.sample_whitelist)
+        return [p for p in partitions if p[:self.split_ncols] in swl]
+    def _list_partitions(self):
+        res = self.sess.execute(f"SELECT DISTINCT \
+        {', '.join(self.partition_cols)} FROM {self.table} ;",
+                                execution_profile='tuple', timeout=90)
+        return [tuple(p) for p in res.all()]
+    def _read_partitions(self, partitions, scan_par, groups):
+        # append the ids of the partitions to the groups, returns the
+        # number of rows per partition
         query = f"SELECT {self.id_col} FROM {self.table} \
         WHERE {'=? AND '.join(self.partition_cols)}=? ;"
-        prep = self.sess.prepare(query)
-        self._rows = {}
-        for sn in self.sample_names:
-            self._rows[sn]={}
-            for l in self.labs:
-                self._rows[sn][l]=[]
-        loc_parts = self.partitions.copy()
+        prep = self.shared.prepare(query)
+        counts = {}
+        loc_parts = list(partitions)
         pbar = tqdm(desc='Scanning Cassandra partitions', total=len(loc_parts))
         futures = []
         # while there are partitions to be processed
@@ -266,41 +919,263 @@ class CassandraListManager():
             # fill the pool with samples
             while (len(loc_parts)>0 and len(futures)<scan_par):
                 part = loc_parts.pop()
-                l = part[-1] # label
-                sn = part[:self.split_ncols] # sample name
                 res = self.sess.execute_async(prep, part,
-                                              execution_profile='dict')
-                futures.append((sn, l, PagedResultHandler(res)))
+                                              execution_profile='tuple')
+                futures.append((part, PagedResultHandler(res)))
             # check if a query slot can be freed
             for future in futures:
-                sn, l, handler = future
+                part, handler = future
                 if(handler.finished_event.is_set()):
                     if handler.error:
                         raise handler.error
                     res = handler.all_rows
-                    self._rows[sn][l] += res
+                    l = part[-1] # label
+                    sn = part[:self.split_ncols] # sample name
+                    groups[sn][l] += b''.join(r[0].bytes for r in res)
+                    counts[part] = len(res)
                     futures.remove(future)
                     pbar.update(1)
                     pbar.set_postfix_str(f'added {len(res):5} patches')
             # sleep 1 ms
             time.sleep(.001)
         pbar.close()
-        # shuffle all ids in sample bags
-        for ks in self._rows.keys():
-            for lab in self._rows[ks]:
-                random.shuffle(self._rows[ks][lab])
-        # save some statistics
+        return counts
+    def _token_ranges(self, min_ranges):
+        # (start, end] ranges covering the Murmur3 ring, split at the ring
+        # tokens so that each one is owned by a single set of replicas
+        tmin, tmax = -2**63, 2**63-1
+        tm = self.cluster.metadata.token_map
+        ring = sorted({t.value for t in tm.ring}) if tm else []
+        bounds = [tmin] + [t for t in ring if tmin<t<tmax] + [tmax]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+        # replicas owning each range, by its end token: the keyspace is
+        # needed, since the session is shared and has none
+        ks = self.table.split('.')[0] if '.' in self.table else self.sess.keyspace
+        if (ks is None):
+            raise ValueError('Token scan needs a table name qualified by '
+                             f'its keyspace, e.g., ks.{self.table}')
+        ks = ks.strip('"')
+        if (tm and ks not in self.cluster.metadata.keyspaces):
+            raise ValueError(f'Keyspace {ks} not found')
+        hosts = []
+        for (a, b) in ranges:
+            reps = []
+            if (tm):
+                reps = [h for h in tm.get_replicas(ks, tm.token_class(b))
+                        if h.is_up]
+            hosts.append(reps)
+        # split large ranges to keep all the workers busy
+        parts = -(-min_ranges//len(ranges))
+        out = []
+        for (a, b), reps in zip(ranges, hosts):
+            step = max(1, (b-a)//parts)
+            cuts = list(range(a, b, step))[:parts] + [b]
+            for lo, hi in zip(cuts[:-1], cuts[1:]):
+                out.append(((lo, hi), reps))
+        random.shuffle(out) # spread the load over the nodes
+        return out
+    def _add_scanned(self, groups, parts, rows, swl):
+        # append a page of (partition cols..., id) rows to the groups
+        with self._scan_lock:
+            for row in rows:
+                part = tuple(row[:-1])
+                sn = part[:self.split_ncols] # sample name
+                if (swl is not None and sn not in swl):
+                    continue
+                if (sn not in groups):
+                    groups[sn] = {l: bytearray() for l in self.labs}
+                groups[sn][part[-1]] += row[-1].bytes
+                parts[part] = parts.get(part, 0) + 1
+    def _count_scanned(self, counts, rows):
+        # a page of (partition cols..., count) rows
+        with self._scan_lock:
+            for row in rows:
+                counts[tuple(row[:-1])] = row[-1]
+    def _scan_range(self, prep, rng, reps, consume):
+        host = random.choice(reps) if reps else None
+        res = self.sess.execute(prep, rng, execution_profile='tuple',
+                                timeout=90, host=host)
+        num = 0
+        # stream the pages into the lists
+        while True:
+            rows = res.current_rows
+            consume(rows)
+            num += len(rows)
+            if (not res.has_more_pages):
+                break
+            res.fetch_next_page()
+        return num
+    def _token_scan(self, query, consume, scan_par, desc):
+        # run query on all the token ranges, scan_par at a time, passing
+        # the pages of rows to consume
+        prep = self.shared.prepare(query)
+        self._scan_lock = threading.Lock()
+        ranges = self._token_ranges(4*scan_par)
+        pbar = tqdm(desc=desc, total=len(ranges))
+        with ThreadPoolExecutor(max_workers=scan_par) as ex:
+            futures = [ex.submit(self._scan_range, prep, rng, reps, consume)
+                       for rng, reps in ranges]
+            try:
+                for fut in as_completed(futures):
+                    pbar.update(1)
+                    pbar.set_postfix_str(f'added {fut.result():5} rows')
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+        pbar.close()
+    def _scan_token_ranges(self, scan_par, sample_whitelist):
+        # full scan by token ranges, without listing the partitions first
+        pk = ', '.join(self.partition_cols)
+        query = f"SELECT {pk}, {self.id_col} FROM {self.table} \
+        WHERE token({pk})>? AND token({pk})<=? ;"
+        swl = None
+        if (sample_whitelist is not None):
+            swl = {tuple(sn) for sn in sample_whitelist}
+        groups = {}
+        parts = {} # partition -> rows
+        consume = lambda rows: self._add_scanned(groups, parts, rows, swl)
+        self._token_scan(query, consume, scan_par,
+                         'Scanning Cassandra token ranges')
+        self.partitions = sorted(parts)
+        self.partition_counts = np.array([parts[p] for p in self.partitions],
+                                         dtype=np.int64)
+        # random order of samples
+        sample_names = list(groups.keys())
+        random.shuffle(sample_names)
+        groups = {sn: groups[sn] for sn in sample_names}
+        self._set_columns(groups, shuffle=True)
+    def _count_partitions(self, scan_par):
+        # rows per partition, counted by the DB
+        pk = ', '.join(self.partition_cols)
+        query = f"SELECT {pk}, COUNT(*) FROM {self.table} \
+        WHERE token({pk})>? AND token({pk})<=? GROUP BY {pk} ;"
+        counts = {}
+        consume = lambda rows: self._count_scanned(counts, rows)
+        self._token_scan(query, consume, scan_par,
+                         'Counting rows by token ranges')
+        return counts
+    def refresh_rows_from_db(self, scan_par=1, check_counts=False,
+                             drop_missing=False):
+        """Update the rows with the partitions added to the DB since they were read
+
+        Only the new partitions are read, appended to their sample and
+        class groups. Partitions whose row count changed (if
+        check_counts) or which are gone (if drop_missing) cause the
+        rebuild of their groups, reading the other partitions of the
+        group too. If the rows were read with a sample whitelist, only
+        the partitions of the whitelisted samples are considered.
+
+        :param scan_par: Parallel queries to Cassandra
+        :param check_counts: Also re-read partitions whose row count changed, counting the rows of all partitions by token ranges (default: False)
+        :param drop_missing: Drop the rows of partitions no longer in the DB, and the samples left without rows (default: False)
+        :returns: Number of new, changed and missing partitions
+        :rtype: tuple
+
+        """
+        if (self.partitions is None or self.partition_counts is None):
+            raise RuntimeError('Partitions of the current rows unknown, '
+                               'read_rows_from_db is needed')
+        known = dict(zip(self.partitions, self.partition_counts.tolist()))
+        # current partitions, with their row counts if requested
+        if (check_counts):
+            current = self._count_partitions(scan_par)
+        else:
+            current = dict.fromkeys(self._list_partitions())
+        # only the samples read in the first place
+        current = {p: current[p] for p in self._whitelisted(list(current))}
+        new = [p for p in current if p not in known]
+        changed = [p for p in current if p in known and
+                   current[p] is not None and current[p]!=known[p]]
+        gone = [p for p in known if p not in current]
+        print(f'Partitions: {len(new)} new, {len(changed)} changed, '
+              f'{len(gone)} missing')
+        group_of = lambda p: (p[:self.split_ncols], p[-1])
+        rebuild = {group_of(p) for p in changed}
+        if (drop_missing):
+            rebuild |= {group_of(p) for p in gone}
+        # new partitions and all the partitions of the rebuilt groups
+        to_read = new + [p for p in current
+                         if group_of(p) in rebuild and p in known]
+        # read the partitions in fresh groups
+        fresh = {}
+        for p in to_read:
+            fresh.setdefault(p[:self.split_ncols],
+                             {l: bytearray() for l in self.labs})
+        read = self._read_partitions(to_read, scan_par, fresh)
+        # merge, keeping the order of samples and rows not affected
+        alive = {p[:self.split_ncols] for p in current}
+        new_samples = [sn for sn in fresh if sn not in self.sample_names]
+        random.shuffle(new_samples)
+        groups = {}
+        for (s, sn) in enumerate(self.sample_names + new_samples):
+            if (drop_missing and sn not in alive):
+                continue
+            groups[sn] = {}
+            for (c, l) in enumerate(self.labs):
+                raw = np.empty((0, 16), dtype=np.uint8)
+                if (s<len(self.sample_names) and (sn, l) not in rebuild):
+                    a = self._starts[s, c]
+                    raw = self.ids[a:a+self._stats[s, c]]
+                add = sn in fresh and len(fresh[sn][l])>0
+                if (add):
+                    ids = np.frombuffer(fresh[sn][l], dtype=np.uint8)
+                    raw = np.concatenate([raw, ids.reshape(-1, 16)])
+                if (add or (sn, l) in rebuild): # random order in sample bags
+                    raw = raw[np.random.permutation(raw.shape[0])]
+                groups[sn][l] = raw
+        # update partitions and their row counts
+        if (drop_missing):
+            known = {p: c for (p, c) in known.items() if p in current}
+        known.update(read)
+        self.partitions = sorted(known)
+        self.partition_counts = np.array([known[p] for p in self.partitions],
+                                         dtype=np.int64)
+        self._set_columns(groups)
+        return (len(new), len(changed), len(gone))
+    def _set_columns(self, groups, shuffle=False):
+        cols = _group_columns(groups, self.labs, shuffle)
+        self.sample_names, self.ids, self._stats = cols
         self._after_rows()
     def _after_rows(self):
-        # set sample names
-        self.sample_names = list(self._rows.keys())
+        # row codes and group offsets, from the counters
+        stats = self._stats
+        num_samples = stats.shape[0]
+        starts = np.pad(stats.ravel().cumsum(), [1,0])[:-1]
+        self._starts = starts.reshape(stats.shape)
+        self.sample_codes = np.repeat(np.arange(num_samples, dtype=np.int32),
+                                      stats.sum(axis=1))
+        lab_codes = np.tile(np.arange(self.num_classes, dtype=np.int16),
+                            num_samples)
+        self.label_codes = np.repeat(lab_codes, stats.ravel())
         # set stats
-        counters = [[len(s[i]) for i in self.labs] for s in self._rows.values()]
-        self._stats = np.array(counters)
-        self.tot = self._stats.sum()
+        self.tot = stats.sum()
         print(f'Read list of {self.tot} patches')
+    def get_rows(self):
+        """Columnar rows, as (sample_names, ids, stats)
+
+        :returns: Sample names, (N,16) uint8 ids grouped by sample and class, rows per sample and class
+        :rtype: tuple
+
+        """
+        return (self.sample_names, self.ids, self._stats)
     def set_rows(self, rows):
-        self._rows = rows
+        """Set the rows, as returned by get_rows
+
+        Nested dicts of rows, {sample_name: {label: [row, ...]}}, as
+        saved by previous versions, are converted.
+
+        :param rows: Columnar rows or nested dicts
+        :returns:
+        :rtype:
+
+        """
+        if (isinstance(rows, dict)):
+            rows = _dict_columns(rows, self.labs)
+        sample_names, ids, stats = rows
+        self.sample_names = list(sample_names)
+        self.ids = ids
+        self._stats = np.asarray(stats)
         self._after_rows()
     def _update_target_params(self, max_patches=None,
                               split_ratios=None, balance=None):
@@ -356,26 +1231,25 @@ class CassandraListManager():
             curr += 1; curr %= self.num_splits
         # save bags
         self._bags = bags
-    def _enough_rows(self, sp, sample_num, lab):
-        """ Are there other rows available, given bag/sample/label?
+    def _enough_rows(self, sp, sample_num, cl):
+        """ Are there other rows available, given bag/sample/class?
 
         :param sp: split/bag
         :param sample_num: group number
-        :param lab: label
+        :param cl: class index
         :returns: 
         :rtype: 
 
         """
-        bag = self._bags[sp]
-        sample_name = bag[sample_num]
-        num = self._cow_rows[sample_name][lab]
+        code = self._bag_codes[sp][sample_num]
+        num = self._cow_rows[code, cl]
         return (num>0)
-    def _find_row(self, sp, sample_num, lab):
-        """ Returns a group/sample which contains a row with a given label
+    def _find_row(self, sp, sample_num, cl):
+        """ Returns a group/sample which contains a row with a given class
 
         :param sp: split/bag
         :param sample_num: starting group number
-        :param lab: required label
+        :param cl: required class index
         :returns: 
         :rtype: 
 
@@ -383,68 +1257,146 @@ class CassandraListManager():
         max_sample = len(self._bags[sp])
         cur_sample = sample_num
         inc = 0
-        while (inc<max_sample and not self._enough_rows(sp, cur_sample, lab)):
+        while (inc<max_sample and not self._enough_rows(sp, cur_sample, cl)):
             cur_sample +=1; cur_sample %= max_sample
             inc += 1
         if (inc>=max_sample): # row not found
             cur_sample = -1 
         return cur_sample
-    def _fill_splits(self):
-        """ Insert into the splits, taking into account the target class balance
+    def _class_quotas(self):
+        # patches per split and class, following split ratios and balance
+        borders = self.max_patches * self.split_ratios.cumsum()
+        borders = borders.round().astype(int)
+        borders = np.pad(borders, [1,0])
+        max_split = [borders[i+1]-borders[i] for i in range(self.num_splits)]
+        quotas = []
+        for sp in range(self.num_splits):
+            tmp = max_split[sp] * self.balance.cumsum()
+            tmp = tmp.round().astype(int)
+            tmp = np.pad(tmp, [1,0])
+            quotas.append([tmp[i+1]-tmp[i] for i in range(tmp.shape[0]-1)])
+        return quotas
+    def _init_cow_rows(self):
+        # init counter per each partition, bags by sample code
+        self._cow_rows = self._stats.copy()
+        codes = {sn: i for (i, sn) in enumerate(self.sample_names)}
+        self._bag_codes = [[codes[sn] for sn in bag] for bag in self._bags]
+    def _fill_splits_loop(self):
+        """ Insert into the splits, one patch at a time (reference implementation)
 
         :returns: 
         :rtype: 
 
         """
-        # init counter per each partition
-        self._cow_rows = {}
-        for sn in self._rows.keys():
-            self._cow_rows[sn]={}
-            for l in self._rows[sn].keys():
-                self._cow_rows[sn][l]=len(self._rows[sn][l])
-        borders = self.max_patches * self.split_ratios.cumsum()
-        borders = borders.round().astype(int)
-        borders = np.pad(borders, [1,0])
-        max_split = [borders[i+1]-borders[i] for i in range(self.num_splits)]
+        self._init_cow_rows()
+        quotas = self._class_quotas()
         sp_rows = []
         pbar = tqdm(desc='Choosing patches', total=self.max_patches)
         for sp in range(self.num_splits): # for each split
             sp_rows.append([])
-            bag = self._bags[sp]
+            bag = self._bag_codes[sp]
             max_sample = len(bag)
-            tmp = max_split[sp] * self.balance.cumsum()
-            tmp = tmp.round().astype(int)
-            tmp = np.pad(tmp, [1,0])
-            max_class = [tmp[i+1]-tmp[i] for i in range(tmp.shape[0]-1)]
+            max_class = quotas[sp]
             for cl in range(self.num_classes): # fill with each class
                 cur_sample = 0
                 tot = 0
                 while (tot<max_class[cl]):
-                    if (not self._enough_rows(sp, cur_sample, self.labs[cl])):
-                        cur_sample = self._find_row(sp, cur_sample, self.labs[cl])
+                    if (not self._enough_rows(sp, cur_sample, cl)):
+                        cur_sample = self._find_row(sp, cur_sample, cl)
                     if (cur_sample<0): # not found, skip to next class
                         break
-                    sample_name = bag[cur_sample]
-                    self._cow_rows[sample_name][self.labs[cl]] -= 1
-                    idx = self._cow_rows[sample_name][self.labs[cl]]
-                    row = self._rows[sample_name][self.labs[cl]][idx]
-                    sp_rows[sp].append(row)
+                    code = bag[cur_sample]
+                    self._cow_rows[code, cl] -= 1
+                    idx = self._starts[code, cl] + self._cow_rows[code, cl]
+                    sp_rows[sp].append(idx)
                     tot+=1
                     cur_sample +=1; cur_sample %= max_sample
                     pbar.update(1)
         pbar.close()
-        # build common sample list
+        self._set_splits([np.array(r, dtype=np.int64) for r in sp_rows])
+    @staticmethod
+    def _round_robin(avail, quota):
+        """Patches taken from each sample, picking one per sample in turn
+
+        Same outcome as cycling over the samples, skipping the empty
+        ones, until quota patches are taken: every sample gives
+        min(avail, level) patches and the first ones with more than
+        level give one more.
+
+        :param avail: Available patches per sample, in bag order
+        :param quota: Patches to be taken
+        :returns: Patches taken per sample
+        :rtype: numpy.ndarray
+
+        """
+        n = avail.shape[0]
+        if (quota>=avail.sum()):
+            return avail.copy()
+        # largest level whose full rounds fit in the quota
+        srt = np.sort(avail)
+        pre = np.pad(srt.cumsum(), [1,0])
+        full = pre[:-1] + srt*(n-np.arange(n)) # taken with level srt[i]
+        i = np.searchsorted(full, quota, side='right')
+        level = (quota-pre[i]) // (n-i)
+        take = np.minimum(avail, level)
+        # last, partial round
+        rest = quota - take.sum()
+        take[np.flatnonzero(avail>level)[:rest]] += 1
+        return take
+    def _fill_splits(self):
+        """ Insert into the splits, taking into account the target class balance
+
+        Each sample gives a contiguous slice of its (shuffled) rows of
+        each class, the same rows, in the same order, picked by
+        _fill_splits_loop.
+
+        :returns: 
+        :rtype: 
+
+        """
+        # repeated samples in a bag are visited more than once per round
+        if (any(len(set(b))<len(b) for b in self._bags)):
+            self._fill_splits_loop()
+            return
+        self._init_cow_rows()
+        quotas = self._class_quotas()
+        sp_rows = []
+        for sp in range(self.num_splits): # for each split
+            bag = np.array(self._bag_codes[sp], dtype=np.int64)
+            picked = []
+            for cl in range(self.num_classes): # fill with each class
+                if (bag.size==0):
+                    break
+                avail = self._cow_rows[bag, cl]
+                take = self._round_robin(avail, quotas[sp][cl])
+                self._cow_rows[bag, cl] -= take
+                # k-th patch of a sample taken at round k, from the end
+                pos = np.repeat(np.arange(bag.size), take)
+                rnd = np.arange(pos.size) - np.repeat(take.cumsum()-take, take)
+                order = np.lexsort((pos, rnd))
+                pos, rnd = pos[order], rnd[order]
+                last = self._starts[bag, cl] + avail - 1
+                picked.append(last[pos] - rnd)
+            if (picked):
+                picked = np.concatenate(picked)
+            else:
+                picked = np.empty(0, dtype=np.int64)
+            sp_rows.append(picked)
+        self._set_splits(sp_rows)
+    def _set_splits(self, sp_rows):
+        # build common sample list, from the chosen rows of each split
         self.split = []
-        self.row_keys = []
+        sel = []
         start = 0
         for sp in range(self.num_splits):
-            self.split.append(None)
-            sz = len(sp_rows[sp])
-            random.shuffle(sp_rows[sp])
-            self.row_keys += sp_rows[sp]
-            self.split[sp] = np.arange(start, start+sz)
-            start += sz
-        self.row_keys = np.array(self.row_keys)
+            rows = sp_rows[sp].tolist()
+            # random, not np.random: same order as before for a given seed
+            random.shuffle(rows)
+            sel += rows
+            self.split.append(np.arange(start, start+len(rows)))
+            start += len(rows)
+        self.row_index = np.array(sel, dtype=np.int64) # rows in self.ids
+        self.row_keys = self.ids[self.row_index]
         self.n = self.row_keys.shape[0] # set size
     def split_setup(self, max_patches=None, split_ratios=None,
                     balance=None, seed=None, bags=None):
@@ -476,12 +1428,35 @@ class CassandraListManager():
 
 ## ecvl reader for Cassandra
 class CassandraDataset():
-    def __init__(self, auth_prov, cassandra_ips, port=9042, seed=None):
+    def __init__(self, auth_prov, cassandra_ips, port=9042, seed=None,
+                 prefetch_depth=1, decode_scale=1, norm_scale=1,
+                 norm_mean=None, norm_std=None, out_uint8=False,
+                 cache_dir=None, cache_bytes=10*2**30, decode_workers=0,
+                 mem_cache_splits=[], mem_cache_bytes=4*2**30,
+                 multi_get=1, hedge_pct=None, max_inflight=64,
+                 ring_size=0, driver_opts=None, inflight_bounds=None):
         """Create ECVL Dataset from Cassandra DB
 
         :param auth_prov: Authenticator for Cassandra
         :param cassandra_ips: List of Cassandra ip's
-        :param seed: Seed for random generators
+        :param seed: Seed for random generators; with the C++ handler, it also seeds the augmentations, which are then applied one patch at a time: reproducible and race-free, but not in parallel
+        :param prefetch_depth: Number of batches per split to be kept in flight, queued in one handler with the C++ loader (default: 1)
+        :param decode_scale: Decode patches at reduced size: 1, 1/2, 1/4 or 1/8 (default: 1)
+        :param norm_scale: Scale factor applied to the pixels while filling the batch, e.g., 1/255 (default: 1)
+        :param norm_mean: Per-channel (BGR) mean subtracted after scaling (default: None)
+        :param norm_std: Per-channel (BGR) std dividing after mean subtraction (default: None)
+        :param out_uint8: Return features as NCHW uint8 numpy arrays and labels as numpy arrays, no normalization allowed (default: False)
+        :param cache_dir: Local directory caching the patch blobs, shared among processes (default: None, no cache)
+        :param cache_bytes: Size budget of the local cache (default: 10 GiB)
+        :param decode_workers: Processes decoding the patches, in one pool shared by all the batch handlers, 0 to decode in the driver threads; workers are started by a fork server, so the main script needs the __main__ guard; only augmentations given as text (AugmentationFactory syntax) work, ECVL augmentation objects raise ValueError (Python handler only, default: 0)
+        :param mem_cache_splits: Splits whose decoded patches are kept in memory after the first epoch, ignored if the split has augmentations (default: [])
+        :param mem_cache_bytes: Memory budget of the decoded patches, summed over the cached splits (default: 4 GiB)
+        :param multi_get: Max patches per request, grouped by owning replica; 1 sends one query per patch (default: 1)
+        :param hedge_pct: Requests slower than this percentile of recent latencies (e.g., 95) are duplicated, first answer wins; the Python handler sends the duplicate to another replica, the C++ one lets the driver's token-aware policy pick it (default: None, no hedging)
+        :param max_inflight: Requests in flight for each batch handler, independent of the decoding threads (C++ handler only, default: 64)
+        :param ring_size: Preallocated batch buffers per batch handler, shaped as the first batch; a buffer is reused only after every Python reference to the returned tensors or arrays is dropped, so keep at most ring_size batches alive to avoid new allocations (C++ handler only, default: 0, no reuse)
+        :param inflight_bounds: (min, max) requests in flight for each batch handler, adapted between the bounds from latencies and errors (AIMD) instead of fixed (default: None, fixed)
+        :param driver_opts: Cassandra driver tuning, as dict with keys io_threads, connections_per_host, queue_size_io, token_aware, latency_aware, speculative_delay_ms (negative: disabled) and speculative_max (C++ handler only, default: None, driver defaults)
         :returns: 
         :rtype: 
 
@@ -507,12 +1482,38 @@ class CassandraDataset():
         self.num_classes = None
         self.prep = None
         ## internal parameters
-        self.row_keys = None
+        self.row_keys = None # (N,16) uint8 patch ids, indexed by splits
+        self.row_labels = None # class index per row, if known
+        self.row_samples = None # index in sample_names per row, if known
+        self.sample_names = None
         self.augs = None
         self.batch_size = None
+        self.prefetch_depth = prefetch_depth
+        self.decode_scale = decode_scale
+        self.norm_scale = norm_scale
+        self.norm_mean = norm_mean
+        self.norm_std = norm_std
+        self.out_uint8 = out_uint8
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_bytes
+        self.decode_workers = decode_workers
+        self._dec_pool = None # decoding processes, shared by the handlers
+        self.mem_cache_splits = mem_cache_splits
+        self.mem_cache_bytes = mem_cache_bytes
+        self.multi_get = multi_get
+        self.hedge_pct = hedge_pct
+        self.max_inflight = max_inflight
+        self.ring_size = ring_size
+        self.driver_opts = driver_opts
+        self.inflight_bounds = inflight_bounds
+        self._mem = {} # per split, in-memory cache of decoded patches
         self.current_split = 0
         self.current_index = []
-        self.batch_handler = []
+        self.batch_handler = [] # per split, ring of prefetch_depth handler slots
+        self._ring_head = [] # per split, handler with the oldest batch
+        self._ring_onair = [] # per split, number of batches in flight
+        self._ring_rows = [] # per split, (rows, from_db) of each ring slot
+        self._cpp_augs = [] # per split, ECVL augmentation of the C++ handler
         self.num_batches = []
         self.locks = None
         self.n = None
@@ -520,7 +1521,22 @@ class CassandraDataset():
         self.num_splits = None
         self._clm = None # Cassandra list manager
     def __del__(self):
-        self._ignore_batches()
+        self.close()
+    def close(self):
+        """Stop the batch handlers and the decoding processes, and release
+        the Cassandra sessions. Sessions stay open, to be reused by other
+        datasets, until close_sessions is called.
+
+        :returns: 
+        :rtype: 
+
+        """
+        self._close_handlers()
+        if (self._dec_pool is not None):
+            self._dec_pool.terminate()
+            self._dec_pool = None
+        if (self._clm is not None):
+            self._clm.close()
     def init_listmanager(self, table, partition_cols, id_col,
                          split_ncols=1, num_classes=2, metatable=None):
         """Initialize the Cassandra list manager.
@@ -541,6 +1557,8 @@ class CassandraDataset():
         self.id_col = id_col
         self.num_classes = num_classes
         self.metatable = metatable
+        if (self._clm is not None):
+            self._clm.close()
         self._clm = CassandraListManager(auth_prov=self.auth_prov,
                                          cassandra_ips=self.cassandra_ips,
                                          port=self.port,
@@ -566,6 +1584,22 @@ class CassandraDataset():
         # if splits are set up, then recreate batch handlers
         if (gen_handlers):
             self._reset_indexes()
+    def _list_info(self):
+        # list manager settings, as saved in the files
+        clm = self._clm
+        return {'list_table': clm.table,
+                'partition_cols': list(clm.partition_cols),
+                'split_ncols': clm.split_ncols, 'id_col': self.id_col,
+                'num_classes': self.num_classes, 'metatable': self.metatable}
+    def _init_from_info(self, info):
+        self.id_col = info['id_col']
+        self.num_classes = info['num_classes']
+        self.init_listmanager(table=info['list_table'],
+                              metatable=info['metatable'],
+                              partition_cols=info['partition_cols'],
+                              split_ncols=info['split_ncols'],
+                              id_col=self.id_col,
+                              num_classes=self.num_classes)
     def save_rows(self, filename):
         """Save full list of DB rows to file
 
@@ -574,21 +1608,32 @@ class CassandraDataset():
         :rtype: 
 
         """
-        stuff = (self._clm.table, self._clm.partition_cols,
-                 self._clm.split_ncols, self.id_col, self.num_classes,
-                 self._clm._rows, self.metatable)
-
-        with open(filename, "wb") as f:
-            pickle.dump(stuff, f)
+        _save_rows_file(filename, self._list_info(), self._clm.get_rows(),
+                        self._clm.partitions, self._clm.partition_counts,
+                        self._clm.sample_whitelist)
     def load_rows(self, filename):
         """Load full list of DB rows from file
 
+        Pickles saved by previous versions are also read.
+
         :param filename: Local filename, as string
         :returns: 
         :rtype: 
 
         """
         print('Loading rows...')
+        if (is_array_file(filename)):
+            header, arrays = load_arrays(filename, _rows_kind)
+            self._init_from_info(header)
+            names = [tuple(sn) for sn in header['sample_names']]
+            self._clm.set_rows((names, arrays['ids'], arrays['stats']))
+            if (header['partitions'] is not None):
+                self._clm.partitions = [tuple(p) for p in header['partitions']]
+                self._clm.partition_counts = arrays.get('partition_counts')
+                swl = header.get('sample_whitelist') # newer files only
+                if (swl is not None):
+                    self._clm.sample_whitelist = [tuple(sn) for sn in swl]
+            return
         with open(filename, "rb") as f:
             stuff = pickle.load(f)
 
@@ -600,15 +1645,36 @@ class CassandraDataset():
                               split_ncols=clm_split_ncols, id_col=self.id_col,
                               num_classes=self.num_classes)
         self._clm.set_rows(clm_rows)
-    def read_rows_from_db(self, scan_par=1, sample_whitelist=None):
+    def read_rows_from_db(self, scan_par=1, sample_whitelist=None,
+                          token_scan=False):
         """Read the full list of rows from the DB.
 
         :param scan_par: Increase parallelism while scanning Cassandra partitions. It can lead to DB overloading.
+        :param sample_whitelist: If not None, only read the listed samples
+        :param token_scan: Scan the table by token ranges, aligned with the replicas, with scan_par parallel workers, instead of listing the partitions and reading them one by one; the table name must be qualified by its keyspace (default: False)
         :returns: 
         :rtype:
 
         """
-        self._clm.read_rows_from_db(scan_par, sample_whitelist)
+        self._clm.read_rows_from_db(scan_par, sample_whitelist, token_scan)
+    def refresh_rows_from_db(self, scan_par=1, check_counts=False,
+                             drop_missing=False):
+        """Update the rows with the partitions added to the DB since they were read.
+
+        The rows must come from read_rows_from_db, or from a file saved
+        afterwards: their partitions and row counts are used to read only
+        the new (or changed) ones. The sample whitelist given when
+        reading, if any, still applies.
+
+        :param scan_par: Parallel queries to Cassandra
+        :param check_counts: Also re-read partitions whose row count changed, counting the rows of all partitions by token ranges (default: False)
+        :param drop_missing: Drop the rows of partitions no longer in the DB, and the samples left without rows (default: False)
+        :returns: Number of new, changed and missing partitions
+        :rtype: tuple
+
+        """
+        return self._clm.refresh_rows_from_db(scan_par, check_counts,
+                                              drop_missing)
     def save_splits(self, filename):
         """Save list of split ids.
 
@@ -617,36 +1683,65 @@ class CassandraDataset():
         :rtype: 
 
         """
-        stuff = (self._clm.table, self._clm.partition_cols,
-                 self._clm.split_ncols, self.id_col, self.num_classes,
-                 self.table, self.label_col, self.data_col,
-                 self.row_keys, self.split, self.metatable)
-        with open(filename, "wb") as f:
-            pickle.dump(stuff, f)
-    def load_splits(self, filename, batch_size=None, augs=None):
+        info = self._list_info()
+        info.update(table=self.table, label_col=self.label_col,
+                    data_col=self.data_col)
+        _save_splits_file(filename, info, self.row_keys, self.split,
+                          labels=self.row_labels, samples=self.row_samples,
+                          sample_names=self.sample_names)
+    def load_splits(self, filename, batch_size=None, augs=None,
+                    prefetch_depth=None):
         """Load list of split ids and optionally set batch_size and augmentations.
 
+        Ids and split indexes are mapped read-only from the file, in
+        constant time, and shared among the processes loading it.
+        Pickles saved by previous versions are also read.
+
         :param filename: Local filename, as string
         :param batch_size: Dataset batch size
         :param augs: Data augmentations to be used. If None use the current ones.
+        :param prefetch_depth: Batches per split kept in flight. If None use the current value.
         :returns: 
         :rtype: 
 
         """
         print('Loading splits...')
-        with open(filename, "rb") as f:
-            stuff = pickle.load(f)
+        if (is_array_file(filename)):
+            header, arrays = load_arrays(filename, _splits_kind)
+            self._init_from_info(header)
+            table = header['table']
+            label_col = header['label_col']
+            data_col = header['data_col']
+            self.row_keys = arrays['ids']
+            split = [arrays[f'split_{sp}']
+                     for sp in range(header['num_splits'])]
+            self.row_labels = arrays.get('labels')
+            self.row_samples = arrays.get('samples')
+            self.sample_names = None
+            if (header['sample_names'] is not None):
+                self.sample_names = [tuple(sn)
+                                     for sn in header['sample_names']]
+        else:
+            with open(filename, "rb") as f:
+                stuff = pickle.load(f)
 
-        (clm_table, clm_partition_cols,
-         clm_split_ncols, self.id_col, self.num_classes,
-         table, label_col, data_col,
-         self.row_keys, split, metatable) = stuff
+            (clm_table, clm_partition_cols,
+             clm_split_ncols, self.id_col, self.num_classes,
+             table, label_col, data_col,
+             row_keys, split, metatable) = stuff
+            # rows as dicts, saved by previous versions
+            if (row_keys.dtype==object):
+                row_keys = uuids_to_raw(row_keys)
+            self.row_keys = row_keys
+            self.row_labels = None
+            self.row_samples = None
+            self.sample_names = None
 
-        # recreate listmanager
-        self.init_listmanager(table=clm_table, metatable=metatable,
-                              partition_cols=clm_partition_cols,
-                              split_ncols=clm_split_ncols, id_col=self.id_col,
-                              num_classes=self.num_classes)
+            # recreate listmanager
+            self.init_listmanager(table=clm_table, metatable=metatable,
+                                  partition_cols=clm_partition_cols,
+                                  split_ncols=clm_split_ncols, id_col=self.id_col,
+                                  num_classes=self.num_classes)
         # init data table
         self.init_datatable(table=table, label_col=label_col, data_col=data_col, gen_handlers=False)
         # reload splits
@@ -654,14 +1749,20 @@ class CassandraDataset():
         self.n = self.row_keys.shape[0] # set size
         num_splits = len(self.split)
         self._update_split_params(num_splits=num_splits, augs=augs,
-                                  batch_size=batch_size)
+                                  batch_size=batch_size,
+                                  prefetch_depth=prefetch_depth)
         self._reset_indexes()
-    def _update_split_params(self, num_splits, augs=None, batch_size=None):
+    def _update_split_params(self, num_splits, augs=None, batch_size=None,
+                             prefetch_depth=None):
         # update batch_size, default: 8
         if (batch_size is not None):
             self.batch_size = batch_size
         if (self.batch_size is None):
             self.batch_size = 8
+        # update prefetch depth
+        if (prefetch_depth is not None):
+            self.prefetch_depth = prefetch_depth
+        assert(self.prefetch_depth>0)
         # update augmentations, default: []
         if (augs is not None):
             self.augs=augs
@@ -671,7 +1772,8 @@ class CassandraDataset():
         # create a lock per split
         self.locks=[threading.Lock() for i in range(self.num_splits)]
     def split_setup(self, max_patches=None, split_ratios=None, augs=None,
-                    balance=None, batch_size=None, seed=None, bags=None):
+                    balance=None, batch_size=None, seed=None, bags=None,
+                    prefetch_depth=None):
         """(Re)Insert the patches in the splits, according to split and class ratios
 
         :param max_patches: Number of patches to be read. If None use the current value.
@@ -680,6 +1782,7 @@ class CassandraDataset():
         :param balance: Ratio among the different classes. If None use the current value.
         :param batch_size: Batch size. If None use the current value.
         :param seed: Seed for random generators
+        :param prefetch_depth: Batches per split kept in flight. If None use the current value.
         :returns: 
         :rtype: 
 
@@ -688,30 +1791,43 @@ class CassandraDataset():
                               split_ratios=split_ratios,
                               balance=balance, seed=seed, bags=bags)
         self.row_keys = self._clm.row_keys
+        self.row_labels = self._clm.label_codes[self._clm.row_index]
+        self.row_samples = self._clm.sample_codes[self._clm.row_index]
+        self.sample_names = self._clm.sample_names
         self.split = self._clm.split
         self.n = self._clm.n
         num_splits = self._clm.num_splits
         self._update_split_params(num_splits=num_splits, augs=augs,
-                                  batch_size=batch_size)
+                                  batch_size=batch_size,
+                                  prefetch_depth=prefetch_depth)
         self._reset_indexes()
     def _ignore_batch(self, cs):
-        if (self.current_index[cs]>self.split[cs].shape[0]):
-            return # end of split, nothing to wait for
-        # wait for (and ignore) batch
-        self._compute_batch(cs)
+        # wait for (and ignore) all the batches in flight
+        while (self._ring_onair[cs]>0):
+            try:
+                self._compute_batch(cs)
+            except:
+                pass
     def _ignore_batches(self):
          # wait for handlers to finish, if running
-        if (self.batch_handler):
-            for cs in range(self.num_splits):
-                try:
-                    self._ignore_batch(cs)
-                except:
-                    pass
-    def _reset_indexes(self):
+        for cs in range(len(self.batch_handler)):
+            self._ignore_batch(cs)
+    def _close_handlers(self):
+        # wait for the batches in flight, then free the handlers and
+        # their sessions (C++ handlers free them when destroyed)
         self._ignore_batches()
-                            
-        self.current_index = []
+        if (not _cpp_handler):
+            for ring in self.batch_handler:
+                for handler in ring:
+                    handler.close()
         self.batch_handler = []
+    def _reset_indexes(self):
+        self._close_handlers()
+        self.current_index = []
+        self._ring_head = []
+        self._ring_onair = []
+        self._ring_rows = []
+        self._cpp_augs = []
         self.num_batches = []
         for cs in range(self.num_splits):
             self.current_index.append(0)
@@ -720,21 +1836,118 @@ class CassandraDataset():
                 aug = self.augs[cs]
             else:
                 aug = None
+            # cached splits get raw uint8 patches, normalized on output
+            mem = self._setup_mem_cache(cs, aug)
+            hopts = {'norm_scale': self.norm_scale,
+                     'norm_mean': self.norm_mean,
+                     'norm_std': self.norm_std,
+                     'out_uint8': self.out_uint8}
+            if (mem):
+                hopts = {'out_uint8': True}
             ap = self.auth_prov
-            handler = BatchPatchHandler(num_classes=self.num_classes,
-                                        label_col=self.label_col,
-                                        data_col=self.data_col,
-                                        id_col=self.id_col,
-                                        table=self.table, aug=aug,
-                                        username=ap.username,
-                                        cass_pass=ap.password,
-                                        cassandra_ips=self.cassandra_ips,
-                                        port=self.port)
-            self.batch_handler.append(handler)
+            # options available only in the Python or C++ handler
+            # the C++ handler queues prefetch_depth batches by itself:
+            # one handler (and session) per split, shared by all the
+            # ring slots, since batches are retrieved in FIFO order
+            py_opts = {}
+            num_handlers = self.prefetch_depth
+            if (not _cpp_handler):
+                if (self.decode_workers>0 and self._dec_pool is None):
+                    self._dec_pool = decode_pool(self.decode_workers,
+                                                 random.getrandbits(32))
+                py_opts['dec_pool'] = self._dec_pool
+            else:
+                py_opts['max_inflight'] = self.max_inflight
+                py_opts['ring_size'] = self.ring_size
+                py_opts['queue_depth'] = self.prefetch_depth
+                # reproducible augmentations, serialized in the handler
+                py_opts['aug_seed'] = random.getrandbits(32)
+                aug = _make_aug(aug) # ECVL object, not text
+                # the handler keeps a bare pointer to it
+                self._cpp_augs.append(aug)
+                if (self.driver_opts):
+                    py_opts['driver_opts'] = _driver_options(self.driver_opts)
+                num_handlers = 1
+            handlers = []
+            for i in range(num_handlers):
+                handler = BatchPatchHandler(num_classes=self.num_classes,
+                                            label_col=self.label_col,
+                                            data_col=self.data_col,
+                                            id_col=self.id_col,
+                                            table=self.table, aug=aug,
+                                            username=ap.username,
+                                            cass_pass=ap.password,
+                                            cassandra_ips=self.cassandra_ips,
+                                            port=self.port,
+                                            decode_scale=self.decode_scale,
+                                            cache_dir=self.cache_dir,
+                                            cache_bytes=self.cache_bytes,
+                                            multi_get=self.multi_get,
+                                            hedge_pct=self.hedge_pct,
+                                            inflight_bounds=self.inflight_bounds,
+                                            **hopts, **py_opts)
+                handlers.append(handler)
+            handlers *= self.prefetch_depth // num_handlers
+            self.batch_handler.append(handlers)
+            self._ring_head.append(0)
+            self._ring_onair.append(0)
+            self._ring_rows.append([None]*self.prefetch_depth)
             self.num_batches.append((self.split[cs].shape[0]+self.batch_size-1)
                                     // self.batch_size)
             # preload batches
-            self._preload_batch(cs)
+            self._preload_batches(cs)
+    def _setup_mem_cache(self, cs, aug):
+        # drop stale cache, keep it if the split still has the same rows
+        rows = np.sort(self.split[cs])
+        old = self._mem.pop(cs, None)
+        if (cs not in self.mem_cache_splits or aug is not None):
+            return False
+        if (old is not None and np.array_equal(old['rows'], rows)):
+            self._mem[cs] = old
+        else:
+            # patch arrays are allocated with the first batch
+            self._mem[cs] = {'rows': rows, 'feats': None, 'labs': None,
+                             'filled': np.zeros(rows.size, dtype=bool),
+                             'count': 0, 'disabled': False}
+        return True
+    def _mem_full(self, cs):
+        mem = self._mem.get(cs)
+        return (mem is not None and mem['count']==mem['rows'].size)
+    def _mem_store(self, cs, idx_ar, feats, labs):
+        mem = self._mem[cs]
+        if (mem['disabled']):
+            return
+        if (mem['feats'] is None):
+            # check memory budget
+            need = mem['rows'].size * (feats[0].nbytes + labs[0].nbytes)
+            used = sum(m['feats'].nbytes + m['labs'].nbytes
+                       for m in self._mem.values() if m['feats'] is not None)
+            if (used + need > self.mem_cache_bytes):
+                print(f'Split {cs} needs {need/2**20:.0f} MiB, '
+                      'over memory cache budget: not caching it')
+                mem['disabled'] = True
+                return
+            n = mem['rows'].size
+            mem['feats'] = np.empty((n,) + feats.shape[1:], dtype=np.uint8)
+            mem['labs'] = np.empty((n,) + labs.shape[1:], dtype=labs.dtype)
+        slots = np.searchsorted(mem['rows'], idx_ar)
+        mem['feats'][slots] = feats
+        mem['labs'][slots] = labs
+        mem['count'] += np.count_nonzero(~mem['filled'][slots])
+        mem['filled'][slots] = True
+    def _mem_output(self, feats, labs):
+        # normalize uint8 patches as the handlers would do
+        if (self.out_uint8):
+            return (feats, labs)
+        x = np.empty(feats.shape, dtype=np.float32)
+        norm = _norm_params(self.norm_scale, self.norm_mean, self.norm_std)
+        if (norm is None):
+            x[...] = feats
+        else:
+            ch_scale, ch_off = norm
+            np.multiply(feats, ch_scale, out=x)
+            x += ch_off
+        return (Tensor(x), Tensor(labs))
     def set_batchsize(self, bs):
         """Change dataset batch size
 
@@ -759,6 +1972,57 @@ class CassandraDataset():
         if (self.augs is None):
             self.augs=[]
         self._reset_indexes()
+    def _handlers(self):
+        # distinct handlers, ring slots may share one
+        seen = set()
+        for ring in self.batch_handler:
+            for handler in ring:
+                if (id(handler) not in seen):
+                    seen.add(id(handler))
+                    yield handler
+    def cache_stats(self):
+        """Counters of the local blob cache, summed over the current handlers
+
+        :returns: Dictionary with hits, misses and evictions
+        :rtype: dict
+
+        """
+        tot = {}
+        for handler in self._handlers():
+            for k, v in handler.cache_stats().items():
+                tot[k] = tot.get(k, 0) + v
+        return tot
+    def hedge_stats(self):
+        """Counters of hedged requests, summed over the current handlers
+
+        :returns: Dictionary with requests, hedged, hedge_wins and the largest current threshold_us
+        :rtype: dict
+
+        """
+        tot = {}
+        for handler in self._handlers():
+            for k, v in handler.hedge_stats().items():
+                if (k=='threshold_us'):
+                    tot[k] = max(tot.get(k, -1), v)
+                else:
+                    tot[k] = tot.get(k, 0) + v
+        return tot
+    def inflight_limits(self):
+        """Current limits of requests in flight
+
+        :returns: Per split, the limits of its handlers
+        :rtype: list
+
+        """
+        lims = []
+        for ring in self.batch_handler:
+            seen = set()
+            lims.append([])
+            for handler in ring:
+                if (id(handler) not in seen):
+                    seen.add(id(handler))
+                    lims[-1].append(handler.inflight_limit())
+        return lims
     def rewind_splits(self, chosen_split=None, shuffle=False):
         """Rewind/reshuffle rows in chosen split and reset its current index
 
@@ -768,39 +2032,70 @@ class CassandraDataset():
         :rtype: 
 
         """
-        self._ignore_batches()
         if (chosen_split is None):
             splits = range(self.num_splits)
         else:
             splits = [chosen_split]
         for cs in splits:
             with self.locks[cs]:
+                # drop the batches in flight of this split only, since
+                # only its batches are preloaded again
+                self._ignore_batch(cs)
                 if (shuffle):
                     self.split[cs] = np.random.permutation(self.split[cs])
-                # reset index and preload batch
+                # reset index and preload batches
                 self.current_index[cs] = 0
-                self._preload_batch(cs)
-    def _save_futures(self, rows, cs):
+                self._preload_batches(cs)
+    def _save_futures(self, rows, cs, pos):
         # choose augmentation
         aug = None
         if (len(self.augs)>cs and self.augs[cs] is not None):
             aug = self.augs[cs]
         # get and convert whole batch asynchronously
-        handler = self.batch_handler[cs]
-        keys_ = [list(row.values())[0] for row in rows]
-        handler.schedule_batch(keys_)
+        handler = self.batch_handler[cs][pos]
+        handler.schedule_batch(rows)
     def _compute_batch(self, cs):
-        hand = self.batch_handler[cs]
-        return(hand.block_get_batch())
+        if (self._ring_onair[cs]==0):
+            raise RuntimeError(f'No more batches in split {cs}')
+        # get oldest batch in flight
+        ring = self.batch_handler[cs]
+        head = self._ring_head[cs]
+        self._ring_head[cs] = (head+1) % len(ring)
+        self._ring_onair[cs] -= 1
+        if (cs not in self._mem):
+            return(ring[head].block_get_batch())
+        idx_ar, from_db = self._ring_rows[cs][head]
+        if (from_db):
+            feats, labs = ring[head].block_get_batch()
+            self._mem_store(cs, idx_ar, feats, labs)
+        else:
+            # pure memory gather
+            mem = self._mem[cs]
+            slots = np.searchsorted(mem['rows'], idx_ar)
+            feats, labs = mem['feats'][slots], mem['labs'][slots]
+        return(self._mem_output(feats, labs))
     def _preload_batch(self, cs):
         if (self.current_index[cs]>=self.split[cs].shape[0]):
-            self.current_index[cs]+=1 # register overflow
-            return # end of split, stop prealoding
+            return False # end of split, stop prealoding
+        ring = self.batch_handler[cs]
+        if (self._ring_onair[cs]>=len(ring)):
+            return False # all handlers busy
         idx_ar = self.split[cs][self.current_index[cs] :
                                 self.current_index[cs] + self.batch_size]
         self.current_index[cs] += idx_ar.size #increment index
-        bb = self.row_keys[idx_ar]
-        self._save_futures(bb, cs)
+        # schedule on first free handler after the busy ones
+        pos = (self._ring_head[cs] + self._ring_onair[cs]) % len(ring)
+        from_db = not self._mem_full(cs)
+        if (from_db):
+            bb = self.row_keys[idx_ar]
+            self._save_futures(bb, cs, pos)
+        self._ring_rows[cs][pos] = (idx_ar, from_db)
+        self._ring_onair[cs] += 1
+        return True
+    def _preload_batches(self, cs):
+        # keep up to prefetch_depth batches in flight
+        while (self._preload_batch(cs)):
+            pass
     def load_batch(self, split=None):
         """Read a batch from Cassandra DB.
 
@@ -817,7 +2112,7 @@ class CassandraDataset():
             # compute batch from preloaded raw data
             batch = self._compute_batch(cs)
             # start preloading the next batch
-            self._preload_batch(cs)
+            self._preload_batches(cs)
         return(batch)
     def load_batch_cross(self, not_splits=[]):
         """Load batch from random split, excluding some (def: [current_split])
@@ -835,9 +2130,7 @@ class CassandraDataset():
         else:
             ns = not_splits
         # choose current split among the remaining ones
-        ends = np.array([sp.shape[0] for sp in self.split])
-        curr = np.array(self.current_index)
-        ok = curr<=ends # valid splits
+        ok = np.array(self._ring_onair)>0 # valid splits
         for sp in ns: # disable splits in ns
             ok[sp] = False
         sp_list = np.array(range(self.num_splits))
@@ -49,13 +49,19 @@ def main(args):
         if Path(args.db_rows_fn).exists():
             # If rows file exists load them from file 
             cd.load_rows(args.db_rows_fn)
+            if args.refresh_rows:
+                # add the partitions written since, and update the file
+                cd.refresh_rows_from_db(scan_par=args.scan_par,
+                                        check_counts=args.check_counts,
+                                        drop_missing=args.drop_missing)
+                cd.save_rows(args.db_rows_fn)
         else:
             # If rows do not exist, read them from db and save to a pickle
-            cd.read_rows_from_db()
+            cd.read_rows_from_db(scan_par=args.scan_par, token_scan=args.token_scan)
             cd.save_rows(os.path.join(args.out_dir, '%s.pckl' % args.db_rows_fn))
     else:
         # If a db_rows_fn is not specified just read them from db
-        cd.read_rows_from_db()
+        cd.read_rows_from_db(scan_par=args.scan_par, token_scan=args.token_scan)
     
     clm = cd._clm
 
@@ -102,6 +108,16 @@ if __name__ == "__main__":
                         help="name of the output pickle file with requested splits")
     parser.add_argument("--db-rows-fn", metavar="STR",
                         help="load db rows from a pickle file if it exists or save rows to a pickle after reading image metadata from db")
+    parser.add_argument("--scan-par", type=int, metavar="INT", default=1,
+                        help="parallel queries while reading the rows from db")
+    parser.add_argument("--token-scan", action="store_true",
+                        help="read the rows from db by token ranges instead of partition by partition")
+    parser.add_argument("--refresh-rows", action="store_true",
+                        help="update the rows file with the partitions added to db since it was saved")
+    parser.add_argument("--check-counts", action="store_true",
+                        help="with --refresh-rows, also re-read partitions whose row count changed")
+    parser.add_argument("--drop-missing", action="store_true",
+                        help="with --refresh-rows, drop partitions and samples no longer in db")
     parser.add_argument("--cassandra-pwd-fn", metavar="STR", default='/tmp/cassandra_pass.txt',
                         help="cassandra password")
     main(parser.parse_args())
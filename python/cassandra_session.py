@@ -0,0 +1,82 @@
+import threading
+
+# pip3 install cassandra-driver
+import cassandra
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+from cassandra.cluster import ExecutionProfile
+
+# Process-wide registry of Cassandra sessions.
+#
+# Handlers and list managers connecting to the same cluster, with the
+# same credentials, share one Cluster/Session and its prepared
+# statements, instead of opening a connection pool each. Sessions stay
+# open when their last user goes away, so that handlers rebuilt (e.g.,
+# on a batch size change) reuse them; close_sessions() shuts down the
+# unused ones.
+class SharedSession():
+    def __init__(self, cassandra_ips, port, username, password):
+        prof_dict = ExecutionProfile(
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+            row_factory = cassandra.query.dict_factory)
+        prof_tuple = ExecutionProfile(
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+            row_factory = cassandra.query.tuple_factory)
+        profs = {'dict': prof_dict, 'tuple': prof_tuple}
+        auth_prov = PlainTextAuthProvider(username=username,
+                                          password=password)
+        self.cluster = Cluster(cassandra_ips,
+                               execution_profiles=profs,
+                               protocol_version=4,
+                               auth_provider=auth_prov,
+                               port=port)
+        self.cluster.connect_timeout = 10 #seconds
+        self.sess = self.cluster.connect()
+        self.users = 0
+        self._prep = {} # query -> prepared statement
+        self._lock = threading.Lock()
+    def prepare(self, query):
+        """Prepared statement of query, prepared once per session"""
+        with self._lock:
+            prep = self._prep.get(query)
+        if (prep is None):
+            prep = self.sess.prepare(query)
+            with self._lock:
+                prep = self._prep.setdefault(query, prep)
+        return prep
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(cassandra_ips, port, username, password):
+    """Shared session for the given cluster and credentials
+
+    :param cassandra_ips: List of Cassandra ip's
+    :param port: Cassandra server port
+    :param username: Cassandra username
+    :param password: Cassandra password
+    :returns: Session, to be given back with release_session
+    :rtype: SharedSession
+
+    """
+    key = (tuple(cassandra_ips), port, username, password)
+    with _sessions_lock:
+        ss = _sessions.get(key)
+        if (ss is None):
+            ss = SharedSession(cassandra_ips, port, username, password)
+            _sessions[key] = ss
+        ss.users += 1
+    return ss
+
+def release_session(ss):
+    with _sessions_lock:
+        ss.users -= 1
+
+def close_sessions():
+    """Shut down the shared sessions not used by anyone"""
+    with _sessions_lock:
+        idle = [k for k, ss in _sessions.items() if ss.users<=0]
+        closing = [_sessions.pop(k) for k in idle]
+    for ss in closing:
+        ss.cluster.shutdown()
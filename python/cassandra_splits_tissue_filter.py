@@ -1,7 +1,7 @@
 import argparse
 import sys, os
 
-from cassandra_dataset import CassandraDataset
+from cassandra_dataset import CassandraDataset, raw_to_uuids, uuids_to_raw
 from cassandra.auth import PlainTextAuthProvider
 from getpass import getpass
 
@@ -44,12 +44,12 @@ def main(args):
 
     for si in range(cd.num_splits):
         cd.current_split = si ## Set the current split 
-        rows = cd.row_keys[cd.split[si]]
+        rows = raw_to_uuids(cd.row_keys[cd.split[si]])
 
         pbar = tqdm(rows[:])
         for r_index, r in enumerate(pbar):
             key = rows[r_index]
-            res = cd._clm.sess.execute(prep, key, execution_profile='tuple')
+            res = cd._clm.sess.execute(prep, [key], execution_profile='tuple')
             data = res.one()
             # patch_id, class, sample_name, sample_rep, tissue coverage ratio, x, y
 
@@ -58,7 +58,7 @@ def main(args):
             tcr = data[4]
 
             if (tcr >= tissue_th_min) and (tcr <= tissue_th_max):
-                new_row_keys_d[si].setdefault(lab, []).append({'patch_id': idx})
+                new_row_keys_d[si].setdefault(lab, []).append(idx)
 
         pbar.close()
 
@@ -71,7 +71,7 @@ def main(args):
     
     ## New cassandra fields related to filtered splits 
     new_row_keys_l_flat = [item for sublist in new_row_keys_l for item in sublist]
-    new_row_keys = np.array(new_row_keys_l_flat)
+    new_row_keys = uuids_to_raw(new_row_keys_l_flat)
 
     ## New n
     n_l = np.array([len(i) for i in new_row_keys_l])
@@ -88,6 +88,8 @@ def main(args):
     cd.n = new_n
     cd.split = new_split
     cd.row_keys = new_row_keys
+    cd.row_labels = None
+    cd.row_samples = None
 
     ## Save new split
     cd.save_splits(out_splits_fn)
@@ -38,7 +38,6 @@ def cassandra_fit(cass_ds, net, epochs=3):
         # loop through batches
         for b in trange(num_batches):
             x,y = cass_ds.load_batch()
-            x.div_(255.0)
             tx, ty = [x], [y]
             eddl.train_batch(net, tx, ty)
         # print loss
@@ -83,7 +82,7 @@ def test_dataset():
         
     # Init Cassandra dataset with server address
     ap = PlainTextAuthProvider(username='prom', password=cass_pass)
-    cd = CassandraDataset(ap, ['cassandra_db'])
+    cd = CassandraDataset(ap, ['cassandra_db'], norm_scale=1/255)
 
     # Flow 0: read rows from db, create splits and save everything
     # Level 0
@@ -0,0 +1,68 @@
+import time
+
+# Adaptive limit of the requests in flight (same algorithm as the C++
+# AIMDLimit).
+#
+# Additive increase, multiplicative decrease: each answer within
+# tolerance times the average latency grows the limit by 1/limit (i.e.,
+# by one per round trip), if the limit is actually being used. Slow
+# answers, timeouts and errors shrink it by backoff, once per round
+# trip: answers to requests sent before the last decrease are not
+# counted again. The reference latency is a long-term moving average,
+# following slow changes of the cluster while sudden slowdowns (e.g.,
+# overload) stand out. Not thread-safe, callers serialize the calls.
+class AIMDLimit():
+    def __init__(self, min_limit, max_limit, initial=None, backoff=0.9,
+                 tolerance=2.0):
+        """Limit of requests in flight, adapted between the bounds
+
+        :param min_limit: Lower bound
+        :param max_limit: Upper bound
+        :param initial: Starting limit (default: max_limit)
+        :param backoff: Factor applied to the limit on slow answers and errors (default: 0.9)
+        :param tolerance: Answers slower than tolerance times the average latency shrink the limit (default: 2)
+        :returns:
+        :rtype:
+
+        """
+        if (not 1<=min_limit<=max_limit):
+            raise ValueError('Bounds must satisfy 1 <= min_limit <= max_limit')
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        if (initial is None):
+            initial = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.rtt_avg = None # long-term average latency, seconds
+        self.last_drop = -float('inf')
+        self.increases = 0
+        self.decreases = 0
+    def get(self):
+        return int(self.limit)
+    def on_sample(self, t0, inflight, dropped=False):
+        """Update the limit with the outcome of a request
+
+        :param t0: Send time of the request (time.perf_counter)
+        :param inflight: Requests in flight when the answer arrived
+        :param dropped: Request failed or timed out
+        :returns:
+        :rtype:
+
+        """
+        now = time.perf_counter()
+        slow = dropped
+        if (not dropped):
+            rtt = now - t0
+            if (self.rtt_avg is None):
+                self.rtt_avg = rtt
+            slow = (rtt > self.tolerance*self.rtt_avg)
+            self.rtt_avg += 0.01*(rtt - self.rtt_avg)
+        if (slow):
+            if (t0 > self.last_drop):
+                self.limit = max(self.min_limit, self.limit*self.backoff)
+                self.last_drop = now
+                self.decreases += 1
+        elif (inflight*2 >= self.limit):
+            self.limit = min(self.max_limit, self.limit + 1/self.limit)
+            self.increases += 1
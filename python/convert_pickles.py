@@ -0,0 +1,24 @@
+"""
+Convert rows and splits pickles, saved by previous versions of
+CassandraDataset, to the current file format, mapped in memory on load.
+"""
+
+import argparse
+
+from cassandra_dataset import convert_pickle
+
+
+def main(args):
+    for src in args.pickles:
+        dst = args.out_fmt % src
+        kind = convert_pickle(src, dst)
+        print(f'{src} -> {dst} ({kind})')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pickles", nargs='+', metavar="STR",
+                        help="rows or splits pickle files")
+    parser.add_argument("--out-fmt", metavar="STR", default='%s.cds',
+                        help="output filename, %%s is replaced by the input one")
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+#ifndef AIMDLIMIT_H
+#define AIMDLIMIT_H
+
+#include <algorithm>
+#include <chrono>
+#include <stdexcept>
+#include <cstdint>
+using namespace std;
+
+// Adaptive limit of the requests in flight (same algorithm as the
+// Python AIMDLimit).
+//
+// Additive increase, multiplicative decrease: each answer within
+// tolerance times the average latency grows the limit by 1/limit, if
+// the limit is actually being used. Slow answers, timeouts and errors
+// shrink it by backoff, once per round trip: answers to requests sent
+// before the last decrease are not counted again. The reference
+// latency is a long-term moving average. Not thread-safe, callers
+// serialize the calls.
+class AIMDLimit{
+private:
+  typedef chrono::steady_clock clock;
+  int min_limit;
+  int max_limit;
+  double limit;
+  double backoff;
+  double tolerance;
+  double rtt_avg = -1; // seconds, -1 until first answer
+  clock::time_point last_drop = clock::time_point::min();
+public:
+  uint64_t increases = 0;
+  uint64_t decreases = 0;
+  AIMDLimit(int min_limit, int max_limit, int initial, double backoff=0.9,
+	    double tolerance=2.0) :
+    min_limit(min_limit), max_limit(max_limit), backoff(backoff),
+    tolerance(tolerance) {
+    if (min_limit<1 || min_limit>max_limit)
+      throw runtime_error("Error: bounds must satisfy 1 <= min <= max");
+    limit = min(max(initial, min_limit), max_limit);
+  }
+  int get(){return(static_cast<int>(limit));}
+  // outcome of a request sent at t0, with inflight requests still out
+  void on_sample(clock::time_point t0, int inflight, bool dropped=false){
+    auto now = clock::now();
+    bool slow = dropped;
+    if (!dropped){
+      double rtt = chrono::duration<double>(now - t0).count();
+      if (rtt_avg<0)
+	rtt_avg = rtt;
+      slow = (rtt > tolerance*rtt_avg);
+      rtt_avg += 0.01*(rtt - rtt_avg);
+    }
+    if (slow){
+      if (t0 > last_drop){
+	limit = max<double>(min_limit, limit*backoff);
+	last_drop = now;
+	++decreases;
+      }
+    } else if (inflight*2 >= limit){
+      limit = min<double>(max_limit, limit + 1/limit);
+      ++increases;
+    }
+  }
+};
+
+#endif
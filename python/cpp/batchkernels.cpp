@@ -0,0 +1,355 @@
+#include "batchkernels.hpp"
+
+#include <cstdlib>
+#include <cstring>
+
+#if defined(__x86_64__) || defined(__i386__)
+#define BPH_X86 1
+#include <immintrin.h>
+#endif
+
+////////////////////////////////////////////////////////////////////////
+// scalar reference
+////////////////////////////////////////////////////////////////////////
+
+static void hwc_row_scalar(const uint8_t* s, float* d, int plane, int x0,
+			   int w, int c, const float* scale, const float* off){
+  // pixels x0..w-1 of a row, d pointing at the row in the first plane
+  for(int ch=0; ch<c; ++ch){
+    float sc = scale[ch];
+    float of = off[ch];
+    const uint8_t* p = s + x0*c + ch;
+    float* q = d + ch*plane;
+    for(int x=x0; x<w; ++x, p+=c)
+      q[x] = sc * static_cast<float>(*p) + of;
+  }
+}
+
+static void hwc2chw_scalar(const uint8_t* src, size_t step, float* dst,
+			   int h, int w, int c, const float* scale,
+			   const float* off){
+  int plane = h * w;
+  for(int y=0; y<h; ++y)
+    hwc_row_scalar(src + y*step, dst + y*w, plane, 0, w, c, scale, off);
+}
+
+static void plane_scalar(const uint8_t* s, float* d, int i0, int n,
+			 float sc, float of){
+  for(int i=i0; i<n; ++i)
+    d[i] = sc * static_cast<float>(s[i]) + of;
+}
+
+static void chw2chw_scalar(const uint8_t* src, float* dst, int plane,
+			   int c, const float* scale, const float* off){
+  for(int ch=0; ch<c; ++ch)
+    plane_scalar(src + ch*plane, dst + ch*plane, 0, plane, scale[ch],
+		 off[ch]);
+}
+
+static void multi_hot_scalar(int32_t lab, float* dst, int n){
+  for(int i=0; i<n; ++i)
+    dst[i] = static_cast<float>((lab>>i) & 1);
+}
+
+static void one_hot_scalar(int32_t lab, float* dst, int n){
+  for(int i=0; i<n; ++i)
+    dst[i] = (i==lab) ? 1.0f : 0.0f;
+}
+
+#ifdef BPH_X86
+////////////////////////////////////////////////////////////////////////
+// SSE4.1
+////////////////////////////////////////////////////////////////////////
+
+// pshufb masks splitting 16 bgr pixels (3 vectors) into 3 channels
+struct DeintMasks{
+  alignas(16) int8_t m[3][3][16];
+  DeintMasks(){
+    for(int ch=0; ch<3; ++ch)
+      for(int v=0; v<3; ++v)
+	for(int i=0; i<16; ++i){
+	  int s = 3*i + ch;
+	  m[ch][v][i] = (s/16==v) ? static_cast<int8_t>(s%16) : -128;
+	}
+  }
+};
+static const DeintMasks deint;
+
+__attribute__((target("sse4.1")))
+static inline __m128i deint_ch(__m128i a, __m128i b, __m128i c, int ch){
+  const __m128i* m = reinterpret_cast<const __m128i*>(deint.m[ch]);
+  __m128i r = _mm_shuffle_epi8(a, _mm_load_si128(m));
+  r = _mm_or_si128(r, _mm_shuffle_epi8(b, _mm_load_si128(m+1)));
+  return(_mm_or_si128(r, _mm_shuffle_epi8(c, _mm_load_si128(m+2))));
+}
+
+__attribute__((target("sse4.1")))
+static inline void cvt16_sse41(__m128i v, float* d, __m128 sc, __m128 of){
+  __m128 f0 = _mm_cvtepi32_ps(_mm_cvtepu8_epi32(v));
+  __m128 f1 = _mm_cvtepi32_ps(_mm_cvtepu8_epi32(_mm_srli_si128(v, 4)));
+  __m128 f2 = _mm_cvtepi32_ps(_mm_cvtepu8_epi32(_mm_srli_si128(v, 8)));
+  __m128 f3 = _mm_cvtepi32_ps(_mm_cvtepu8_epi32(_mm_srli_si128(v, 12)));
+  _mm_storeu_ps(d, _mm_add_ps(_mm_mul_ps(f0, sc), of));
+  _mm_storeu_ps(d+4, _mm_add_ps(_mm_mul_ps(f1, sc), of));
+  _mm_storeu_ps(d+8, _mm_add_ps(_mm_mul_ps(f2, sc), of));
+  _mm_storeu_ps(d+12, _mm_add_ps(_mm_mul_ps(f3, sc), of));
+}
+
+__attribute__((target("sse4.1")))
+static void plane_sse41(const uint8_t* s, float* d, int n, float sc,
+			float of){
+  __m128 vs = _mm_set1_ps(sc);
+  __m128 vo = _mm_set1_ps(of);
+  int i = 0;
+  for(; i+16<=n; i+=16)
+    cvt16_sse41(_mm_loadu_si128(reinterpret_cast<const __m128i*>(s+i)),
+		d+i, vs, vo);
+  plane_scalar(s, d, i, n, sc, of);
+}
+
+__attribute__((target("sse4.1")))
+static void hwc2chw_sse41(const uint8_t* src, size_t step, float* dst,
+			  int h, int w, int c, const float* scale,
+			  const float* off){
+  int plane = h * w;
+  if (c==1){
+    for(int y=0; y<h; ++y)
+      plane_sse41(src + y*step, dst + y*w, w, scale[0], off[0]);
+    return;
+  }
+  if (c!=3){
+    hwc2chw_scalar(src, step, dst, h, w, c, scale, off);
+    return;
+  }
+  __m128 vs[3], vo[3];
+  for(int ch=0; ch<3; ++ch){
+    vs[ch] = _mm_set1_ps(scale[ch]);
+    vo[ch] = _mm_set1_ps(off[ch]);
+  }
+  for(int y=0; y<h; ++y){
+    const uint8_t* s = src + y*step;
+    float* d = dst + y*w;
+    int x = 0;
+    for(; x+16<=w; x+=16){
+      const __m128i* p = reinterpret_cast<const __m128i*>(s + 3*x);
+      __m128i a = _mm_loadu_si128(p);
+      __m128i b = _mm_loadu_si128(p+1);
+      __m128i cc = _mm_loadu_si128(p+2);
+      for(int ch=0; ch<3; ++ch)
+	cvt16_sse41(deint_ch(a, b, cc, ch), d + ch*plane + x, vs[ch],
+		    vo[ch]);
+    }
+    hwc_row_scalar(s, d, plane, x, w, c, scale, off);
+  }
+}
+
+__attribute__((target("sse4.1")))
+static void chw2chw_sse41(const uint8_t* src, float* dst, int plane,
+			  int c, const float* scale, const float* off){
+  for(int ch=0; ch<c; ++ch)
+    plane_sse41(src + ch*plane, dst + ch*plane, plane, scale[ch], off[ch]);
+}
+
+__attribute__((target("sse4.1")))
+static void multi_hot_sse41(int32_t lab, float* dst, int n){
+  __m128i v = _mm_set1_epi32(lab);
+  __m128i bits = _mm_setr_epi32(1, 2, 4, 8);
+  __m128 one = _mm_set1_ps(1.0f);
+  int i = 0;
+  for(; i+4<=n; i+=4){
+    __m128i b = _mm_sll_epi32(bits, _mm_cvtsi32_si128(i));
+    __m128i m = _mm_cmpeq_epi32(_mm_and_si128(v, b), b);
+    _mm_storeu_ps(dst+i, _mm_and_ps(_mm_castsi128_ps(m), one));
+  }
+  for(; i<n; ++i)
+    dst[i] = static_cast<float>((lab>>i) & 1);
+}
+
+__attribute__((target("sse4.1")))
+static void one_hot_sse41(int32_t lab, float* dst, int n){
+  __m128i v = _mm_set1_epi32(lab);
+  __m128i idx = _mm_setr_epi32(0, 1, 2, 3);
+  __m128 one = _mm_set1_ps(1.0f);
+  int i = 0;
+  for(; i+4<=n; i+=4){
+    __m128i m = _mm_cmpeq_epi32(_mm_add_epi32(idx, _mm_set1_epi32(i)), v);
+    _mm_storeu_ps(dst+i, _mm_and_ps(_mm_castsi128_ps(m), one));
+  }
+  for(; i<n; ++i)
+    dst[i] = (i==lab) ? 1.0f : 0.0f;
+}
+
+////////////////////////////////////////////////////////////////////////
+// AVX2
+////////////////////////////////////////////////////////////////////////
+
+__attribute__((target("avx2")))
+static inline void cvt16_avx2(__m128i v, float* d, __m256 sc, __m256 of){
+  __m256 f0 = _mm256_cvtepi32_ps(_mm256_cvtepu8_epi32(v));
+  __m256 f1 = _mm256_cvtepi32_ps(_mm256_cvtepu8_epi32(_mm_srli_si128(v, 8)));
+  _mm256_storeu_ps(d, _mm256_add_ps(_mm256_mul_ps(f0, sc), of));
+  _mm256_storeu_ps(d+8, _mm256_add_ps(_mm256_mul_ps(f1, sc), of));
+}
+
+__attribute__((target("avx2")))
+static void plane_avx2(const uint8_t* s, float* d, int n, float sc,
+		       float of){
+  __m256 vs = _mm256_set1_ps(sc);
+  __m256 vo = _mm256_set1_ps(of);
+  int i = 0;
+  for(; i+32<=n; i+=32){
+    __m256i v = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(s+i));
+    cvt16_avx2(_mm256_castsi256_si128(v), d+i, vs, vo);
+    cvt16_avx2(_mm256_extracti128_si256(v, 1), d+i+16, vs, vo);
+  }
+  for(; i+16<=n; i+=16)
+    cvt16_avx2(_mm_loadu_si128(reinterpret_cast<const __m128i*>(s+i)),
+	       d+i, vs, vo);
+  plane_scalar(s, d, i, n, sc, of);
+}
+
+__attribute__((target("avx2")))
+static void hwc2chw_avx2(const uint8_t* src, size_t step, float* dst,
+			 int h, int w, int c, const float* scale,
+			 const float* off){
+  int plane = h * w;
+  if (c==1){
+    for(int y=0; y<h; ++y)
+      plane_avx2(src + y*step, dst + y*w, w, scale[0], off[0]);
+    return;
+  }
+  if (c!=3){
+    hwc2chw_scalar(src, step, dst, h, w, c, scale, off);
+    return;
+  }
+  __m256 vs[3], vo[3];
+  for(int ch=0; ch<3; ++ch){
+    vs[ch] = _mm256_set1_ps(scale[ch]);
+    vo[ch] = _mm256_set1_ps(off[ch]);
+  }
+  for(int y=0; y<h; ++y){
+    const uint8_t* s = src + y*step;
+    float* d = dst + y*w;
+    int x = 0;
+    for(; x+16<=w; x+=16){
+      const __m128i* p = reinterpret_cast<const __m128i*>(s + 3*x);
+      __m128i a = _mm_loadu_si128(p);
+      __m128i b = _mm_loadu_si128(p+1);
+      __m128i cc = _mm_loadu_si128(p+2);
+      for(int ch=0; ch<3; ++ch)
+	cvt16_avx2(deint_ch(a, b, cc, ch), d + ch*plane + x, vs[ch],
+		   vo[ch]);
+    }
+    hwc_row_scalar(s, d, plane, x, w, c, scale, off);
+  }
+}
+
+__attribute__((target("avx2")))
+static void chw2chw_avx2(const uint8_t* src, float* dst, int plane,
+			 int c, const float* scale, const float* off){
+  for(int ch=0; ch<c; ++ch)
+    plane_avx2(src + ch*plane, dst + ch*plane, plane, scale[ch], off[ch]);
+}
+
+__attribute__((target("avx2")))
+static void multi_hot_avx2(int32_t lab, float* dst, int n){
+  __m256i v = _mm256_set1_epi32(lab);
+  __m256i bits = _mm256_setr_epi32(1, 2, 4, 8, 16, 32, 64, 128);
+  __m256 one = _mm256_set1_ps(1.0f);
+  int i = 0;
+  for(; i+8<=n; i+=8){
+    __m256i b = _mm256_sll_epi32(bits, _mm_cvtsi32_si128(i));
+    __m256i m = _mm256_cmpeq_epi32(_mm256_and_si256(v, b), b);
+    _mm256_storeu_ps(dst+i, _mm256_and_ps(_mm256_castsi256_ps(m), one));
+  }
+  for(; i<n; ++i)
+    dst[i] = static_cast<float>((lab>>i) & 1);
+}
+
+__attribute__((target("avx2")))
+static void one_hot_avx2(int32_t lab, float* dst, int n){
+  __m256i v = _mm256_set1_epi32(lab);
+  __m256i idx = _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7);
+  __m256 one = _mm256_set1_ps(1.0f);
+  int i = 0;
+  for(; i+8<=n; i+=8){
+    __m256i m = _mm256_cmpeq_epi32(_mm256_add_epi32(idx,
+						    _mm256_set1_epi32(i)), v);
+    _mm256_storeu_ps(dst+i, _mm256_and_ps(_mm256_castsi256_ps(m), one));
+  }
+  for(; i<n; ++i)
+    dst[i] = (i==lab) ? 1.0f : 0.0f;
+}
+#endif
+
+////////////////////////////////////////////////////////////////////////
+// runtime dispatch
+////////////////////////////////////////////////////////////////////////
+
+static const BatchKernels k_scalar = {KernelIsa::scalar, hwc2chw_scalar,
+				      chw2chw_scalar, multi_hot_scalar,
+				      one_hot_scalar};
+#ifdef BPH_X86
+static const BatchKernels k_sse41 = {KernelIsa::sse41, hwc2chw_sse41,
+				     chw2chw_sse41, multi_hot_sse41,
+				     one_hot_sse41};
+static const BatchKernels k_avx2 = {KernelIsa::avx2, hwc2chw_avx2,
+				    chw2chw_avx2, multi_hot_avx2,
+				    one_hot_avx2};
+#endif
+
+bool kernel_isa_supported(KernelIsa isa){
+  switch (isa){
+  case KernelIsa::scalar:
+    return(true);
+#ifdef BPH_X86
+  case KernelIsa::sse41:
+    return(__builtin_cpu_supports("sse4.1"));
+  case KernelIsa::avx2:
+    return(__builtin_cpu_supports("avx2"));
+#endif
+  default:
+    return(false);
+  }
+}
+
+string kernel_isa_name(KernelIsa isa){
+  switch (isa){
+  case KernelIsa::sse41:
+    return("sse41");
+  case KernelIsa::avx2:
+    return("avx2");
+  default:
+    return("scalar");
+  }
+}
+
+const BatchKernels& batch_kernels(KernelIsa isa){
+  if (!kernel_isa_supported(isa))
+    return(k_scalar);
+#ifdef BPH_X86
+  if (isa==KernelIsa::avx2)
+    return(k_avx2);
+  if (isa==KernelIsa::sse41)
+    return(k_sse41);
+#endif
+  return(k_scalar);
+}
+
+static const BatchKernels& choose_kernels(){
+  KernelIsa isa = KernelIsa::avx2;
+  const char* env = getenv("BPH_KERNELS");
+  if (env && strcmp(env, "sse41")==0)
+    isa = KernelIsa::sse41;
+  else if (env && strcmp(env, "scalar")==0)
+    isa = KernelIsa::scalar;
+  // best supported, not above the requested one
+  while (!kernel_isa_supported(isa))
+    isa = static_cast<KernelIsa>(static_cast<int>(isa) - 1);
+  return(batch_kernels(isa));
+}
+
+const BatchKernels& batch_kernels(){
+  static const BatchKernels& k = choose_kernels();
+  return(k);
+}
@@ -0,0 +1,37 @@
+#ifndef BATCHKERNELS_H
+#define BATCHKERNELS_H
+
+#include <cstdint>
+#include <cstddef>
+#include <string>
+using namespace std;
+
+// Inner loops of batch assembly, with AVX2 and SSE4.1 versions chosen
+// at runtime (scalar fallback). All versions compute x*scale[c] + off[c]
+// as a multiplication followed by an addition, so their results are
+// identical to the scalar ones.
+enum class KernelIsa {scalar, sse41, avx2};
+
+struct BatchKernels{
+  KernelIsa isa;
+  // interleaved (hwc) uint8 image, rows step bytes apart, to planar
+  // (chw) float slot, scaled and shifted per channel
+  void (*hwc2chw)(const uint8_t* src, size_t step, float* dst, int h,
+		  int w, int c, const float* scale, const float* off);
+  // planar (chw) uint8 image to planar float slot
+  void (*chw2chw)(const uint8_t* src, float* dst, int plane, int c,
+		  const float* scale, const float* off);
+  // label as n floats: bit i of lab (multi-label) or i==lab (one-hot)
+  void (*multi_hot)(int32_t lab, float* dst, int n);
+  void (*one_hot)(int32_t lab, float* dst, int n);
+};
+
+// best kernels supported by the cpu (BPH_KERNELS=scalar|sse41|avx2
+// lowers the choice)
+const BatchKernels& batch_kernels();
+// kernels of a given isa, falling back to scalar if not supported
+const BatchKernels& batch_kernels(KernelIsa isa);
+bool kernel_isa_supported(KernelIsa isa);
+string kernel_isa_name(KernelIsa isa);
+
+#endif
@@ -1,32 +1,86 @@
 #include "batchpatchhandler.hpp"
+#include "tokenring.hpp"
 
 #include <iostream>
 #include <fstream>
 #include <sstream>
 #include <stdexcept>
+#include <cstring>
+#include <cstdint>
+#include <tuple>
+#include <chrono>
+#include <algorithm>
 #include <opencv2/imgcodecs.hpp>
 #include <opencv2/core/mat.hpp>
 #include <ecvl/support_eddl.h>
+#include <random>
 
+atomic<uint64_t> BatchPatchHandler::n_handlers{0};
+mutex BatchPatchHandler::aug_mtx;
 
 BatchPatchHandler::~BatchPatchHandler(){
-  cass_session_free(session);
-  cass_cluster_free(cluster);
+  // drop the batches not started yet, wait for the one being loaded
+  {
+    lock_guard<mutex> lock(q_mtx);
+    stop_loader = true;
+    to_load.clear();
+  }
+  q_cv.notify_all();
+  if (loader.joinable())
+    loader.join();
+  // stop hedging, then wait for the answers of hedge losers
+  {
+    lock_guard<mutex> lock(req_mtx);
+    stop_hedge = true;
+  }
+  hedge_cv.notify_all();
+  if (hedge_thread.joinable())
+    hedge_thread.join();
+  {
+    unique_lock<mutex> lock(req_mtx);
+    req_cv.wait(lock, [this]{return attempts==0;});
+  }
+  // the session (with its prepared statements) stays in the registry
+  delete pool;
 }
 
 void BatchPatchHandler::connect(){
+  // session shared with the handlers with the same connection parameters
+  auto& o = driver_opts;
+  stringstream key;
+  key << s_cassandra_ips << '\n' << port << '\n' << username << '\n' <<
+    password << '\n' << o.io_threads << ' ' << o.connections_per_host <<
+    ' ' << o.queue_size_io << ' ' << o.token_aware << ' ' <<
+    o.latency_aware << ' ' << o.speculative_delay_ms << ' ' <<
+    o.speculative_max;
+  conn = SessionRegistry::get(key.str(), [this](CassCluster* cluster){
+      setup_cluster(cluster);});
+  session = conn->session;
+}
+
+void BatchPatchHandler::setup_cluster(CassCluster* cluster){
   cass_cluster_set_contact_points(cluster, s_cassandra_ips.c_str());
   cass_cluster_set_credentials(cluster, username.c_str(), password.c_str());
   cass_cluster_set_port(cluster, port);
   cass_cluster_set_protocol_version(cluster, CASS_PROTOCOL_VERSION_V4);
-  CassFuture* connect_future = cass_session_connect(session, cluster);
-  CassError rc = cass_future_error_code(connect_future);
-  cass_future_free(connect_future);
-  if (rc == CASS_OK) {
-    printf("Successfully connected!\n");
-  } else {
-    throw runtime_error("Error: unable to connect to Cassandra DB. ");
-  }
+  // driver tuning
+  auto& o = driver_opts;
+  if (cass_cluster_set_num_threads_io(cluster, o.io_threads) != CASS_OK ||
+      cass_cluster_set_core_connections_per_host(cluster,
+						 o.connections_per_host)
+      != CASS_OK ||
+      cass_cluster_set_queue_size_io(cluster, o.queue_size_io) != CASS_OK)
+    throw runtime_error("Error: invalid driver options");
+  cass_cluster_set_token_aware_routing(cluster,
+				       o.token_aware ? cass_true : cass_false);
+  // spread requests (and hedges) over all the replicas of a key
+  cass_cluster_set_token_aware_routing_shuffle_replicas(cluster, cass_true);
+  cass_cluster_set_latency_aware_routing(cluster, o.latency_aware ?
+					 cass_true : cass_false);
+  if (o.speculative_delay_ms>=0 &&
+      cass_cluster_set_constant_speculative_execution_policy
+      (cluster, o.speculative_delay_ms, o.speculative_max) != CASS_OK)
+    throw runtime_error("Error: invalid speculative execution options");
 }
 
 BatchPatchHandler::BatchPatchHandler(int num_classes, ecvl::Augmentation* aug,
@@ -34,11 +88,53 @@ BatchPatchHandler::BatchPatchHandler(int num_classes, ecvl::Augmentation* aug,
 				     string data_col, string id_col,
 				     string username, string cass_pass,
 				     vector<string> cassandra_ips,
-				     int thread_par, int port) :
-  num_classes(num_classes), aug(aug), table(table), label_col(label_col),
-  data_col(data_col), id_col(id_col), username(username),
-  password(cass_pass), cassandra_ips(cassandra_ips), port(port)
+				     int thread_par, int port,
+				     float decode_scale, float norm_scale,
+				     optional<vector<float>> norm_mean,
+				     optional<vector<float>> norm_std,
+				     bool out_uint8, optional<string> cache_dir,
+				     uint64_t cache_bytes, int multi_get,
+				     optional<float> hedge_pct, int max_inflight,
+				     int ring_size,
+				     optional<vector<int>> batch_shape,
+				     int queue_depth, optional<uint32_t> aug_seed,
+				     optional<DriverOptions> driver_opts,
+				     optional<pair<int, int>> inflight_bounds) :
+  num_classes(num_classes), aug(aug), aug_seed(aug_seed), table(table),
+  label_col(label_col), data_col(data_col), id_col(id_col), username(username),
+  password(cass_pass), cassandra_ips(cassandra_ips), port(port),
+  decode_scale(decode_scale), norm_scale(norm_scale),
+  norm_mean(norm_mean.value_or(vector<float>())),
+  norm_std(norm_std.value_or(vector<float>())),
+  driver_opts(driver_opts.value_or(DriverOptions())), multi_get(multi_get),
+  hedge_pct(hedge_pct), max_inflight(max_inflight), ring_size(ring_size),
+  queue_depth(queue_depth), out_uint8(out_uint8)
 {
+  if (out_uint8 && (norm_scale!=1.0f || norm_mean || norm_std))
+    throw runtime_error("Error: normalization not available with uint8 output");
+  if (queue_depth<1)
+    throw runtime_error("Error: queue_depth must be at least 1");
+  // requests in flight: max_inflight, or adapted between bounds
+  if (inflight_bounds)
+    limiter = unique_ptr<AIMDLimit>
+      (new AIMDLimit(inflight_bounds->first, inflight_bounds->second,
+		     max_inflight));
+  // ECVL draws augmentation parameters from one process-wide engine:
+  // without aug_seed, workers draw from it concurrently, in scheduling
+  // order (neither reproducible nor race-free with thread_par>1)
+  if (aug && !aug_seed)
+    ecvl::AugmentationParam::SetSeed(random_device()());
+  // set decoding scale, reduced sizes use jpeg scaled IDCT
+  if (decode_scale==1.0f)
+    imread_flag = cv::IMREAD_UNCHANGED;
+  else if (decode_scale==0.5f)
+    imread_flag = cv::IMREAD_REDUCED_COLOR_2;
+  else if (decode_scale==0.25f)
+    imread_flag = cv::IMREAD_REDUCED_COLOR_4;
+  else if (decode_scale==0.125f)
+    imread_flag = cv::IMREAD_REDUCED_COLOR_8;
+  else
+    throw runtime_error("Error: decode_scale must be one of 1, 1/2, 1/4, 1/8");
   // join cassandra ip's into comma seperated string
   s_cassandra_ips =
     accumulate(cassandra_ips.begin(), cassandra_ips.end(), string(), 
@@ -47,24 +143,123 @@ BatchPatchHandler::BatchPatchHandler(int num_classes, ecvl::Augmentation* aug,
 	       } );
   // set multi-label or not
   multi_label = (num_classes>_max_multilabs) ? false : true;
-  // connect to cluster and init session
+  // connect to cluster, or reuse the session of other handlers
   connect();
-  // assemble query
+  // assemble query and prepare statement
   stringstream ss;
   ss << "SELECT " << label_col << ", " << data_col <<
     " FROM " << table << " WHERE " << id_col << "=?" << endl;
-  string query = ss.str();
-  // prepare statement
-  CassFuture* prepare_future = cass_session_prepare(session, query.c_str());
-  prepared = cass_future_get_prepared(prepare_future);
-  if (prepared == NULL) {
-    /* Handle error */
-    cass_future_free(prepare_future);
-    throw runtime_error("Error in query: " + query);
-  }
-  cass_future_free(prepare_future);
-  // init thread pool
+  prepared = prepare(ss.str());
+  // multi-partition query, for keys owned by the same node
+  if (multi_get>1){
+    stringstream ss_in;
+    ss_in << "SELECT " << id_col << ", " << label_col << ", " << data_col <<
+      " FROM " << table << " WHERE " << id_col << " IN ?" << endl;
+    prepared_in = prepare(ss_in.str());
+  }
+  // token ring, to group keys by node
+  if (multi_get>1)
+    load_ring();
+  // init local cache, one directory per table
+  if (cache_dir)
+    cache = unique_ptr<BlobCache>(new BlobCache(*cache_dir + "/" + table,
+						cache_bytes));
+  // init thread pool, decoding only: default one thread per core
+  if (thread_par<=0)
+    thread_par = max(1u, thread::hardware_concurrency());
   pool = new ThreadPool(thread_par);
+  // batch shape given in advance: {bs, chan, height, width}
+  if (batch_shape){
+    auto& sh = *batch_shape;
+    if (sh.size()!=4 || *min_element(sh.begin(), sh.end())<=0)
+      throw runtime_error("Error: batch_shape must be {bs, chan, height, width}");
+    chan = sh[1];
+    set_norm();
+    height = sh[2];
+    width = sh[3];
+    tot_dims = chan * height * width;
+    if (ring_size>0){
+      batch_ring = make_shared<BatchRing>(ring_size, sh, num_classes);
+      batch_ring->fill(out_uint8);
+    }
+  }
+  // hedge monitor
+  if (hedge_pct)
+    hedge_thread = thread(&BatchPatchHandler::hedge_loop, this);
+  // batch loader
+  loader = thread(&BatchPatchHandler::loader_loop, this);
+}
+
+const CassPrepared* BatchPatchHandler::prepare(const string& query){
+  // prepared once per shared session
+  return(conn->prepare(query));
+}
+
+void BatchPatchHandler::load_ring(){
+  // read tokens of local node, then of its peers (from the same node)
+  string local_addr;
+  for(auto tab : {"system.local", "system.peers"}){
+    string query = string("SELECT rpc_address, tokens FROM ") + tab;
+    CassStatement* statement = cass_statement_new(query.c_str(), 0);
+    if (!local_addr.empty())
+      cass_statement_set_host(statement, local_addr.c_str(), port);
+    CassFuture* query_future = cass_session_execute(session, statement);
+    cass_statement_free(statement);
+    const CassResult* result = cass_future_get_result(query_future);
+    cass_future_free(query_future);
+    if (result == NULL) {
+      cerr << "Warning: token ring not available, "
+	"requests are not grouped by node" << endl;
+      ring.clear();
+      return;
+    }
+    CassIterator* rows = cass_iterator_from_result(result);
+    while (cass_iterator_next(rows)) {
+      const CassRow* row = cass_iterator_get_row(rows);
+      CassInet inet;
+      cass_value_get_inet(cass_row_get_column(row, 0), &inet);
+      char addr[CASS_INET_STRING_LENGTH];
+      cass_inet_string(inet, addr);
+      if (local_addr.empty())
+	local_addr = addr;
+      CassIterator* toks =
+	cass_iterator_from_collection(cass_row_get_column(row, 1));
+      while (toks && cass_iterator_next(toks)) {
+	const char* tok;
+	size_t tok_len;
+	cass_value_get_string(cass_iterator_get_value(toks), &tok, &tok_len);
+	ring[stoll(string(tok, tok_len))] = addr;
+      }
+      if (toks)
+	cass_iterator_free(toks);
+    }
+    cass_iterator_free(rows);
+    cass_result_free(result);
+  }
+}
+
+string BatchPatchHandler::key2host(const string& key){
+  // node owning the key (token from the hex digits, i.e., wire bytes)
+  return(ring_owner(ring, uuid_token(key)));
+}
+
+vector<pair<string, vector<int>>>
+BatchPatchHandler::group_keys(const vector<string>& keys,
+			      const vector<int>& offs){
+  // group by node owning the token, then split in chunks of multi_get
+  map<string, vector<int>> groups;
+  for(int off : offs){
+    groups[key2host(keys[off])].push_back(off);
+  }
+  vector<pair<string, vector<int>>> r;
+  for(auto& g : groups){
+    auto& v = g.second;
+    for(size_t i=0; i<v.size(); i+=multi_get){
+      auto e = v.begin() + min(v.size(), i+multi_get);
+      r.emplace_back(g.first, vector<int>(v.begin()+i, e));
+    }
+  }
+  return(r);
 }
 
 vector<char> BatchPatchHandler::file2buf(string filename){
@@ -79,167 +274,675 @@ vector<char> BatchPatchHandler::file2buf(string filename){
     throw runtime_error("Error reading file");
 }
 
-cv::Mat BatchPatchHandler::buf2mat(const vector<char>& buf){
-  cv::InputArray ia(buf);
-  cv::Mat img = cv::imdecode(ia, cv::IMREAD_UNCHANGED);
-  // img is BGR
-  return(img);
-} 
-
-ecvl::Image BatchPatchHandler::buf2img(const vector<char>& buf){
-  cv::Mat m = buf2mat(buf);
-  ecvl::Image r = ecvl::MatToImage(m);
-  if (aug){
-    aug->Apply(r);
+void BatchPatchHandler::set_norm(){
+  // per-channel (x*norm_scale - mean)/std, as x*ch_scale + ch_off
+  if ((norm_mean.size()>1 && norm_mean.size()!=(size_t)chan) ||
+      (norm_std.size()>1 && norm_std.size()!=(size_t)chan))
+    throw runtime_error("Error: norm_mean and norm_std need one value per channel");
+  ch_scale.resize(chan);
+  ch_off.resize(chan);
+  for(int c=0; c<chan; ++c){
+    float m = norm_mean.empty() ? 0.0 : norm_mean[norm_mean.size()>1 ? c : 0];
+    float s = norm_std.empty() ? 1.0 : norm_std[norm_std.size()>1 ? c : 0];
+    ch_scale[c] = norm_scale / s;
+    ch_off[c] = -m / s;
   }
-  return(r);
 }
 
-void BatchPatchHandler::get_img(const CassResult* result, int off){
+void BatchPatchHandler::get_img(const CassResult* result, int off,
+				const string& key){
+  // free Cassandra result memory (values included) when done
+  unique_ptr<const CassResult, decltype(&cass_result_free)>
+    res(result, cass_result_free);
   // decode result
   const CassRow* row = cass_result_first_row(result);
   if (row == NULL) {
     // Handle error
     throw runtime_error("Error: query returned empty set");
   }
+  cass_int32_t lab;
+  const cass_byte_t* data;
+  size_t sz;
+  row2data(row, lab, data, sz, key);
+  // decode straight from the driver buffer
+  data2batch(data, sz, lab, off);
+}
+
+void BatchPatchHandler::row2data(const CassRow* row, cass_int32_t& lab,
+				 const cass_byte_t*& data, size_t& sz,
+				 const string& key){
   const CassValue* c_lab =
     cass_row_get_column_by_name(row, label_col.c_str());
   const CassValue* c_data =
     cass_row_get_column_by_name(row, data_col.c_str());
-  cass_int32_t lab;
   cass_value_get_int32(c_lab, &lab);
-  const cass_byte_t* data;
-  size_t sz;
   cass_value_get_bytes(c_data, &data, &sz);
-  // convert buffer to image as vector<float>
-  vector<char> buf(data, data+sz);
-  ecvl::Image im = buf2img(buf);
-  if (!im.contiguous_){
-        throw runtime_error("Image data not contiguous.");
-  }
-  // free Cassandra result memory (values included)
-  cass_result_free(result);
+  // fresh from Cassandra: save in local cache
+  if (cache)
+    cache->put(key, lab, data, sz);
+}
+
+ecvl::Augmentation* BatchPatchHandler::thread_aug(){
+  // clone of aug owned by the calling (pool) thread, so that workers
+  // share no augmentation parameters (the random engine is ECVL's)
+  thread_local uint64_t t_uid = -1;
+  thread_local shared_ptr<ecvl::Augmentation> t_aug;
+  if (t_uid!=uid){
+    t_aug = aug->Clone();
+    t_uid = uid;
+  }
+  return(t_aug.get());
+}
+
+void BatchPatchHandler::data2batch(const cass_byte_t* data, size_t sz,
+				   cass_int32_t lab, int off){
+  // decode blob, without copying it, into a per-thread scratch image
+  thread_local cv::Mat scratch;
+  const cv::Mat raw(1, static_cast<int>(sz), CV_8UC1,
+		    const_cast<cass_byte_t*>(data));
+  cv::imdecode(raw, imread_flag, &scratch);
+  if (scratch.empty())
+    throw runtime_error("Error: unable to decode patch");
+  if (aug){
+    // augmentations work on ecvl images (planar, i.e., chw)
+    ecvl::Image im = ecvl::MatToImage(scratch);
+    if (aug_seed){
+      // one at a time, seeded by batch and offset: same draws whatever
+      // the scheduling of the workers
+      seed_seq ss{*aug_seed, static_cast<uint32_t>(n_loaded),
+		  static_cast<uint32_t>(n_loaded>>32),
+		  static_cast<uint32_t>(off)};
+      uint32_t seed;
+      ss.generate(&seed, &seed+1);
+      lock_guard<mutex> lock(aug_mtx);
+      ecvl::AugmentationParam::SetSeed(seed);
+      thread_aug()->Apply(im);
+    } else
+      thread_aug()->Apply(im);
+    if (!im.contiguous_){
+      throw runtime_error("Image data not contiguous.");
+    }
+    init_batch_dims(im.Channels(), im.Height(), im.Width());
+    chw2batch(im.data_, off);
+  } else {
+    // bgr interleaved (hwc), written directly in the batch slot
+    init_batch_dims(scratch.channels(), scratch.rows, scratch.cols);
+    hwc2batch(scratch, off);
+  }
+  lab2batch(lab, off);
+}
+
+void BatchPatchHandler::init_batch_dims(int c, int h, int w){
   ////////////////////////////////////////////////////////////////////////
   // run by just one thread
   ////////////////////////////////////////////////////////////////////////
-  mtx.lock();
-  // if unset, set images parameters
-  if (height<0){
-    height = im.Height();
-    width = im.Width();
-    chan = im.Channels();
-    tot_dims = chan * height * width;
-  }
-  // allocate batch if needed
-  if (init_batch){
-    t_feats = unique_ptr<Tensor>(new Tensor({bs, chan, height, width}));
-    t_labs = unique_ptr<Tensor>(new Tensor({bs, num_classes}));
+  {
+    lock_guard<mutex> lock(mtx);
+    // if unset, set images parameters
+    if (height<0){
+      chan = c;
+      set_norm();
+      height = h;
+      width = w;
+      tot_dims = chan * height * width;
+    }
+    // unless given in advance, batch shape is fixed by the first batch
+    if (ring_size>0 && !batch_ring)
+      batch_ring = make_shared<BatchRing>(ring_size,
+					  vector<int>{bs, chan, height, width},
+					  num_classes);
+    // allocate batch if needed
+    if (init_batch && batch_ring){
+      if (out_uint8)
+	u_feats = batch_ring->get_u_feats(bs);
+      else
+	t_feats = batch_ring->get_feats(bs);
+      t_labs = batch_ring->get_labs(bs);
+    }
+    else if (init_batch){
+      if (out_uint8)
+	u_feats = unique_ptr<vector<uint8_t>>(new vector<uint8_t>(bs*tot_dims));
+      else
+	t_feats = unique_ptr<Tensor>(new Tensor({bs, chan, height, width}));
+      t_labs = unique_ptr<Tensor>(new Tensor({bs, num_classes}));
+    }
+    init_batch = false;
   }
-  init_batch = false;
-  mtx.unlock();
   ////////////////////////////////////////////////////////////////////////
+  if (c!=chan || h!=height || w!=width)
+    throw runtime_error("Error: patch shape differs from previous ones");
+}
 
-  // copy image and label to tensors
-  float* p_feats =t_feats->ptr + off*tot_dims;
-  uint8_t* p_im = im.data_;
-  for(int i=0; i<tot_dims; ++i){
-    *(p_feats++) = static_cast<float>(*(p_im++));
+void BatchPatchHandler::chw2batch(const uint8_t* p_im, int off){
+  // copy planar image to tensors
+  if (out_uint8){
+    memcpy(u_feats->data() + off*tot_dims, p_im, tot_dims);
+    return;
   }
+  // convert to float, fusing scaling and normalization
+  float* p_feats = t_feats->ptr + off*tot_dims;
+  kern.chw2chw(p_im, p_feats, height * width, chan, ch_scale.data(),
+	       ch_off.data());
   // alternative way: using ecvl ImageToTensor
   // Tensor* tf = t_feats.get();
   // ecvl::ImageToTensor(im, tf, off);
+}
 
+void BatchPatchHandler::hwc2batch(const cv::Mat& m, int off){
+  // transpose interleaved image (hwc) to planar slot (chw)
+  int plane = height * width;
+  if (out_uint8){
+    uint8_t* p_feats = u_feats->data() + off*tot_dims;
+    vector<cv::Mat> planes;
+    for(int c=0; c<chan; ++c)
+      planes.emplace_back(height, width, CV_8UC1, p_feats + c*plane);
+    cv::split(m, planes); // planes already allocated: written in place
+    return;
+  }
+  // convert to float, fusing transpose, scaling and normalization
+  float* p_feats = t_feats->ptr + off*tot_dims;
+  kern.hwc2chw(m.ptr<uint8_t>(0), m.step, p_feats, height, width, chan,
+	       ch_scale.data(), ch_off.data());
+}
+
+void BatchPatchHandler::lab2batch(cass_int32_t lab, int off){
   // convert label 
   float* p_labs = t_labs->ptr + off*num_classes;
-  if (multi_label){ // multi-label encoding
-    for(int i=0; i<num_classes; ++i){
-      *(p_labs++) = static_cast<float>(lab&1);
-      lab>>=1;
+  if (multi_label) // multi-label encoding
+    kern.multi_hot(lab, p_labs, num_classes);
+  else // int to one-hot
+    kern.one_hot(lab, p_labs, num_classes);
+}
+
+void BatchPatchHandler::add_latency(int64_t us){
+  lock_guard<mutex> lock(hedge_mtx);
+  const size_t max_lats = 1024;
+  if (lats.size() < max_lats)
+    lats.push_back(us);
+  else
+    lats[n_lats % max_lats] = us;
+  ++n_lats;
+  // update threshold every 64 samples
+  if (n_lats >= 64 && n_lats % 64 == 0){
+    vector<int64_t> v(lats);
+    size_t k = min(v.size()-1, static_cast<size_t>(*hedge_pct/100 * v.size()));
+    nth_element(v.begin(), v.begin()+k, v.end());
+    hedge_thr_us = v[k];
+  }
+}
+
+int BatchPatchHandler::cur_limit(){
+  // with req_mtx held
+  return(limiter ? limiter->get() : max_inflight);
+}
+
+int BatchPatchHandler::inflight_limit(){
+  lock_guard<mutex> lock(req_mtx);
+  return(cur_limit());
+}
+
+void BatchPatchHandler::issue_requests(){
+  // keep requests in flight up to the limit
+  while (true){
+    shared_ptr<Request> req;
+    {
+      lock_guard<mutex> lock(req_mtx);
+      if (pending.empty() || inflight>=cur_limit())
+	return;
+      req = pending.front();
+      pending.pop_front();
+      ++inflight;
+      req->t0 = chrono::steady_clock::now();
+      if (hedge_pct)
+	hedge_q.push_back(req);
     }
-  } else { // int to one-hot
-    for(int i=0; i<num_classes; ++i){
-      float b = (i==lab)? 1.0 : 0.0;
-      *(p_labs++) = b;
+    send(req, false);
+  }
+}
+
+// data passed to the driver callback
+struct Attempt{
+  BatchPatchHandler* h;
+  shared_ptr<Request> req;
+  bool hedge;
+};
+
+void BatchPatchHandler::send(shared_ptr<Request> req, bool hedge){
+  // hedges are not pinned: the ring does not know the replica placement
+  // (e.g., NetworkTopologyStrategy), so let the driver pick the node:
+  // a shuffled replica with token-aware routing, any coordinator for IN
+  // lists (no routing key)
+  string host = hedge ? "" : req->host;
+  CassFuture* query_future = req->in_list ? keys2future(req->keys, host) :
+    key2future(req->keys[0], host);
+  {
+    lock_guard<mutex> lock(req_mtx);
+    ++req->attempts;
+    ++attempts;
+  }
+  // callback runs in a driver thread (or here, if already completed)
+  cass_future_set_callback(query_future, &BatchPatchHandler::on_result,
+			   new Attempt{this, req, hedge});
+}
+
+void BatchPatchHandler::on_result(CassFuture* query_future, void* data){
+  Attempt* a = static_cast<Attempt*>(data);
+  a->h->handle_result(query_future, a->req, a->hedge);
+  delete a;
+}
+
+void BatchPatchHandler::handle_result(CassFuture* query_future,
+				      shared_ptr<Request> req, bool hedge){
+  // future is ready: no blocking here
+  CassError rc = cass_future_error_code(query_future);
+  bool win = false;
+  string err;
+  {
+    lock_guard<mutex> lock(req_mtx);
+    --req->attempts;
+    --attempts;
+    // first answer wins; an error waits for the other attempt, if any
+    if (!req->done && (rc==CASS_OK || req->attempts==0)){
+      req->done = true;
+      --inflight;
+      if (limiter)
+	limiter->on_sample(req->t0, inflight, rc!=CASS_OK);
+      if (rc==CASS_OK && !batch_error){
+	win = true;
+	++decoding;
+      } else if (rc!=CASS_OK) {
+	const char* error_message;
+	size_t error_message_length;
+	cass_future_error_message(query_future,
+				  &error_message, &error_message_length);
+	err = string(error_message, error_message_length);
+      }
     }
   }
+  if (!err.empty())
+    set_error(make_exception_ptr
+	      (runtime_error("Error: unable to execute query, " + err)));
+  if (!win){
+    // hedge loser, or batch already failed
+    cass_future_free(query_future);
+    req_cv.notify_all();
+    return;
+  }
+  ++n_req;
+  if (hedge)
+    ++n_hedge_wins;
+  if (hedge_pct)
+    add_latency(chrono::duration_cast<chrono::microseconds>
+		(chrono::steady_clock::now() - req->t0).count());
+  // cpu work to the pool, and a free slot for the next request
+  pool->enqueue(&BatchPatchHandler::decode_result, this, query_future, req);
+  issue_requests();
 }
 
-void BatchPatchHandler::future2img(CassFuture* query_future, int off){
-  // get result (blocking)
-  const CassResult* result = cass_future_get_result(query_future);
-  if (result == NULL) {
-    // Handle error
-    const char* error_message;
-    size_t error_message_length;
-    cass_future_error_message(query_future,
-			      &error_message, &error_message_length);
+void BatchPatchHandler::decode_result(CassFuture* query_future,
+				      shared_ptr<Request> req){
+  try {
+    const CassResult* result = cass_future_get_result(query_future);
     cass_future_free(query_future);
-    throw runtime_error("Error: unable to execute query, " +
-			string(error_message));
+    if (req->in_list){
+      unique_ptr<const CassResult, decltype(&cass_result_free)>
+	res(result, cass_result_free);
+      rows2batch(result, req->offs, req->keys);
+    } else
+      get_img(result, req->offs[0], req->keys[0]);
+  } catch (...) {
+    set_error(current_exception());
   }
-  cass_future_free(query_future);
-  get_img(result, off);
+  {
+    lock_guard<mutex> lock(req_mtx);
+    --decoding;
+  }
+  req_cv.notify_all();
 }
 
-vector<CassFuture*> BatchPatchHandler::keys2futures(const vector<string>& keys){
-  vector<CassFuture*> futs;
-  futs.reserve(bs);
-  for(auto it=keys.begin(); it!=keys.end(); ++it){
-    string id = *it;
-    // prepare query
-    CassStatement* statement = cass_prepared_bind(prepared);
+void BatchPatchHandler::rows2batch(const CassResult* result,
+				   const vector<int>& offs,
+				   const vector<string>& keys){
+  // batch slots of each key
+  map<string, vector<int>> slots;
+  for(size_t i=0; i<keys.size(); ++i)
+    slots[keys[i]].push_back(offs[i]);
+  // decode rows straight from the driver buffers, scatter to slots
+  unique_ptr<CassIterator, decltype(&cass_iterator_free)>
+    it(cass_iterator_from_result(result), cass_iterator_free);
+  while (cass_iterator_next(it.get())) {
+    const CassRow* row = cass_iterator_get_row(it.get());
     CassUuid cuid;
-    cass_uuid_from_string(id.c_str(), &cuid);
-    cass_statement_bind_uuid_by_name(statement, id_col.c_str(), cuid);
-    CassFuture* query_future = cass_session_execute(session, statement);
-    cass_statement_free(statement);
-    futs.push_back(query_future);
+    cass_value_get_uuid(cass_row_get_column_by_name(row, id_col.c_str()),
+			&cuid);
+    char s_id[CASS_UUID_STRING_LENGTH];
+    cass_uuid_string(cuid, s_id);
+    auto sl = slots.find(s_id);
+    if (sl == slots.end())
+      continue;
+    cass_int32_t lab;
+    const cass_byte_t* data;
+    size_t sz;
+    row2data(row, lab, data, sz, s_id);
+    for(int off : sl->second)
+      data2batch(data, sz, lab, off);
+    slots.erase(sl);
   }
-  return(futs);
+  if (!slots.empty())
+    throw runtime_error("Error: query returned empty set for " +
+			slots.begin()->first);
 }
 
+void BatchPatchHandler::set_error(exception_ptr e){
+  // keep first error, do not send the remaining requests
+  {
+    lock_guard<mutex> lock(req_mtx);
+    if (!batch_error)
+      batch_error = e;
+    pending.clear();
+  }
+  req_cv.notify_all();
+}
+
+void BatchPatchHandler::hedge_loop(){
+  // duplicate requests slower than threshold
+  unique_lock<mutex> lock(req_mtx);
+  while (!stop_hedge){
+    auto wait = chrono::microseconds(10000);
+    auto now = chrono::steady_clock::now();
+    int64_t thr = hedge_thr_us;
+    vector<shared_ptr<Request>> late;
+    while (!hedge_q.empty()){
+      auto req = hedge_q.front();
+      if (req->done){
+	hedge_q.pop_front();
+	continue;
+      }
+      if (thr<0)
+	break;
+      auto due = req->t0 + chrono::microseconds(thr);
+      if (due>now){
+	wait = min(wait, chrono::duration_cast<chrono::microseconds>(due-now));
+	break;
+      }
+      hedge_q.pop_front();
+      late.push_back(req);
+    }
+    if (!late.empty()){
+      lock.unlock();
+      for(auto& req : late){
+	++n_hedged;
+	send(req, true);
+      }
+      lock.lock();
+      continue;
+    }
+    hedge_cv.wait_for(lock, max(wait, chrono::microseconds(500)));
+  }
+}
+
+void BatchPatchHandler::cached2img(string key, int off){
+  cass_int32_t lab;
+  vector<char> buf;
+  try {
+    if (cache->get(key, lab, buf))
+      data2batch(reinterpret_cast<const cass_byte_t*>(buf.data()), buf.size(),
+		 lab, off);
+    else { // evicted in the meanwhile, query Cassandra
+      auto req = make_shared<Request>();
+      req->offs = {off};
+      req->keys = {key};
+      {
+	lock_guard<mutex> lock(req_mtx);
+	if (!batch_error)
+	  pending.push_back(req);
+      }
+      issue_requests();
+    }
+  } catch (...) {
+    set_error(current_exception());
+  }
+  {
+    lock_guard<mutex> lock(req_mtx);
+    --decoding;
+  }
+  req_cv.notify_all();
+}
+
+void BatchPatchHandler::set_statement_opts(CassStatement* statement,
+					   const string& host){
+  // reads are idempotent: allow speculative executions
+  cass_statement_set_is_idempotent(statement, cass_true);
+  if (!host.empty())
+    cass_statement_set_host(statement, host.c_str(), port);
+}
+
+CassFuture* BatchPatchHandler::key2future(const string& key,
+					  const string& host){
+  // prepare query
+  CassStatement* statement = cass_prepared_bind(prepared);
+  CassUuid cuid;
+  cass_uuid_from_string(key.c_str(), &cuid);
+  cass_statement_bind_uuid_by_name(statement, id_col.c_str(), cuid);
+  set_statement_opts(statement, host);
+  CassFuture* query_future = cass_session_execute(session, statement);
+  cass_statement_free(statement);
+  return(query_future);
+}
+
+CassFuture* BatchPatchHandler::keys2future(const vector<string>& keys,
+					   const string& host){
+  // prepare query with IN list, sent to the node owning the keys
+  CassStatement* statement = cass_prepared_bind(prepared_in);
+  CassCollection* ids = cass_collection_new(CASS_COLLECTION_TYPE_LIST,
+					    keys.size());
+  for(auto& k : keys){
+    CassUuid cuid;
+    cass_uuid_from_string(k.c_str(), &cuid);
+    cass_collection_append_uuid(ids, cuid);
+  }
+  cass_statement_bind_collection(statement, 0, ids);
+  cass_collection_free(ids);
+  set_statement_opts(statement, host);
+  CassFuture* query_future = cass_session_execute(session, statement);
+  cass_statement_free(statement);
+  return(query_future);
+}
 
 void BatchPatchHandler::get_images(const vector<string>& keys){
-  vector<CassFuture*> futs = keys2futures(keys);
-  vector<future<void>> asys;
-  asys.reserve(bs);
+  vector<int> to_query;
   for(auto i=0; i!=bs; ++i){
-    // recover data and label
-    // future2img(futs[i], i);
-    // asys.push_back(async(launch::async, &BatchPatchHandler::future2img, this, futs[i], i));
-    asys.emplace_back(pool->enqueue(&BatchPatchHandler::future2img, this, futs[i], i));
+    // recover data and label, from local cache if available
+    if (cache && cache->contains(keys[i])){
+      {
+	lock_guard<mutex> lock(req_mtx);
+	++decoding;
+      }
+      pool->enqueue(&BatchPatchHandler::cached2img, this, keys[i], i);
+    } else
+      to_query.push_back(i);
+  }
+  // one request per key or, with multi_get, per node and chunk of keys
+  vector<shared_ptr<Request>> reqs;
+  if (multi_get>1){
+    for(auto& g : group_keys(keys, to_query)){
+      auto req = make_shared<Request>();
+      req->offs = g.second;
+      for(int off : g.second)
+	req->keys.push_back(keys[off]);
+      req->in_list = true;
+      req->host = g.first;
+      reqs.push_back(req);
+    }
+  } else {
+    for(int off : to_query){
+      auto req = make_shared<Request>();
+      req->offs = {off};
+      req->keys = {keys[off]};
+      reqs.push_back(req);
+    }
   }
-  // barrier
-  for(auto it=asys.begin(); it!=asys.end(); ++it){
-    it->wait();
+  {
+    lock_guard<mutex> lock(req_mtx);
+    pending.insert(pending.end(), reqs.begin(), reqs.end());
   }
+  issue_requests();
+  // wait for all the patches (or, after an error, for the work in flight)
+  unique_lock<mutex> lock(req_mtx);
+  req_cv.wait(lock, [this]{
+      return pending.empty() && inflight==0 && decoding==0;});
 }
 
-pair<unique_ptr<Tensor>, unique_ptr<Tensor>> BatchPatchHandler::load_batch(const vector<string>& keys){
+Batch BatchPatchHandler::load_batch(const vector<string>& keys){
+  ++n_loaded;
   bs = keys.size();
   init_batch = true;
+  batch_error = nullptr;
   // get images and assemble batch
   get_images(keys);
-  auto r = make_pair(move(t_feats), move(t_labs));
+  if (batch_error)
+    rethrow_exception(batch_error);
+  Batch r;
+  r.feats = move(t_feats);
+  r.u_feats = move(u_feats);
+  r.labs = move(t_labs);
   return(r);
 }
 
-void BatchPatchHandler::schedule_batch(const vector<py::object>& keys){
-  // convert uuids to strings
-  vector<string> ks;
-  ks.reserve(keys.size());
-  for(auto it=keys.begin(); it!=keys.end(); ++it){
-    string s = py::str(*it);
-    ks.push_back(s);
+void BatchPatchHandler::loader_loop(){
+  // load scheduled batches, one at a time
+  unique_lock<mutex> lock(q_mtx);
+  while (true){
+    q_cv.wait(lock, [this]{return stop_loader || !to_load.empty();});
+    if (stop_loader)
+      return;
+    auto job = move(to_load.front());
+    to_load.pop_front();
+    lock.unlock();
+    try {
+      job.second.set_value(load_batch(job.first));
+    } catch (...) {
+      job.second.set_exception(current_exception());
+    }
+    lock.lock();
+  }
+}
+
+void BatchPatchHandler::schedule_batch(vector<string> keys){
+  promise<Batch> p;
+  {
+    lock_guard<mutex> lock(q_mtx);
+    if (batches.size() >= (size_t)queue_depth)
+      throw runtime_error("Error: batch queue full, get a batch first");
+    batches.push_back(p.get_future());
+    to_load.emplace_back(move(keys), move(p));
+  }
+  q_cv.notify_one();
+}
+
+void BatchPatchHandler::schedule_batch(const uint8_t* raw, size_t n){
+  // raw uuids to their string form, as used for queries and cache
+  static const char hex[] = "0123456789abcdef";
+  vector<string> keys(n);
+  for(size_t i=0; i<n; ++i){
+    const uint8_t* b = raw + 16*i;
+    string& k = keys[i];
+    k.reserve(36);
+    for(int j=0; j<16; ++j){
+      if (j==4 || j==6 || j==8 || j==10)
+	k.push_back('-');
+      k.push_back(hex[b[j]>>4]);
+      k.push_back(hex[b[j]&15]);
+    }
+  }
+  schedule_batch(move(keys));
+}
+
+Batch BatchPatchHandler::pop_batch(){
+  // oldest scheduled batch, waiting for it if needed
+  future<Batch> f;
+  {
+    lock_guard<mutex> lock(q_mtx);
+    if (batches.empty())
+      throw runtime_error("Error: no batch scheduled");
+    f = move(batches.front());
+    batches.pop_front();
+  }
+  return(f.get());
+}
+
+bool BatchPatchHandler::batch_ready(){
+  lock_guard<mutex> lock(q_mtx);
+  return(!batches.empty() && batches.front().wait_for(chrono::seconds(0))
+	 == future_status::ready);
+}
+
+SharedBatch BatchPatchHandler::block_get_shared(){
+  auto b = pop_batch();
+  // with the ring, buffers go back to it when Python releases them
+  SharedBatch r;
+  if (batch_ring){
+    if (out_uint8)
+      r.u_feats = batch_ring->share_u_feats(move(b.u_feats));
+    else
+      r.feats = batch_ring->share_feats(move(b.feats));
+    r.labs = batch_ring->share_labs(move(b.labs));
+  } else {
+    r.feats = move(b.feats);
+    r.u_feats = move(b.u_feats);
+    r.labs = move(b.labs);
   }
-  batch = async(launch::async, &BatchPatchHandler::load_batch, this, ks);
-  // t_batch = load_batch(ks);
+  return(r);
 }
 
 pair<shared_ptr<Tensor>, shared_ptr<Tensor>> BatchPatchHandler::block_get_batch(){
-  auto b = batch.get();
-  auto r = make_pair(shared_ptr<Tensor>(move(b.first)),
-		     shared_ptr<Tensor>(move(b.second)));
+  if (out_uint8)
+    throw runtime_error("Error: uint8 output, use block_get_batch_numpy");
+  auto b = block_get_shared();
+  return(make_pair(b.feats, b.labs));
+}
+
+// numpy array viewing memory owned by a shared_ptr: the capsule keeps a
+// copy of the pointer, so the memory lives as long as the array (and
+// its views), then goes back to its owner (e.g., the ring)
+template<class T, class O>
+static py::array_t<T> shared2numpy(const shared_ptr<O>& own, T* data,
+				   vector<py::ssize_t> shape){
+  py::capsule caps(new shared_ptr<O>(own), [](void* p){
+      delete reinterpret_cast<shared_ptr<O>*>(p);});
+  return(py::array_t<T>(shape, data, caps));
+}
+
+pair<py::array, py::array_t<float>> BatchPatchHandler::batch2numpy(const SharedBatch& b){
+  // zero-copy: features as NCHW uint8 or float, labels as float
+  py::ssize_t b_bs = b.labs->shape[0];
+  vector<py::ssize_t> f_shape = {b_bs, chan, height, width};
+  py::array feats;
+  if (out_uint8)
+    feats = shared2numpy(b.u_feats, b.u_feats->data(), f_shape);
+  else
+    feats = shared2numpy(b.feats, b.feats->ptr, f_shape);
+  auto labs = shared2numpy(b.labs, b.labs->ptr, {b_bs, num_classes});
+  return(make_pair(feats, labs));
+}
+
+map<string, uint64_t> BatchPatchHandler::cache_stats(){
+  if (cache)
+    return(cache->stats());
+  map<string, uint64_t> r = {{"hits", 0}, {"misses", 0}, {"evictions", 0}};
+  return(r);
+}
+
+map<string, int64_t> BatchPatchHandler::hedge_stats(){
+  map<string, int64_t> r = {{"requests", n_req}, {"hedged", n_hedged},
+			    {"hedge_wins", n_hedge_wins},
+			    {"threshold_us", hedge_thr_us}};
   return(r);
 }
 
+map<string, uint64_t> BatchPatchHandler::ring_stats(){
+  if (batch_ring)
+    return(batch_ring->stats());
+  map<string, uint64_t> r = {{"reused", 0}, {"allocated", 0}};
+  return(r);
+}
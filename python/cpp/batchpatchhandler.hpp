@@ -7,6 +7,15 @@
 #include <future>
 #include <utility>
 #include <mutex>
+#include <optional>
+#include <map>
+#include <atomic>
+#include <functional>
+#include <deque>
+#include <thread>
+#include <chrono>
+#include <condition_variable>
+#include <exception>
 #include <opencv2/core.hpp>
 #include <eddl/tensor/tensor.h>
 #include <ecvl/core.h>
@@ -16,9 +25,53 @@ using namespace std;
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 namespace py = pybind11;
 
 #include "ThreadPool.hpp"
+#include "blobcache.hpp"
+#include "sessionregistry.hpp"
+#include "batchring.hpp"
+#include "batchkernels.hpp"
+#include "aimdlimit.hpp"
+
+// tuning of the Cassandra driver, defaults as in the driver
+struct DriverOptions{
+  int io_threads = 1; // threads handling the connections
+  int connections_per_host = 1;
+  int queue_size_io = 8192; // requests queued per io thread
+  bool token_aware = true; // route to a replica of the key
+  bool latency_aware = false; // prefer hosts with lower latency
+  // send the query to another host if no answer after the delay
+  int64_t speculative_delay_ms = -1; // negative: disabled
+  int speculative_max = 1; // additional executions
+};
+
+// request to Cassandra, for one or more (IN list) patches
+struct Request{
+  vector<int> offs; // batch slots
+  vector<string> keys;
+  bool in_list = false;
+  string host; // owner node, if known
+  chrono::steady_clock::time_point t0;
+  int attempts = 0; // in flight, including the hedged one
+  bool done = false; // first answer arrived
+};
+
+// assembled batch: features either as float tensor or as uint8 buffer
+struct Batch{
+  unique_ptr<Tensor> feats;
+  unique_ptr<vector<uint8_t>> u_feats;
+  unique_ptr<Tensor> labs;
+};
+
+
+// retrieved batch, buffers shared with Python (and with the ring)
+struct SharedBatch{
+  shared_ptr<Tensor> feats;
+  shared_ptr<vector<uint8_t>> u_feats;
+  shared_ptr<Tensor> labs;
+};
 
 
 class BatchPatchHandler{
@@ -28,6 +81,14 @@ private:
   static const int _max_multilabs = 32;
   bool multi_label;
   ecvl::Augmentation* aug = NULL;
+  // per-worker clones of aug
+  static atomic<uint64_t> n_handlers;
+  const uint64_t uid = n_handlers++; // tells clones of different handlers
+  // ECVL draws from one process-wide engine: with aug_seed, augmentations
+  // are applied one at a time, reseeding the engine for each patch
+  optional<uint32_t> aug_seed;
+  static mutex aug_mtx;
+  uint64_t n_loaded = 0; // batches loaded, for the per-patch seeds
   string table;
   string label_col;
   string data_col;
@@ -37,10 +98,52 @@ private:
   vector<string> cassandra_ips;
   string s_cassandra_ips;
   int port = 9042;
+  float decode_scale = 1.0;
+  int imread_flag; // opencv flag for (reduced size) decoding
+  // output type and normalization: x*ch_scale[c] + ch_off[c]
+  float norm_scale = 1.0;
+  vector<float> norm_mean;
+  vector<float> norm_std;
+  vector<float> ch_scale;
+  vector<float> ch_off;
+  // conversion kernels, best isa of the cpu
+  const BatchKernels& kern = batch_kernels();
   // Cassandra connection and execution
-  CassCluster* cluster = cass_cluster_new();
-  CassSession* session = cass_session_new();
+  DriverOptions driver_opts;
+  shared_ptr<SharedSession> conn;
+  CassSession* session = NULL; // of conn
   const CassPrepared* prepared;
+  // multi-partition requests: IN query and token ring of the cluster
+  int multi_get = 1;
+  const CassPrepared* prepared_in = NULL;
+  map<int64_t, string> ring; // node token -> node address
+  // hedged requests: duplicate requests slower than the hedge_pct
+  // percentile of recent latencies
+  optional<float> hedge_pct;
+  mutex hedge_mtx;
+  vector<int64_t> lats; // recent latencies (us), circular buffer
+  uint64_t n_lats = 0;
+  atomic<int64_t> hedge_thr_us{-1}; // -1 until enough samples
+  atomic<uint64_t> n_req{0};
+  atomic<uint64_t> n_hedged{0};
+  atomic<uint64_t> n_hedge_wins{0};
+  thread hedge_thread;
+  condition_variable hedge_cv;
+  bool stop_hedge = false;
+  deque<shared_ptr<Request>> hedge_q; // requests by issue time
+  // requests: sent as driver futures, completed by callbacks which
+  // hand the results to the decoding pool
+  int max_inflight = 64;
+  unique_ptr<AIMDLimit> limiter; // adaptive limit, if bounds given
+  mutex req_mtx;
+  condition_variable req_cv;
+  deque<shared_ptr<Request>> pending; // to be sent
+  int inflight = 0; // requests without answer yet
+  int decoding = 0; // decoding tasks queued or running
+  int attempts = 0; // driver futures with callback still to run
+  exception_ptr batch_error;
+  // optional local cache of blobs
+  unique_ptr<BlobCache> cache;
   // concurrency
   ThreadPool* pool;
   mutex mtx;
@@ -51,29 +154,88 @@ private:
   int height = -1;
   int width;
   int tot_dims;
-  // current batch
-  future<pair<unique_ptr<Tensor>, unique_ptr<Tensor>>> batch;
-  pair<unique_ptr<Tensor>, unique_ptr<Tensor>> t_batch; // test
+  // preallocated batch buffers, given back when released by Python
+  int ring_size = 0;
+  shared_ptr<BatchRing> batch_ring;
+  // scheduled batches, loaded in FIFO order by the loader thread
+  int queue_depth = 1;
+  mutex q_mtx;
+  condition_variable q_cv;
+  deque<pair<vector<string>, promise<Batch>>> to_load;
+  deque<future<Batch>> batches; // scheduled and not yet retrieved
+  bool stop_loader = false;
+  thread loader;
+  // batch being loaded
   unique_ptr<Tensor> t_feats;
+  unique_ptr<vector<uint8_t>> u_feats;
   unique_ptr<Tensor> t_labs;
   // methods
   void connect();
+  void setup_cluster(CassCluster* cluster);
+  void set_statement_opts(CassStatement* statement, const string& host);
+  const CassPrepared* prepare(const string& query);
+  void load_ring();
+  string key2host(const string& key);
+  void add_latency(int64_t us);
+  vector<pair<string, vector<int>>> group_keys(const vector<string>& keys,
+					       const vector<int>& offs);
+  void set_norm();
   vector<char> file2buf(string filename);
-  ecvl::Image buf2img(const vector<char>& buf);
-  cv::Mat buf2mat(const vector<char>& buf);
-  void get_img(const CassResult* result, int off);
+  void get_img(const CassResult* result, int off, const string& key);
+  void row2data(const CassRow* row, cass_int32_t& lab,
+		const cass_byte_t*& data, size_t& sz, const string& key);
+  ecvl::Augmentation* thread_aug();
+  void data2batch(const cass_byte_t* data, size_t sz, cass_int32_t lab,
+		  int off);
+  void init_batch_dims(int c, int h, int w);
+  void chw2batch(const uint8_t* p_im, int off);
+  void hwc2batch(const cv::Mat& m, int off);
+  void lab2batch(cass_int32_t lab, int off);
   void get_images(const vector<string>& keys);
-  vector<CassFuture*> keys2futures(const vector<string>& keys);
-  void future2img(CassFuture* query_future, int off);
+  CassFuture* key2future(const string& key, const string& host="");
+  CassFuture* keys2future(const vector<string>& keys, const string& host);
+  int cur_limit();
+  void issue_requests();
+  void send(shared_ptr<Request> req, bool hedge);
+  static void on_result(CassFuture* query_future, void* data);
+  void handle_result(CassFuture* query_future, shared_ptr<Request> req,
+		     bool hedge);
+  void decode_result(CassFuture* query_future, shared_ptr<Request> req);
+  void rows2batch(const CassResult* result, const vector<int>& offs,
+		  const vector<string>& keys);
+  void set_error(exception_ptr e);
+  void hedge_loop();
+  void cached2img(string key, int off);
+  void loader_loop();
+  Batch pop_batch();
 public:
   BatchPatchHandler(int num_classes, ecvl::Augmentation* aug, string table,
 		    string label_col, string data_col, string id_col,
 		    string username, string cass_pass,
-		    vector<string> cassandra_ips, int thread_par=32, int port=9042);
+		    vector<string> cassandra_ips, int thread_par=0, int port=9042,
+		    float decode_scale=1.0, float norm_scale=1.0,
+		    optional<vector<float>> norm_mean={},
+		    optional<vector<float>> norm_std={}, bool out_uint8=false,
+		    optional<string> cache_dir={},
+		    uint64_t cache_bytes=10ull<<30, int multi_get=1,
+		    optional<float> hedge_pct={}, int max_inflight=64,
+		    int ring_size=0, optional<vector<int>> batch_shape={},
+		    int queue_depth=1, optional<uint32_t> aug_seed={},
+		    optional<DriverOptions> driver_opts={},
+		    optional<pair<int, int>> inflight_bounds={});
   ~BatchPatchHandler();
-  void schedule_batch(const vector<py::object>& keys);
-  pair<unique_ptr<Tensor>, unique_ptr<Tensor>> load_batch(const vector<string>& keys);
+  const bool out_uint8;
+  void schedule_batch(vector<string> keys);
+  void schedule_batch(const uint8_t* raw, size_t n); // raw 16-byte keys
+  Batch load_batch(const vector<string>& keys);
+  bool batch_ready();
+  SharedBatch block_get_shared();
   pair<shared_ptr<Tensor>, shared_ptr<Tensor>> block_get_batch();
+  pair<py::array, py::array_t<float>> batch2numpy(const SharedBatch& b);
+  map<string, uint64_t> cache_stats();
+  map<string, int64_t> hedge_stats();
+  int inflight_limit();
+  map<string, uint64_t> ring_stats();
 };
 
 #endif
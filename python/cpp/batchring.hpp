@@ -0,0 +1,130 @@
+#ifndef BATCHRING_H
+#define BATCHRING_H
+
+#include <vector>
+#include <memory>
+#include <mutex>
+#include <atomic>
+#include <cstdint>
+#include <map>
+#include <string>
+#include <eddl/tensor/tensor.h>
+using namespace std;
+
+// Ring of batch buffers (features, as float Tensor or uint8 vector, and
+// labels), reused across batches instead of allocating new ones.
+//
+// Buffers are handed out as shared_ptrs whose deleter puts them back in
+// the ring when the last reference is dropped, i.e., when Python releases
+// the returned Tensor or numpy array. A buffer is never reused while any
+// reference to it is alive; once released, its memory can back a later
+// batch. Up to k buffers per kind are kept; buffers of a different shape
+// (e.g., the last, smaller batch of a split) are allocated and freed as
+// usual. If the ring is destroyed first, released buffers are just freed.
+class BatchRing : public enable_shared_from_this<BatchRing>{
+private:
+  size_t k;
+  vector<int> shape; // {bs, chan, height, width}
+  int num_classes;
+  mutex mtx;
+  vector<unique_ptr<Tensor>> f_free;
+  vector<unique_ptr<vector<uint8_t>>> u_free;
+  vector<unique_ptr<Tensor>> l_free;
+  atomic<uint64_t> reused{0};
+  atomic<uint64_t> allocated{0};
+  template<class T>
+  unique_ptr<T> take(vector<unique_ptr<T>>& fl){
+    lock_guard<mutex> lock(mtx);
+    if (fl.empty())
+      return(nullptr);
+    auto r = move(fl.back());
+    fl.pop_back();
+    ++reused;
+    return(r);
+  }
+  template<class T>
+  shared_ptr<T> share(unique_ptr<T> p, vector<unique_ptr<T>> BatchRing::* fl,
+		      bool fits){
+    if (!fits)
+      return(shared_ptr<T>(move(p)));
+    weak_ptr<BatchRing> w = shared_from_this();
+    return(shared_ptr<T>(p.release(), [w, fl](T* q){
+	  auto ring = w.lock();
+	  if (ring){
+	    lock_guard<mutex> lock(ring->mtx);
+	    auto& v = (*ring).*fl;
+	    if (v.size() < ring->k){
+	      v.emplace_back(q);
+	      return;
+	    }
+	  }
+	  delete q;
+	}));
+  }
+public:
+  BatchRing(size_t k, vector<int> shape, int num_classes) :
+    k(k), shape(shape), num_classes(num_classes) {}
+  const vector<int>& batch_shape(){return(shape);}
+  size_t feats_size(){return(shape[0]*shape[1]*shape[2]*shape[3]);}
+  // preallocate k buffers per kind
+  void fill(bool u8){
+    for(size_t i=0; i<k; ++i){
+      if (u8)
+	u_free.emplace_back(new vector<uint8_t>(feats_size()));
+      else
+	f_free.emplace_back(new Tensor(shape));
+      l_free.emplace_back(new Tensor({shape[0], num_classes}));
+    }
+    allocated += 2*k;
+  }
+  // buffers for a batch of bs patches
+  unique_ptr<Tensor> get_feats(int bs){
+    unique_ptr<Tensor> r;
+    if (bs==shape[0])
+      r = take(f_free);
+    if (!r){
+      ++allocated;
+      r.reset(new Tensor({bs, shape[1], shape[2], shape[3]}));
+    }
+    return(r);
+  }
+  unique_ptr<vector<uint8_t>> get_u_feats(int bs){
+    unique_ptr<vector<uint8_t>> r;
+    if (bs==shape[0])
+      r = take(u_free);
+    if (!r){
+      ++allocated;
+      r.reset(new vector<uint8_t>(bs*feats_size()/shape[0]));
+    }
+    return(r);
+  }
+  unique_ptr<Tensor> get_labs(int bs){
+    unique_ptr<Tensor> r;
+    if (bs==shape[0])
+      r = take(l_free);
+    if (!r){
+      ++allocated;
+      r.reset(new Tensor({bs, num_classes}));
+    }
+    return(r);
+  }
+  // shared owners, giving the buffers back when released
+  shared_ptr<Tensor> share_feats(unique_ptr<Tensor> p){
+    bool fits = (p->shape[0]==shape[0]);
+    return(share(move(p), &BatchRing::f_free, fits));
+  }
+  shared_ptr<vector<uint8_t>> share_u_feats(unique_ptr<vector<uint8_t>> p){
+    bool fits = (p->size()==feats_size());
+    return(share(move(p), &BatchRing::u_free, fits));
+  }
+  shared_ptr<Tensor> share_labs(unique_ptr<Tensor> p){
+    bool fits = (p->shape[0]==shape[0]);
+    return(share(move(p), &BatchRing::l_free, fits));
+  }
+  map<string, uint64_t> stats(){
+    map<string, uint64_t> r = {{"reused", reused}, {"allocated", allocated}};
+    return(r);
+  }
+};
+
+#endif
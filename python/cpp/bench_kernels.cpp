@@ -0,0 +1,57 @@
+// Micro-benchmark of the batch assembly kernels: one batch of patches
+// (default 256 x 3 x 256 x 256) converted and labeled, for each
+// supported isa.
+//   ./bench_kernels [batch_size] [side] [reps]
+#include <iostream>
+#include <vector>
+#include <random>
+#include <chrono>
+#include <string>
+
+#include "batchkernels.hpp"
+using namespace std;
+
+int main(int argc, char* argv[]){
+  int bs = (argc>1) ? stoi(argv[1]) : 256;
+  int side = (argc>2) ? stoi(argv[2]) : 256;
+  int reps = (argc>3) ? stoi(argv[3]) : 5;
+  const int c = 3;
+  const int num_classes = 2;
+  size_t tot_dims = c*side*side;
+  mt19937 rng(42);
+  uniform_int_distribution<int> byte(0, 255);
+  vector<uint8_t> img(tot_dims);
+  for(auto& v : img)
+    v = byte(rng);
+  vector<float> feats(bs*tot_dims);
+  vector<float> labs(bs*num_classes);
+  float scale[c] = {1/(255*0.229f), 1/(255*0.224f), 1/(255*0.225f)};
+  float off[c] = {-0.485f/0.229f, -0.456f/0.224f, -0.406f/0.225f};
+  cout << "isa\tkernel\tms/batch\tpatches/s" << endl;
+  for(auto isa : {KernelIsa::scalar, KernelIsa::sse41, KernelIsa::avx2}){
+    if (!kernel_isa_supported(isa))
+      continue;
+    const BatchKernels& k = batch_kernels(isa);
+    for(string kern : {"hwc2chw", "chw2chw", "labels"}){
+      double best = 1e30;
+      for(int r=0; r<reps; ++r){
+	auto t0 = chrono::steady_clock::now();
+	for(int b=0; b<bs; ++b){
+	  float* p = feats.data() + b*tot_dims;
+	  if (kern=="hwc2chw")
+	    k.hwc2chw(img.data(), side*c, p, side, side, c, scale, off);
+	  else if (kern=="chw2chw")
+	    k.chw2chw(img.data(), p, side*side, c, scale, off);
+	  else
+	    k.one_hot(b%num_classes, labs.data() + b*num_classes,
+		      num_classes);
+	}
+	chrono::duration<double, milli> dt = chrono::steady_clock::now() - t0;
+	best = min(best, dt.count());
+      }
+      cout << kernel_isa_name(isa) << "\t" << kern << "\t" << best << "\t"
+	   << bs/best*1000 << endl;
+    }
+  }
+  return(0);
+}
@@ -0,0 +1,168 @@
+#include "blobcache.hpp"
+
+#include <fstream>
+#include <sstream>
+#include <filesystem>
+#include <algorithm>
+#include <thread>
+#include <tuple>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/file.h>
+namespace fs = std::filesystem;
+
+BlobCache::BlobCache(string path, uint64_t max_bytes) :
+  path(path), max_bytes(max_bytes)
+{
+  fs::create_directories(path);
+  // check budget at startup
+  start_eviction();
+}
+
+BlobCache::~BlobCache(){
+  // interrupt and wait for the eviction in progress, if any
+  stopping = true;
+  lock_guard<mutex> lock(evict_mtx);
+  if (evict_thr.joinable())
+    evict_thr.join();
+}
+
+string BlobCache::key2path(const string& key){
+  // uuid as 32 hex digits
+  string h;
+  h.reserve(32);
+  for(char c : key)
+    if (c!='-')
+      h.push_back(c);
+  return(path + "/" + h.substr(0, 2) + "/" + h);
+}
+
+bool BlobCache::contains(const string& key){
+  error_code ec;
+  if (fs::exists(key2path(key), ec))
+    return(true);
+  // counted here, since get() is not called for keys not in the cache
+  ++misses;
+  return(false);
+}
+
+bool BlobCache::get(const string& key, int32_t& lab, vector<char>& buf){
+  string fn = key2path(key);
+  ifstream file(fn, ios::binary | ios::ate);
+  streamsize size = file.tellg();
+  if (!file || size<4){ // not cached or just evicted
+    ++misses;
+    return(false);
+  }
+  file.seekg(0, ios::beg);
+  char b_lab[4];
+  buf.resize(size-4);
+  if (!file.read(b_lab, 4) || !file.read(buf.data(), size-4)){
+    ++misses;
+    return(false);
+  }
+  lab = (int32_t)((uint8_t)b_lab[0] | (uint8_t)b_lab[1]<<8 |
+		  (uint8_t)b_lab[2]<<16 | (uint32_t)(uint8_t)b_lab[3]<<24);
+  // refresh for LRU
+  error_code ec;
+  fs::last_write_time(fn, fs::file_time_type::clock::now(), ec);
+  ++hits;
+  return(true);
+}
+
+void BlobCache::put(const string& key, int32_t lab, const uint8_t* data,
+		    size_t sz){
+  string fn = key2path(key);
+  fs::path dir = fs::path(fn).parent_path();
+  stringstream ss;
+  ss << dir.string() << "/." << fs::path(fn).filename().string() << "."
+     << getpid() << "." << this_thread::get_id() << ".tmp";
+  string tmp = ss.str();
+  error_code ec;
+  fs::create_directories(dir, ec);
+  {
+    ofstream file(tmp, ios::binary);
+    uint32_t ul = (uint32_t)lab;
+    char b_lab[4] = {(char)(ul & 0xff), (char)((ul>>8) & 0xff),
+		     (char)((ul>>16) & 0xff), (char)((ul>>24) & 0xff)};
+    file.write(b_lab, 4);
+    file.write(reinterpret_cast<const char*>(data), sz);
+    if (!file){ // e.g., disk full, the cache is best effort
+      file.close();
+      fs::remove(tmp, ec);
+      return;
+    }
+  }
+  fs::rename(tmp, fn, ec); // atomic
+  if (ec){
+    fs::remove(tmp, ec);
+    return;
+  }
+  if ((added += sz+4) > max_bytes/16)
+    start_eviction();
+}
+
+void BlobCache::start_eviction(){
+  // scan and evict in the background, one thread per process
+  lock_guard<mutex> lock(evict_mtx);
+  if (evicting || stopping)
+    return;
+  if (evict_thr.joinable()) // previous eviction, done
+    evict_thr.join();
+  evicting = true;
+  added = 0;
+  evict_thr = thread([this](){
+    evict();
+    evicting = false;
+  });
+}
+
+void BlobCache::evict(double low_water){
+  // one evicting process per host
+  int fd = open((path + "/.lock").c_str(), O_CREAT | O_RDWR, 0644);
+  if (fd<0 || flock(fd, LOCK_EX | LOCK_NB)!=0){
+    if (fd>=0)
+      close(fd);
+    return;
+  }
+  vector<tuple<fs::file_time_type, uint64_t, fs::path>> entries;
+  uint64_t tot = 0;
+  error_code ec;
+  for(auto& d : fs::directory_iterator(path, ec)){
+    if (stopping)
+      break;
+    if (!d.is_directory(ec))
+      continue;
+    for(auto& e : fs::directory_iterator(d.path(), ec)){
+      auto mt = e.last_write_time(ec);
+      if (ec)
+	continue;
+      uint64_t sz = e.file_size(ec);
+      if (ec)
+	continue;
+      entries.emplace_back(mt, sz, e.path());
+      tot += sz;
+    }
+  }
+  if (tot > max_bytes && !stopping){
+    sort(entries.begin(), entries.end());
+    for(auto& en : entries){
+      if (tot <= low_water*max_bytes || stopping)
+	break;
+      if (fs::remove(std::get<2>(en), ec)){
+	tot -= std::get<1>(en);
+	++evictions;
+      }
+    }
+  }
+  flock(fd, LOCK_UN);
+  close(fd);
+}
+
+map<string, uint64_t> BlobCache::stats(){
+  map<string, uint64_t> r;
+  r["hits"] = hits;
+  r["misses"] = misses;
+  r["evictions"] = evictions;
+  return(r);
+}
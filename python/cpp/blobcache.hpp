@@ -0,0 +1,43 @@
+#ifndef BLOBCACHE_H
+#define BLOBCACHE_H
+
+#include <string>
+#include <vector>
+#include <map>
+#include <atomic>
+#include <thread>
+#include <mutex>
+#include <cstdint>
+using namespace std;
+
+// Local disk cache of patch blobs, shared by processes on the same host.
+// Same layout as the Python BlobCache: <path>/<hex[:2]>/<hex>, each file
+// holding the label as little-endian int32 followed by the raw blob.
+// Files are written to a temporary name and atomically renamed, hits
+// refresh the mtime and eviction removes the least recently used files,
+// scanning the directory in a background thread.
+class BlobCache{
+private:
+  string path;
+  uint64_t max_bytes;
+  atomic<uint64_t> added{0}; // bytes written since last eviction
+  atomic<bool> evicting{false};
+  atomic<bool> stopping{false}; // cache going away, stop evicting
+  thread evict_thr; // background scan and eviction
+  mutex evict_mtx; // protects evict_thr
+  atomic<uint64_t> hits{0};
+  atomic<uint64_t> misses{0};
+  atomic<uint64_t> evictions{0};
+  string key2path(const string& key);
+  void start_eviction();
+public:
+  BlobCache(string path, uint64_t max_bytes);
+  ~BlobCache();
+  bool contains(const string& key); // counts misses, get() the hits
+  bool get(const string& key, int32_t& lab, vector<char>& buf);
+  void put(const string& key, int32_t lab, const uint8_t* data, size_t sz);
+  void evict(double low_water=0.9);
+  map<string, uint64_t> stats();
+};
+
+#endif
@@ -5,9 +5,81 @@ using namespace pybind11::literals;
 
 #include "batchpatchhandler.hpp"
 
+// wait for the next batch without holding the GIL
+static SharedBatch get_shared(BatchPatchHandler& h){
+  py::gil_scoped_release release;
+  return(h.block_get_shared());
+}
+
 PYBIND11_MODULE(BPH, m) {
+  // free the shared Cassandra sessions no handler is using
+  m.def("close_sessions", &SessionRegistry::close_idle,
+	py::call_guard<py::gil_scoped_release>());
+  py::class_<DriverOptions>(m, "DriverOptions")
+    .def(py::init<>())
+    .def_readwrite("io_threads", &DriverOptions::io_threads)
+    .def_readwrite("connections_per_host",
+		   &DriverOptions::connections_per_host)
+    .def_readwrite("queue_size_io", &DriverOptions::queue_size_io)
+    .def_readwrite("token_aware", &DriverOptions::token_aware)
+    .def_readwrite("latency_aware", &DriverOptions::latency_aware)
+    .def_readwrite("speculative_delay_ms",
+		   &DriverOptions::speculative_delay_ms)
+    .def_readwrite("speculative_max", &DriverOptions::speculative_max);
   py::class_<BatchPatchHandler>(m, "BatchPatchHandler")
-    .def(py::init<int, ecvl::Augmentation*, string, string, string, string, string, string, vector<string>, int, int >(), "num_classes"_a, "aug"_a, "table"_a, "label_col"_a, "data_col"_a, "id_col"_a, "username"_a, "cass_pass"_a, "cassandra_ips"_a, "thread_par"_a=32, "port"_a=9042)
-    .def("schedule_batch", &BatchPatchHandler::schedule_batch, "keys"_a)
-    .def("block_get_batch", &BatchPatchHandler::block_get_batch);
+    .def(py::init<int, ecvl::Augmentation*, string, string, string, string, string, string, vector<string>, int, int, float, float, optional<vector<float>>, optional<vector<float>>, bool, optional<string>, uint64_t, int, optional<float>, int, int, optional<vector<int>>, int, optional<uint32_t>, optional<DriverOptions>, optional<pair<int, int>> >(), "num_classes"_a, "aug"_a, "table"_a, "label_col"_a, "data_col"_a, "id_col"_a, "username"_a, "cass_pass"_a, "cassandra_ips"_a, "thread_par"_a=0, "port"_a=9042, "decode_scale"_a=1.0, "norm_scale"_a=1.0, "norm_mean"_a=py::none(), "norm_std"_a=py::none(), "out_uint8"_a=false, "cache_dir"_a=py::none(), "cache_bytes"_a=10ull<<30, "multi_get"_a=1, "hedge_pct"_a=py::none(), "max_inflight"_a=64, "ring_size"_a=0, "batch_shape"_a=py::none(), "queue_depth"_a=1, "aug_seed"_a=py::none(), "driver_opts"_a=py::none(), "inflight_bounds"_a=py::none(),
+	 // the handler keeps a bare pointer to aug
+	 py::keep_alive<1, 3>(),
+	 py::call_guard<py::gil_scoped_release>())
+    // raw 16-byte keys, as (N,16) uint8 array, read without the GIL
+    .def("schedule_batch", [](BatchPatchHandler& h,
+			      py::array_t<uint8_t, py::array::c_style> keys){
+	if (keys.ndim()!=2 || keys.shape(1)!=16)
+	  throw invalid_argument("Error: raw keys must be shaped (N,16)");
+	py::gil_scoped_release release;
+	h.schedule_batch(keys.data(), keys.shape(0));
+      }, "keys"_a.noconvert())
+    // keys converted to strings with the GIL, queued without it
+    .def("schedule_batch", [](BatchPatchHandler& h,
+			      const vector<py::object>& keys){
+	vector<string> ks;
+	ks.reserve(keys.size());
+	for(auto& k : keys)
+	  ks.push_back(py::str(k));
+	py::gil_scoped_release release;
+	h.schedule_batch(move(ks));
+      }, "keys"_a)
+    // (Tensor, Tensor) or, with out_uint8, (uint8 array, float array)
+    .def("block_get_batch", [](BatchPatchHandler& h) -> py::object {
+	auto b = get_shared(h);
+	if (h.out_uint8)
+	  return py::cast(h.batch2numpy(b));
+	return py::cast(make_pair(b.feats, b.labs));
+      })
+    // oldest batch if already loaded, None otherwise
+    .def("try_get_batch", [](BatchPatchHandler& h) -> py::object {
+	bool ready;
+	{
+	  py::gil_scoped_release release;
+	  ready = h.batch_ready();
+	}
+	if (!ready)
+	  return py::none();
+	auto b = get_shared(h);
+	if (h.out_uint8)
+	  return py::cast(h.batch2numpy(b));
+	return py::cast(make_pair(b.feats, b.labs));
+      })
+    // (features, labels) as numpy arrays viewing the batch memory
+    .def("block_get_batch_numpy", [](BatchPatchHandler& h) {
+	return h.batch2numpy(get_shared(h));
+      })
+    .def("cache_stats", &BatchPatchHandler::cache_stats,
+	 py::call_guard<py::gil_scoped_release>())
+    .def("hedge_stats", &BatchPatchHandler::hedge_stats,
+	 py::call_guard<py::gil_scoped_release>())
+    .def("ring_stats", &BatchPatchHandler::ring_stats,
+	 py::call_guard<py::gil_scoped_release>())
+    .def("inflight_limit", &BatchPatchHandler::inflight_limit,
+	 py::call_guard<py::gil_scoped_release>());
 }
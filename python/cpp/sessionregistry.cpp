@@ -0,0 +1,80 @@
+#include "sessionregistry.hpp"
+
+#include <cstdio>
+#include <stdexcept>
+#include <vector>
+
+SharedSession::SharedSession(const function<void(CassCluster*)>& setup){
+  cluster = cass_cluster_new();
+  session = cass_session_new();
+  try {
+    setup(cluster);
+  } catch (...) {
+    cass_session_free(session);
+    cass_cluster_free(cluster);
+    throw;
+  }
+  CassFuture* connect_future = cass_session_connect(session, cluster);
+  CassError rc = cass_future_error_code(connect_future);
+  cass_future_free(connect_future);
+  if (rc == CASS_OK) {
+    printf("Successfully connected!\n");
+  } else {
+    cass_session_free(session);
+    cass_cluster_free(cluster);
+    throw runtime_error("Error: unable to connect to Cassandra DB. ");
+  }
+}
+
+SharedSession::~SharedSession(){
+  for(auto& p : prepared)
+    cass_prepared_free(p.second);
+  cass_session_free(session);
+  cass_cluster_free(cluster);
+}
+
+const CassPrepared* SharedSession::prepare(const string& query){
+  lock_guard<mutex> lock(mtx);
+  auto it = prepared.find(query);
+  if (it != prepared.end())
+    return(it->second);
+  CassFuture* prepare_future = cass_session_prepare(session, query.c_str());
+  const CassPrepared* prep = cass_future_get_prepared(prepare_future);
+  cass_future_free(prepare_future);
+  if (prep == NULL) {
+    /* Handle error */
+    throw runtime_error("Error in query: " + query);
+  }
+  prepared[query] = prep;
+  return(prep);
+}
+
+mutex SessionRegistry::mtx;
+map<string, shared_ptr<SharedSession>> SessionRegistry::sessions;
+
+shared_ptr<SharedSession> SessionRegistry::get(const string& key,
+					       const function<void(CassCluster*)>& setup){
+  lock_guard<mutex> lock(mtx);
+  auto it = sessions.find(key);
+  if (it != sessions.end())
+    return(it->second);
+  auto s = make_shared<SharedSession>(setup);
+  sessions[key] = s;
+  return(s);
+}
+
+void SessionRegistry::close_idle(){
+  // sessions referenced only by the registry
+  vector<shared_ptr<SharedSession>> idle;
+  {
+    lock_guard<mutex> lock(mtx);
+    for(auto it=sessions.begin(); it!=sessions.end();){
+      if (it->second.use_count()==1){
+	idle.push_back(it->second);
+	it = sessions.erase(it);
+      } else
+	++it;
+    }
+  }
+  // freed here, out of the lock
+}
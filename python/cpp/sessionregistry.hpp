@@ -0,0 +1,41 @@
+#ifndef SESSIONREGISTRY_H
+#define SESSIONREGISTRY_H
+
+#include <cassandra.h>
+#include <string>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <functional>
+using namespace std;
+
+// Cassandra session shared by the handlers connecting to the same
+// cluster with the same credentials and driver options, together with
+// its prepared statements.
+class SharedSession{
+private:
+  mutex mtx;
+  map<string, const CassPrepared*> prepared; // query -> statement
+public:
+  CassCluster* cluster;
+  CassSession* session;
+  // setup configures the cluster before connecting
+  SharedSession(const function<void(CassCluster*)>& setup);
+  ~SharedSession();
+  const CassPrepared* prepare(const string& query);
+};
+
+// Process-wide registry of shared sessions, by connection key. Sessions
+// stay open when their last handler goes away, so that rebuilt handlers
+// reuse them; close_idle frees the unused ones.
+class SessionRegistry{
+private:
+  static mutex mtx;
+  static map<string, shared_ptr<SharedSession>> sessions;
+public:
+  static shared_ptr<SharedSession> get(const string& key,
+				       const function<void(CassCluster*)>& setup);
+  static void close_idle();
+};
+
+#endif
@@ -20,3 +20,10 @@ x,y = h.block_get_batch()
 print(x.getShape())
 print(y.getShape())
 
+
+# same batch as numpy arrays, without copies
+h.schedule_batch([UUID('92cd1dee-78da-4310-a35f-193a6d49809e'),
+                  UUID('e4dd636b-cdbd-4ae2-a4d0-1e428da1a002')])
+x,y = h.block_get_batch_numpy()
+print(x.shape, x.dtype)
+print(y.shape, y.dtype)
@@ -0,0 +1,116 @@
+// Unit tests of the batch assembly kernels: each supported isa must
+// give the same results as the scalar reference.
+#include <iostream>
+#include <vector>
+#include <random>
+#include <cstring>
+
+#include "batchkernels.hpp"
+using namespace std;
+
+static int failures = 0;
+
+static void check(bool ok, const string& what){
+  if (!ok){
+    cout << "FAIL: " << what << endl;
+    ++failures;
+  }
+}
+
+static void test_images(const BatchKernels& ref, const BatchKernels& k,
+			mt19937& rng){
+  uniform_int_distribution<int> byte(0, 255);
+  uniform_real_distribution<float> real(-2, 2);
+  string isa = kernel_isa_name(k.isa);
+  // widths exercising full vectors and tails
+  for(int c : {1, 3, 4})
+    for(int w : {1, 7, 15, 16, 17, 31, 32, 33, 100, 224})
+      for(int pad : {0, 5}){
+	int h = 5;
+	size_t step = w*c + pad;
+	vector<uint8_t> img(h*step);
+	for(auto& v : img)
+	  v = byte(rng);
+	vector<float> scale(c), off(c);
+	for(int ch=0; ch<c; ++ch){
+	  scale[ch] = real(rng);
+	  off[ch] = real(rng);
+	}
+	string tag = isa + " c=" + to_string(c) + " w=" + to_string(w) +
+	  " pad=" + to_string(pad);
+	// hwc -> chw
+	vector<float> a(h*w*c), b(h*w*c);
+	ref.hwc2chw(img.data(), step, a.data(), h, w, c, scale.data(),
+		    off.data());
+	k.hwc2chw(img.data(), step, b.data(), h, w, c, scale.data(),
+		  off.data());
+	check(memcmp(a.data(), b.data(), a.size()*sizeof(float))==0,
+	      "hwc2chw " + tag);
+	// reference is the plain formula
+	bool ok = true;
+	for(int ch=0; ch<c; ++ch)
+	  for(int y=0; y<h; ++y)
+	    for(int x=0; x<w; ++x){
+	      float e = scale[ch] * static_cast<float>(img[y*step + x*c + ch])
+		+ off[ch];
+	      ok = ok && (a[(ch*h + y)*w + x]==e);
+	    }
+	check(ok, "hwc2chw reference " + tag);
+	// chw -> chw, on a planar image
+	if (pad==0){
+	  ref.chw2chw(img.data(), a.data(), h*w, c, scale.data(), off.data());
+	  k.chw2chw(img.data(), b.data(), h*w, c, scale.data(), off.data());
+	  check(memcmp(a.data(), b.data(), a.size()*sizeof(float))==0,
+		"chw2chw " + tag);
+	}
+      }
+}
+
+static void test_labels(const BatchKernels& ref, const BatchKernels& k,
+			mt19937& rng){
+  string isa = kernel_isa_name(k.isa);
+  uniform_int_distribution<int32_t> any;
+  for(int n=1; n<=32; ++n){
+    vector<int32_t> labs = {0, -1, n-1, n, any(rng), any(rng), any(rng)};
+    for(int32_t lab : labs){
+      string tag = isa + " n=" + to_string(n) + " lab=" + to_string(lab);
+      vector<float> a(n, -1), b(n, -1);
+      ref.multi_hot(lab, a.data(), n);
+      k.multi_hot(lab, b.data(), n);
+      check(a==b, "multi_hot " + tag);
+      bool ok = true;
+      for(int i=0; i<n; ++i)
+	ok = ok && (a[i]==static_cast<float>((lab>>i) & 1));
+      check(ok, "multi_hot reference " + tag);
+      ref.one_hot(lab, a.data(), n);
+      k.one_hot(lab, b.data(), n);
+      check(a==b, "one_hot " + tag);
+      ok = true;
+      for(int i=0; i<n; ++i)
+	ok = ok && (a[i]==((i==lab) ? 1.0f : 0.0f));
+      check(ok, "one_hot reference " + tag);
+    }
+  }
+}
+
+int main(){
+  mt19937 rng(42);
+  const BatchKernels& ref = batch_kernels(KernelIsa::scalar);
+  for(auto isa : {KernelIsa::scalar, KernelIsa::sse41, KernelIsa::avx2}){
+    if (!kernel_isa_supported(isa)){
+      cout << kernel_isa_name(isa) << ": not supported, skipped" << endl;
+      continue;
+    }
+    const BatchKernels& k = batch_kernels(isa);
+    test_images(ref, k, rng);
+    test_labels(ref, k, rng);
+    cout << kernel_isa_name(isa) << ": tested" << endl;
+  }
+  cout << "default: " << kernel_isa_name(batch_kernels().isa) << endl;
+  if (failures){
+    cout << failures << " failures" << endl;
+    return(1);
+  }
+  cout << "all tests passed" << endl;
+  return(0);
+}
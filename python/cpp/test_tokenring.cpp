@@ -0,0 +1,118 @@
+// Unit tests of the token ring: tokens must match the ones Cassandra
+// reports for the same partition keys (SELECT token(patch_id) ..., here
+// pinned from the Python driver's Murmur3Token), and keys must map to
+// the node owning their token.
+#include <iostream>
+#include <vector>
+#include <stdexcept>
+#include <cctype>
+
+#include "tokenring.hpp"
+using namespace std;
+
+static int failures = 0;
+
+static void check(bool ok, const string& what){
+  if (!ok){
+    cout << "FAIL: " << what << endl;
+    ++failures;
+  }
+}
+
+static vector<uint8_t> hex2bytes(const string& hex){
+  vector<uint8_t> r;
+  for(size_t i=0; i+1<hex.size(); i+=2)
+    r.push_back(stoi(hex.substr(i, 2), nullptr, 16));
+  return(r);
+}
+
+static void test_uuid_tokens(){
+  vector<pair<string, int64_t>> known = {
+    {"92cd1dee-78da-4310-9a4b-1f0e6c2d3b5a", -7192508108788785347ll},
+    {"00000000-0000-0000-0000-000000000000", 5457549051747178710ll},
+    {"ffffffff-ffff-ffff-ffff-ffffffffffff", -2824192546314762522ll},
+    {"6513270e-269e-0d37-f2a7-4de452e6b438", -3712457634114257828ll},
+    {"d23f0824-128b-2f33-0c5c-7fd0a6a3a450", -4490729605316431960ll},
+    {"9531985d-5d9d-c9f8-1818-e811892f902b", 7371680463930464713ll},
+    {"36f675cc-81e7-4ef5-e8e2-5d940ed90475", -3324826385668658115ll},
+    {"6b0d549b-6f03-675a-1600-a35a099950d8", -4884086685876900736ll},
+    // time-based uuid: time fields must not be reordered
+    {"b79476a4-c9d8-11f1-804d-000000001234", -371389107690384394ll},
+  };
+  for(auto& kt : known){
+    check(uuid_token(kt.first) == kt.second, "token of " + kt.first);
+    // case of the digits does not matter
+    string up = kt.first;
+    for(auto& c : up)
+      c = toupper(c);
+    check(uuid_token(up) == kt.second, "token of " + up);
+  }
+  // wire bytes are the hex digits, in order
+  uint8_t pk[16];
+  uuid_bytes("00112233-4455-6677-8899-aabbccddeeff", pk);
+  bool ok = true;
+  for(int b=0; b<16; ++b)
+    ok = ok && pk[b] == 0x11*b;
+  check(ok, "uuid_bytes");
+  for(string bad : {"", "0011", "00112233-4455-6677-8899-aabbccddeeff00",
+		    "0011223g-4455-6677-8899-aabbccddeeff"}){
+    bool thrown = false;
+    try{
+      uuid_bytes(bad, pk);
+    }
+    catch(const invalid_argument&){
+      thrown = true;
+    }
+    check(thrown, "malformed uuid '" + bad + "'");
+  }
+}
+
+static void test_raw_tokens(){
+  // lengths exercising every tail, and bytes >= 0x80 (sign extension)
+  vector<pair<string, int64_t>> known = {
+    {"", 0ll},
+    {"61", -8839064797231613815ll},
+    {"616263", -5434086359492102041ll},
+    {"c8c9cacbcccdce", 4714062292616372100ll},
+    {"808182838485868788898a8b8c8d8e", 63099782945186636ll},
+    {"000102030405060708090a0b0c0d0e0f10111213", -6642154758453422773ll},
+    {string(66, 'f'), -6464197807167602253ll},
+  };
+  for(auto& kt : known){
+    auto data = hex2bytes(kt.first);
+    check(murmur3_token(data.data(), data.size()) == kt.second,
+	  "token of 0x" + kt.first);
+  }
+}
+
+static void test_owner(){
+  map<int64_t, string> ring;
+  check(ring_owner(ring, 0) == "", "empty ring");
+  ring = {{-6000000000000000000ll, "a"}, {0ll, "b"},
+	  {6000000000000000000ll, "c"}};
+  check(ring_owner(ring, -6000000000000000000ll) == "a", "node token");
+  check(ring_owner(ring, -5999999999999999999ll) == "b", "after node token");
+  check(ring_owner(ring, 1) == "c", "middle range");
+  check(ring_owner(ring, 6000000000000000001ll) == "a", "wrap around");
+  // i.e., key2host of the keys
+  check(ring_owner(ring, uuid_token("92cd1dee-78da-4310-9a4b-1f0e6c2d3b5a"))
+	== "a", "owner of 92cd1dee-...");
+  check(ring_owner(ring, uuid_token("9531985d-5d9d-c9f8-1818-e811892f902b"))
+	== "a", "owner of 9531985d-...");
+  check(ring_owner(ring, uuid_token("36f675cc-81e7-4ef5-e8e2-5d940ed90475"))
+	== "b", "owner of 36f675cc-...");
+  check(ring_owner(ring, uuid_token("00000000-0000-0000-0000-000000000000"))
+	== "c", "owner of 00000000-...");
+}
+
+int main(){
+  test_uuid_tokens();
+  test_raw_tokens();
+  test_owner();
+  if (failures){
+    cout << failures << " failures" << endl;
+    return(1);
+  }
+  cout << "all tests passed" << endl;
+  return(0);
+}
@@ -0,0 +1,107 @@
+#include "tokenring.hpp"
+
+#include <stdexcept>
+#include <climits>
+
+int64_t murmur3_token(const uint8_t* data, size_t len){
+  // token of Murmur3Partitioner: first half of murmur3 x64_128, seed 0
+  auto rotl = [](uint64_t x, int r) -> uint64_t {return (x<<r) | (x>>(64-r));};
+  auto fmix = [](uint64_t k) -> uint64_t {
+    k ^= k >> 33; k *= 0xff51afd7ed558ccdull;
+    k ^= k >> 33; k *= 0xc4ceb9fe1a85ec53ull;
+    k ^= k >> 33;
+    return k;
+  };
+  const uint64_t c1 = 0x87c37b91114253d5ull;
+  const uint64_t c2 = 0x4cf5ad432745937full;
+  uint64_t h1 = 0, h2 = 0;
+  auto getblock = [](const uint8_t* p) -> uint64_t {
+    uint64_t r = 0;
+    for(int b=7; b>=0; --b)
+      r = (r<<8) | p[b]; // little endian
+    return r;
+  };
+  size_t nblocks = len / 16;
+  for(size_t i=0; i<nblocks; ++i){
+    uint64_t k1 = getblock(data + i*16);
+    uint64_t k2 = getblock(data + i*16 + 8);
+    k1 *= c1; k1 = rotl(k1, 31); k1 *= c2; h1 ^= k1;
+    h1 = rotl(h1, 27); h1 += h2; h1 = h1*5 + 0x52dce729;
+    k2 *= c2; k2 = rotl(k2, 33); k2 *= c1; h2 ^= k2;
+    h2 = rotl(h2, 31); h2 += h1; h2 = h2*5 + 0x38495ab5;
+  }
+  // tail, with sign extension of bytes as in Cassandra
+  const uint8_t* tail = data + nblocks*16;
+  uint64_t k1 = 0, k2 = 0;
+  auto sb = [&](size_t i) -> uint64_t {
+    return static_cast<uint64_t>(static_cast<int64_t>(static_cast<int8_t>(tail[i])));
+  };
+  switch(len & 15){
+  case 15: k2 ^= sb(14) << 48; [[fallthrough]];
+  case 14: k2 ^= sb(13) << 40; [[fallthrough]];
+  case 13: k2 ^= sb(12) << 32; [[fallthrough]];
+  case 12: k2 ^= sb(11) << 24; [[fallthrough]];
+  case 11: k2 ^= sb(10) << 16; [[fallthrough]];
+  case 10: k2 ^= sb(9) << 8; [[fallthrough]];
+  case 9: k2 ^= sb(8);
+    k2 *= c2; k2 = rotl(k2, 33); k2 *= c1; h2 ^= k2;
+    [[fallthrough]];
+  case 8: k1 ^= sb(7) << 56; [[fallthrough]];
+  case 7: k1 ^= sb(6) << 48; [[fallthrough]];
+  case 6: k1 ^= sb(5) << 40; [[fallthrough]];
+  case 5: k1 ^= sb(4) << 32; [[fallthrough]];
+  case 4: k1 ^= sb(3) << 24; [[fallthrough]];
+  case 3: k1 ^= sb(2) << 16; [[fallthrough]];
+  case 2: k1 ^= sb(1) << 8; [[fallthrough]];
+  case 1: k1 ^= sb(0);
+    k1 *= c1; k1 = rotl(k1, 31); k1 *= c2; h1 ^= k1;
+  }
+  h1 ^= len; h2 ^= len;
+  h1 += h2; h2 += h1;
+  h1 = fmix(h1); h2 = fmix(h2);
+  h1 += h2;
+  int64_t tok = static_cast<int64_t>(h1);
+  if (tok == INT64_MIN)
+    tok = INT64_MAX;
+  return(tok);
+}
+
+void uuid_bytes(const string& key, uint8_t* out){
+  // the hex digits, in order, are the serialized uuid
+  auto nibble = [](char c) -> int {
+    if (c>='0' && c<='9') return c - '0';
+    if (c>='a' && c<='f') return c - 'a' + 10;
+    if (c>='A' && c<='F') return c - 'A' + 10;
+    return -1;
+  };
+  int n = 0;
+  for(char c : key){
+    if (c=='-')
+      continue;
+    int v = nibble(c);
+    if (v<0 || n==32)
+      throw invalid_argument("Error: malformed uuid " + key);
+    if (n%2==0)
+      out[n/2] = v << 4;
+    else
+      out[n/2] |= v;
+    ++n;
+  }
+  if (n!=32)
+    throw invalid_argument("Error: malformed uuid " + key);
+}
+
+int64_t uuid_token(const string& key){
+  uint8_t pk[16];
+  uuid_bytes(key, pk);
+  return(murmur3_token(pk, 16));
+}
+
+string ring_owner(const map<int64_t, string>& ring, int64_t tok){
+  if (ring.empty())
+    return("");
+  auto it = ring.lower_bound(tok);
+  if (it == ring.end()) // wrap around
+    it = ring.begin();
+  return(it->second);
+}
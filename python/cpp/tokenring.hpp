@@ -0,0 +1,26 @@
+#ifndef TOKENRING_H
+#define TOKENRING_H
+
+#include <cstdint>
+#include <cstddef>
+#include <string>
+#include <map>
+using namespace std;
+
+// Token of a partition key, as computed by Cassandra's
+// Murmur3Partitioner, and owner of a token on the ring of the nodes.
+// No driver calls: keys are taken as text and serialized here.
+
+// token of the serialized partition key: first half of murmur3 x64_128,
+// seed 0, with Cassandra's sign extension of the tail bytes
+int64_t murmur3_token(const uint8_t* data, size_t len);
+// uuid in text form (hex digits, dashes ignored) to its 16 wire bytes,
+// throws invalid_argument if malformed
+void uuid_bytes(const string& key, uint8_t* out);
+// token of a uuid partition key, given as text
+int64_t uuid_token(const string& key);
+// node owning the token: first node token not lower than it, wrapping
+// around; empty if the ring is empty
+string ring_owner(const map<int64_t, string>& ring, int64_t tok);
+
+#endif
@@ -13,7 +13,7 @@ sys.path.append('../')
 
 from pyeddl.tensor import Tensor
 
-from cassandra_dataset import CassandraDataset
+from cassandra_dataset import CassandraDataset, raw_to_uuids
 
 from cassandra.auth import PlainTextAuthProvider
 from getpass import getpass
@@ -62,7 +62,7 @@ def main(args):
     
         #print ("Current split: %d, %s" % (si, split_name), flush=True)
         cd.rewind_splits(shuffle=False)
-        rows = cd.row_keys[cd.split[si]]
+        rows = raw_to_uuids(cd.row_keys[cd.split[si]])
         n_rows = len(rows)
         
         pbar = tqdm(range(n_rows))
@@ -73,7 +73,7 @@ def main(args):
         pbar = tqdm(rows)
         for r_index, r in enumerate(pbar):
             key = rows[r_index]
-            res = cd._clm.sess.execute(prep, key, execution_profile='tuple')
+            res = cd._clm.sess.execute(prep, [key], execution_profile='tuple')
             data = res.one()
             idx = '%s.jpg' % str(data[0])
             lab = data[1]
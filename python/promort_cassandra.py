@@ -134,12 +134,14 @@ def main(args):
     # create cassandra reader
     ap = PlainTextAuthProvider(username='prom', password=cass_pass)
     #cd = CassandraDataset(ap, ['cassandra_db'])
-    cd = CassandraDataset(ap, ['127.0.0.1'], seed=args.seed)
+    cd = CassandraDataset(ap, ['127.0.0.1'], seed=args.seed, norm_scale=1/255,
+                          mem_cache_splits=args.mem_cache_splits)
 
     # Check if file exists
     if Path(args.splits_fn).exists():
         # Load splits 
-        cd.load_splits(args.splits_fn, batch_size=args.batch_size, augs=dataset_augs)
+        cd.load_splits(args.splits_fn, batch_size=args.batch_size, augs=dataset_augs,
+                       prefetch_depth=args.prefetch_depth)
     else:
         print ("Split file %s not found" % args.splits_fn)
         sys.exit(-1)
@@ -221,7 +223,6 @@ def main(args):
             else:
                 x, y = cd.load_batch()
     
-            x.div_(255.0)
             tx, ty = [x], [y]
             eddl.train_batch(net, tx, ty)
             
@@ -254,7 +255,6 @@ def main(args):
             else:
                 x, y = cd.load_batch()
 
-            x.div_(255.0)
             eddl.forward(net, [x])
             output = eddl.getOutput(out)
             sum_ca = 0.0 ## sum of samples accuracy within a batch
@@ -313,6 +313,8 @@ if __name__ == "__main__":
     parser.add_argument("--batch-size", type=int, metavar="INT", default=32, help='Batch size')
     parser.add_argument("--val-split-indexes", type=int, nargs='+', default=[], help='List of split indexs to be used as validation set in case of a multisplit dataset (e.g. for cross validation purpose')
     parser.add_argument("--test-split-indexes", type=int, nargs='+', default=[], help='List of split indexs to be used as validation set in case of a multisplit dataset (e.g. for cross validation purpose')
+    parser.add_argument("--prefetch-depth", type=int, metavar="INT", default=1, help='Number of batches per split loaded in advance from Cassandra')
+    parser.add_argument("--mem-cache-splits", type=int, nargs='+', default=[], help='Splits without augmentations to be kept in memory after the first epoch (e.g. validation)')
     parser.add_argument("--lsb", type=int, metavar="INT", default=1, help='(Multi-gpu setting) Number of batches to run before synchronizing the weights of the different GPUs')
     parser.add_argument("--seed", type=int, metavar="INT", default=None, help='Seed of the random generator to manage data load')
     parser.add_argument("--lr", type=float, metavar="FLOAT", default=1e-5, help='Learning rate')
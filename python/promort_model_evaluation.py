@@ -13,7 +13,7 @@ import pyecvl.ecvl as ecvl
 import pyeddl.eddl as eddl
 from pyeddl.tensor import Tensor
 
-from cassandra_dataset import CassandraDataset
+from cassandra_dataset import CassandraDataset, raw_to_uuids
 
 from cassandra.auth import PlainTextAuthProvider
 from getpass import getpass
@@ -104,7 +104,7 @@ def main(args):
     # create cassandra reader
     ap = PlainTextAuthProvider(username='prom', password=cass_pass)
     #cd = CassandraDataset(ap, ['cassandra_db'])
-    cd = CassandraDataset(ap, ['127.0.0.1'])
+    cd = CassandraDataset(ap, ['127.0.0.1'], norm_scale=1/255)
 
     try:
         cd.load_splits(args.splits_fn, batch_size=args.batch_size, augs=[])
@@ -140,7 +140,6 @@ def main(args):
         
         n = 0
         x, y = cd.load_batch()
-        x.div_(255.0)
         eddl.forward(net, [x])
         output = eddl.getOutput(out)
         
@@ -153,7 +152,7 @@ def main(args):
             total_metric.append(ca)
             sum_ += ca
             
-            p_id = str(ids[k]['patch_id'])
+            p_id = str(raw_to_uuids(ids[k:k+1])[0])
             result_np = result.getdata()[0]
             gt_np = target.getdata()[0]
             normal_p = result_np[0]
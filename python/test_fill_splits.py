@@ -0,0 +1,108 @@
+"""
+Equivalence of the vectorized and the reference (one patch at a time)
+split filling of CassandraListManager, on random tables without a DB.
+
+Run with: python3 test_fill_splits.py (or pytest)
+"""
+
+import numpy as np
+
+from cassandra_dataset import CassandraListManager, _max_multilabs
+
+
+class _LocalListManager(CassandraListManager):
+    # list manager on random rows, no Cassandra session
+    def __init__(self, num_samples, num_classes, split_ncols, rs):
+        self.split_ncols = split_ncols
+        self.num_classes = num_classes
+        if (num_classes<=_max_multilabs):
+            self.labs = [2**i for i in range(num_classes)]
+        else:
+            self.labs = list(range(num_classes))
+        self.max_patches = None
+        self.balance = None
+        self.split_ratios = None
+        self.num_splits = None
+        self._bags = None
+        # uneven samples, some classes missing in some samples
+        stats = rs.randint(0, 60, size=(num_samples, num_classes))
+        stats[rs.rand(num_samples, num_classes)<0.2] = 0
+        ids = rs.randint(0, 256, size=(stats.sum(), 16)).astype(np.uint8)
+        names = [(f'sample_{i}',) for i in range(num_samples)]
+        self.set_rows((names, ids, stats))
+    def __del__(self):
+        pass
+
+
+def _splits(seed, reference, **setup):
+    rs = np.random.RandomState(seed)
+    clm = _LocalListManager(num_samples=rs.randint(8, 40),
+                            num_classes=rs.randint(2, 5),
+                            split_ncols=setup.pop('split_ncols', 1), rs=rs)
+    if (reference):
+        clm._fill_splits = clm._fill_splits_loop
+    if ('balance' in setup and setup['balance'] is None):
+        setup['balance'] = rs.rand(clm.num_classes) + 0.1
+    clm.split_setup(seed=seed, **setup)
+    return clm
+
+
+def _check(seed, **setup):
+    ref = _splits(seed, True, **dict(setup))
+    vec = _splits(seed, False, **dict(setup))
+    assert np.array_equal(ref.row_index, vec.row_index), (seed, setup)
+    assert np.array_equal(ref.row_keys, vec.row_keys), (seed, setup)
+    assert len(ref.split)==len(vec.split)
+    for a, b in zip(ref.split, vec.split):
+        assert np.array_equal(a, b), (seed, setup)
+    assert np.array_equal(ref._cow_rows, vec._cow_rows), (seed, setup)
+
+
+def test_all_patches():
+    for seed in range(20):
+        _check(seed, split_ratios=[7, 2, 1])
+
+
+def test_max_patches():
+    for seed in range(20):
+        for mp in [1, 17, 200, 10**6]:
+            _check(seed, max_patches=mp, split_ratios=[3, 1])
+
+
+def test_balance():
+    # classes running out of patches, in some splits
+    for seed in range(20):
+        _check(seed, max_patches=300, split_ratios=[5, 3, 2], balance=None)
+
+
+def test_no_grouping():
+    # the same bag (all samples) shared by all splits
+    for seed in range(10):
+        _check(seed, max_patches=250, split_ratios=[1, 1], split_ncols=0)
+
+
+def test_round_robin():
+    rs = np.random.RandomState(0)
+    for _ in range(500):
+        avail = rs.randint(0, 10, size=rs.randint(1, 8))
+        quota = rs.randint(0, avail.sum()+5)
+        # cycle over the samples, skipping the empty ones
+        left = avail.copy()
+        take = np.zeros_like(avail)
+        cur = 0
+        while (take.sum()<quota and left.sum()>0):
+            if (left[cur]>0):
+                left[cur] -= 1
+                take[cur] += 1
+            cur = (cur+1) % avail.size
+        got = CassandraListManager._round_robin(avail, quota)
+        assert np.array_equal(got, take), (avail, quota)
+
+
+if __name__ == "__main__":
+    test_round_robin()
+    test_all_patches()
+    test_max_patches()
+    test_balance()
+    test_no_grouping()
+    print('All tests passed')
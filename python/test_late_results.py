@@ -0,0 +1,92 @@
+"""
+Late results of a failed batch, decoded after the Python BatchPatchHandler
+moved on to the next batch, must not be written into the new one.
+
+Run with: python3 test_late_results.py (or pytest)
+"""
+
+import threading
+
+import numpy as np
+
+import cassandra_dataset as cd
+from test_multi_get import _Future, _db, _handler
+
+
+class _ThreadFuture(_Future):
+    # callbacks from another thread, after release is set
+    def __init__(self, rows, release=None):
+        super().__init__(rows)
+        self.release = release
+    def add_callbacks(self, callback, errback):
+        def run():
+            if (self.release is not None):
+                self.release.wait()
+            if (isinstance(self.rows, Exception)):
+                errback(self.rows)
+            else:
+                callback(self.rows)
+        threading.Thread(target=run, daemon=True).start()
+
+
+def test_late_decode():
+    if (cd._cpp_handler):
+        return # Python handler not in use
+    db = _db(6)
+    keys = list(db)
+    bad = keys.pop() # failing request
+    h, sess = _handler(db, multi_get=1)
+    held = {keys[3]: threading.Event()} # answer of batch B, held
+    def execute_async(prep, args, execution_profile=None, host=None):
+        k = args[0]
+        if (k==bad):
+            return _ThreadFuture(KeyError(k))
+        return _ThreadFuture([{'label': db[k][0], 'data': db[k][1]}],
+                             held.get(k))
+    sess.execute_async = execute_async
+    # the decode of keys[1] (batch A) waits until batch B is in flight
+    started = threading.Event()
+    resume = threading.Event()
+    late_done = threading.Event()
+    late = []
+    get_img = h._get_img
+    def slow_get_img(item):
+        if (item['data']==db[keys[1]][1]):
+            late.append(threading.current_thread())
+            started.set()
+            resume.wait()
+        return get_img(item)
+    h._get_img = slow_get_img
+    patch_done = h._patch_done
+    def traced_patch_done(*args):
+        patch_done(*args)
+        if (threading.current_thread() in late):
+            late_done.set()
+    h._patch_done = traced_patch_done
+    # batch A fails, while keys[1] is still being decoded
+    h.schedule_batch([keys[0], keys[1], bad])
+    try:
+        h.block_get_batch()
+        assert False, 'batch A should fail'
+    except KeyError:
+        pass
+    assert started.wait(5)
+    # batch B, same size: buffers reused
+    batch = [keys[2], keys[4], keys[3]]
+    h.schedule_batch(batch)
+    for _ in range(500): # wait for the answers not held
+        if (h.cow==2):
+            break
+        threading.Event().wait(0.01)
+    resume.set() # late write of batch A
+    assert late_done.wait(5)
+    held[keys[3]].set()
+    x, y = h.block_get_batch()
+    exp = np.array([db[k][2][..., ::-1].transpose(2, 0, 1) for k in batch])
+    assert (np.array(x.getdata()) == exp).all()
+    assert h.cow==3 and h.onair==0
+
+
+if __name__ == "__main__":
+    test_late_decode()
+    print('All tests passed')
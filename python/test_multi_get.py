@@ -0,0 +1,136 @@
+"""
+Grouped (multi_get) requests of the Python BatchPatchHandler, bound with
+the real cassandra-driver statements, on a fake session.
+
+Run with: python3 test_multi_get.py (or pytest)
+"""
+
+import io
+import uuid
+from collections import namedtuple
+
+import numpy as np
+import PIL.Image
+from cassandra.cqltypes import UUIDType, ListType
+from cassandra.query import PreparedStatement, BoundStatement
+
+import cassandra_dataset as cd
+
+_Col = namedtuple('_Col', 'keyspace_name table_name name type')
+_Host = namedtuple('_Host', 'address is_up')
+_hosts = [_Host(f'10.0.0.{i}', True) for i in range(3)]
+
+
+def _prepare(query):
+    # real prepared statement, as returned by a node
+    if (' IN ' in query):
+        cols = [_Col('ks', 't', 'patch_id',
+                     ListType.apply_parameters([UUIDType]))]
+        rk = None # no routing key for IN lists
+    else:
+        cols = [_Col('ks', 't', 'patch_id', UUIDType)]
+        rk = [0]
+    return PreparedStatement(cols, query.encode(), rk, query, 'ks', 4,
+                             [], None)
+
+
+class _Future():
+    def __init__(self, rows):
+        self.rows = rows
+    def add_callbacks(self, callback, errback):
+        callback(self.rows)
+
+
+class _Metadata():
+    def get_replicas(self, keyspace, routing_key):
+        h = _hosts[routing_key[0] % len(_hosts)]
+        return [h] + [o for o in _hosts if o!=h]
+
+
+class _Cluster():
+    metadata = _Metadata()
+
+
+class _Session():
+    def __init__(self, db):
+        self.db = db
+        self.sent = [] # (statement, host)
+    def execute_async(self, prep, args, execution_profile=None, host=None):
+        stmt = prep.bind(args)
+        assert isinstance(stmt, BoundStatement)
+        self.sent.append((stmt, host))
+        if (' IN ' in prep.query_string):
+            return _Future([{'patch_id': k, 'label': self.db[k][0],
+                             'data': self.db[k][1]} for k in args[0]])
+        k = args[0]
+        return _Future([{'label': self.db[k][0], 'data': self.db[k][1]}])
+
+
+class _Shared():
+    def __init__(self, db):
+        self.sess = _Session(db)
+        self.cluster = _Cluster()
+        self.users = 0
+    def prepare(self, query):
+        return _prepare(query)
+
+
+def _db(n):
+    rs = np.random.RandomState(0)
+    db = {}
+    for i in range(n):
+        arr = rs.randint(0, 255, (8, 8, 3), dtype=np.uint8)
+        buf = io.BytesIO()
+        PIL.Image.fromarray(arr).save(buf, 'PNG')
+        db[uuid.UUID(int=rs.randint(2**62))] = (1 << (i%2), buf.getvalue(),
+                                                arr)
+    return db
+
+
+def _handler(db, multi_get):
+    shared = _Shared(db)
+    get_session = cd.get_session
+    cd.get_session = lambda *a: shared
+    try:
+        h = cd.BatchPatchHandler(2, None, 'ks.t', 'label', 'data',
+                                 'patch_id', 'u', 'p', ['x'],
+                                 thread_par=4, multi_get=multi_get)
+    finally:
+        cd.get_session = get_session
+    return h, shared.sess
+
+
+def test_in_lists():
+    if (cd._cpp_handler):
+        return # Python handler not in use
+    db = _db(40)
+    keys = list(db)
+    h, sess = _handler(db, multi_get=8)
+    h.schedule_batch(cd.uuids_to_raw(keys))
+    x, y = h.block_get_batch()
+    exp = np.array([db[k][2][..., ::-1].transpose(2, 0, 1) for k in keys])
+    assert (np.array(x.getdata()) == exp).all()
+    labs = np.array([db[k][0]>>1 for k in keys])
+    assert (np.array(y.getdata()).argmax(1) == labs).all()
+    # IN lists sent to the replica owning all their keys
+    grouped = [(s, host) for (s, host) in sess.sent
+               if ' IN ' in s.prepared_statement.query_string]
+    assert grouped
+    for (stmt, host) in grouped:
+        assert stmt.routing_key is None
+        assert host is not None
+    for key in keys:
+        owner = h._replicas(key)[0]
+        sent = [host for (s, host) in grouped if key in _in_keys(s)]
+        assert sent==[owner]
+
+
+def _in_keys(stmt):
+    # uuids bound to an IN list
+    lt = ListType.apply_parameters([UUIDType])
+    return lt.from_binary(stmt.values[0], 4)
+
+
+if __name__ == "__main__":
+    test_in_lists()
+    print('All tests passed')